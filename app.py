@@ -1,41 +1,207 @@
-import time
-from flask import Flask, render_template, request, redirect, url_for
-from lpp import get_recommendations
+"""This file contains the LitLoom web app.
 
-app = Flask(__name__)
+create_app builds the app and loads the catalog before returning it. A server that builds the app once in a master
+process and forks its workers from it, as uwsgi does with wsgi.py, therefore loads the catalog once, and every
+worker shares it copy-on-write. Background threads are started by each worker on its first request instead, since
+threads do not survive a fork.
+"""
+import json
+from typing import Optional
+
+from flask import (Flask, Response, abort, current_app, has_app_context, jsonify, render_template, request, redirect,
+                   url_for)
+from binary_catalog import binary_snapshot
+from catalog import get_catalog
+from catalog_store import CatalogReloader
+from jobs import DONE, JobManager, JobQueueFull
+from lpp import format_recommendations
+from service import RecommendationService, ServiceOverloaded
+from telemetry import CONTENT_TYPE, REGISTRY, instrument
+from votes import get_vote_store
 
 
-@app.route('/')
 def home():
     return render_template('home_page.html')
 
 
-@app.route('/select_genres')
 def select_genres():
     return render_template('genre_requests.html')
 
 
-@app.route('/process', methods=['POST'])
 def process():
     selected_genres = request.form.getlist('genres')
     form_submitted = request.form.get('form_submitted')
     show_loading_overlay = True
 
     if form_submitted == 'true':
-        # Simulate processing time
-        time.sleep(0.5)
-        books = get_recommendations(selected_genres)
-        time.sleep(0.5)
-        return redirect(url_for('display_selected_genres', books=books))
+        genre_votes = {selected_genre: 1 for selected_genre in selected_genres}
+        return submit_recommendations(genre_votes)
 
     return render_template('genre_requests.html', show_loading_overlay=show_loading_overlay)
 
 
-@app.route('/display_selected_genres')
-def display_selected_genres():
-    books = request.args.getlist('books')
-    return render_template('selected_genres_page.html', books=books)
+def submit_recommendations(genre_votes):
+    service, jobs = current_app.extensions['litloom']['service'], current_app.extensions['litloom']['jobs']
+    try:
+        pending = service.submit(genre_votes)
+        job_id = jobs.submit(lambda: format_recommendations(pending.result()))
+    except (ServiceOverloaded, JobQueueFull):
+        return render_template('genre_requests.html', busy=True), 503
+    return redirect(url_for('job_page', job_id=job_id), code=303)
+
+
+def club_votes(club):
+    """Return the total votes for each genre in club, after casting the ballot posted, if any: either a form with
+    a member and their genres, or a JSON object with a member and a votes object mapping genres to whole numbers.
+    >>> import os, tempfile
+    >>> database = os.path.join(tempfile.mkdtemp(), 'votes.db')
+    >>> client = create_app({'TESTING': True, 'VOTES_DATABASE': database}).test_client()
+    >>> client.post('/clubs/mystery/votes', json={'member': 'ana', 'votes': {'Horror': 2}}).json
+    {'Horror': 2}
+    >>> bodies = [[1, 2], 'ana', {'member': 3, 'votes': {}}, {'member': 'ana', 'votes': ['Horror']},
+    ...           {'member': 'ana', 'votes': {'Horror': 'two'}}]
+    >>> [client.post('/clubs/mystery/votes', json=body).status_code for body in bodies]
+    [400, 400, 400, 400, 400]
+    >>> client.post('/clubs/mystery/votes', data='{', content_type='application/json').status_code
+    400
+    """
+    store = get_vote_store(current_app.config['VOTES_DATABASE'])
+    if request.method == 'POST':
+        if request.is_json:
+            body = request.get_json(silent=True)
+            if not isinstance(body, dict):
+                abort(400)
+            member, ballot = body.get('member'), body.get('votes', {})
+        else:
+            member, ballot = request.form.get('member'), {genre: 1 for genre in request.form.getlist('genres')}
+        # JSON object keys are always strings, and cast checks that every vote is a whole number.
+        if not member or not isinstance(member, str) or not isinstance(ballot, dict):
+            abort(400)
+        try:
+            store.cast(club, member, ballot)
+        except ValueError as error:
+            return jsonify({'error': str(error)}), 400
+    return jsonify(store.genre_votes(club))
+
+
+def club_recommendations(club):
+    genre_votes = get_vote_store(current_app.config['VOTES_DATABASE']).genre_votes(club)
+    if not genre_votes:
+        abort(404)
+    return submit_recommendations(genre_votes)
+
+
+def job_page(job_id):
+    job = current_app.extensions['litloom']['jobs'].get(job_id) or abort(404)
+    if job.status == DONE:
+        return render_template('selected_genres_page.html', books=job.result)
+    return render_template('job_status.html', job=job)
+
+
+def job_status(job_id):
+    job = current_app.extensions['litloom']['jobs'].get(job_id) or abort(404)
+    return jsonify(job.to_dict())
+
+
+def job_events(job_id):
+    job = current_app.extensions['litloom']['jobs'].get(job_id) or abort(404)
+
+    def stream():
+        # Comments keep the connection open through proxies until the job finishes.
+        while not job.wait(timeout=15):
+            yield ': waiting\n\n'
+        yield f'event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n'
+
+    return Response(stream(), content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+def metrics():
+    """Return every metric in the Prometheus text format, including the stage timings and recommendation cache
+    counts the service's worker processes send back with their results.
+    >>> import time
+    >>> _ = create_app({'TESTING': True})
+    >>> client = create_app({'TESTING': True}).test_client()
+    >>> client.get('/metrics').text.count('# TYPE litloom_jobs_unfinished gauge')
+    1
+    >>> def sample(name):
+    ...     lines = client.get('/metrics').text.splitlines()
+    ...     return sum(float(line.split()[-1]) for line in lines if line.split()[0] == name)
+    >>> selects = sample('litloom_stage_seconds_count{stage="select"}')
+    >>> misses = sample('litloom_recommendation_cache_misses_total')
+    >>> job = client.post('/process', data={'genres': ['Horror', 'Poetry'], 'form_submitted': 'true'}).location
+    >>> deadline = time.monotonic() + 60
+    >>> while sample('litloom_recommendation_cache_misses_total') == misses and time.monotonic() < deadline:
+    ...     time.sleep(0.05)
+    >>> sample('litloom_recommendation_cache_misses_total') - misses
+    1.0
+    >>> sample('litloom_stage_seconds_count{stage="select"}') > selects
+    True
+    """
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def app_gauges() -> list[tuple[str, str, str, float]]:
+    """Return the gauges of the current app's jobs and recommendation service, as a metrics collector, or none
+    outside an app context. It is registered once, for every app, so that each app's /metrics shows its own
+    gauges and the registry does not keep apps alive.
+    """
+    if not has_app_context() or 'litloom' not in current_app.extensions:
+        return []
+    jobs, service = current_app.extensions['litloom']['jobs'], current_app.extensions['litloom']['service']
+    return [('litloom_jobs_unfinished', 'gauge', 'Recommendation jobs waiting or running.', jobs.stats()['unfinished']),
+            ('litloom_jobs_stored', 'gauge', 'Recommendation jobs kept in the result store.', jobs.stats()['stored']),
+            ('litloom_service_in_flight', 'gauge', 'Recommendation requests in the worker processes.',
+             service.stats()['in_flight'])]
+
+
+REGISTRY.register_collector(app_gauges)
+
+
+# The rule, view function and methods of every route.
+ROUTES = [
+    ('/', home, ['GET']),
+    ('/select_genres', select_genres, ['GET']),
+    ('/process', process, ['POST']),
+    ('/clubs/<club>/votes', club_votes, ['GET', 'POST']),
+    ('/clubs/<club>/recommendations', club_recommendations, ['POST']),
+    ('/jobs/<job_id>', job_page, ['GET']),
+    ('/jobs/<job_id>/status', job_status, ['GET']),
+    ('/jobs/<job_id>/events', job_events, ['GET']),
+    ('/metrics', metrics, ['GET']),
+]
+
+
+def create_app(config: Optional[dict] = None) -> Flask:
+    """Return a new app, with its settings taken from config over the defaults, and its catalog loaded.
+    >>> client = create_app({'TESTING': True}).test_client()
+    >>> client.get('/select_genres').status_code
+    200
+    """
+    app = Flask(__name__)
+    app.config.update(CATALOG='book_info.csv', CATALOG_RELOAD_SECONDS=5.0, VOTES_DATABASE='votes.db',
+                      SERVICE_PROCESSES=None)
+    app.config.update(config or {})
+    instrument(app)
+    for rule, view, methods in ROUTES:
+        app.add_url_rule(rule, view_func=view, methods=methods)
+
+    get_catalog(app.config['CATALOG'])
+    # Written here, before a pre-forking server forks, so that no worker has to write it on its first request.
+    binary_snapshot(app.config['CATALOG'])
+    service = RecommendationService(app.config['CATALOG'], processes=app.config['SERVICE_PROCESSES'])
+    jobs = JobManager(max_workers=service.processes + service.max_queue, max_pending=64, ttl=600)
+    # Changes to the catalog are loaded in the background and swapped in between requests, in this process and
+    # in the service's workers.
+    reloader = CatalogReloader(app.config['CATALOG'], interval=app.config['CATALOG_RELOAD_SECONDS'],
+                               on_reload=service.publish_catalog)
+    app.extensions['litloom'] = {'service': service, 'jobs': jobs, 'reloader': reloader}
+
+    @app.before_request
+    def start_reloader():
+        reloader.start()
+
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,271 @@
+"""This file contains the compact binary catalog format, and converters between it and book_info.csv.
+
+A binary catalog is read through mmap: loading one only reads its header, and the columns are used in place as
+views of the mapped file. Several worker processes that load the same file therefore share one copy of it in the
+operating system's page cache instead of each parsing the csv into memory of their own.
+
+File layout (all integers little-endian):
+- a header: the magic bytes b'LITLOOM\\0', the format version, the number of books, the number of genres, and
+  the number of sections, followed by an (offset, length) pair for each section
+- the sections, in SECTIONS order, each starting on an 8-byte boundary:
+  - ratings (float64), rating_counts (int64) and rating_scores (float64), one per book
+  - title_offsets (int64) and title_data (utf-8): the title table; title i is
+    title_data[title_offsets[i]:title_offsets[i + 1]]
+  - author_ids (int32), one per book, into the interned author table author_offsets / author_data
+  - genre_offsets / genre_data: the interned genre names, indexed by genre id
+  - book_indptr (int64) and book_genres (int32): the genre ids of each book
+  - genre_indptr (int64) and genre_books (int32): the posting list of book ids for each genre
+  - index_genre_books (int32) and index_genre_keys (float64): the genre index's posting lists, sorted by rating
+    score, and their negated rating scores
+  - index_all_books (int32) and index_all_keys (float64): the genre index's list of every book, sorted by
+    rating score, and their negated rating scores
+
+The genre index is stored sorted so that loading a binary catalog never sorts anything.
+"""
+import csv
+import glob
+import mmap
+import os
+import struct
+import tempfile
+from typing import Sequence, Union
+
+import numpy as np
+
+from books import write_to_csv
+from catalog import BINARY_SUFFIX, Catalog, catalog_version, get_catalog
+
+MAGIC = b'LITLOOM\0'
+FORMAT_VERSION = 2
+SECTIONS = ['ratings', 'rating_counts', 'rating_scores', 'title_offsets', 'title_data', 'author_ids',
+            'author_offsets', 'author_data', 'genre_offsets', 'genre_data', 'book_indptr', 'book_genres',
+            'genre_indptr', 'genre_books', 'index_genre_books', 'index_genre_keys', 'index_all_books',
+            'index_all_keys']
+SECTION_TYPES = {'ratings': np.float64, 'rating_counts': np.int64, 'rating_scores': np.float64,
+                 'title_offsets': np.int64, 'title_data': np.uint8, 'author_ids': np.int32,
+                 'author_offsets': np.int64, 'author_data': np.uint8, 'genre_offsets': np.int64,
+                 'genre_data': np.uint8, 'book_indptr': np.int64, 'book_genres': np.int32,
+                 'genre_indptr': np.int64, 'genre_books': np.int32, 'index_genre_books': np.int32,
+                 'index_genre_keys': np.float64, 'index_all_books': np.int32, 'index_all_keys': np.float64}
+HEADER = struct.Struct('<8sIQQI')
+SECTION_ENTRY = struct.Struct('<QQ')
+
+
+class StringTable(Sequence[str]):
+    """A read-only sequence of strings stored back to back as utf-8, decoded only when accessed.
+
+    Instance Attributes:
+    - offsets: string i is data[offsets[i]:offsets[i + 1]]
+    - data: the encoded strings
+    """
+    offsets: np.ndarray
+    data: np.ndarray
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray) -> None:
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, list[str]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('string table index out of range')
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+
+class InternedStrings(Sequence[str]):
+    """A read-only sequence of strings, each stored as an id into a table of distinct strings.
+    """
+    ids: np.ndarray
+    table: Sequence[str]
+
+    def __init__(self, ids: np.ndarray, table: Sequence[str]) -> None:
+        self.ids = ids
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, list[str]]:
+        if isinstance(index, slice):
+            return [self.table[i] for i in self.ids[index].tolist()]
+        return self.table[int(self.ids[index])]
+
+
+def write_binary_catalog(catalog: Catalog, filename: str) -> None:
+    """Write the catalog to filename in the binary catalog format, replacing the file atomically.
+    """
+    titles, title_offsets = _encode_strings(catalog.titles)
+    author_ids = {}
+    book_authors = np.array([author_ids.setdefault(author, len(author_ids)) for author in catalog.authors],
+                            dtype=np.int32)
+    authors, author_offsets = _encode_strings(list(author_ids))
+    genres, genre_offsets = _encode_strings(catalog.genre_names)
+    index = catalog.genre_index()
+    columns = {'ratings': catalog.ratings, 'rating_counts': catalog.rating_counts,
+               'rating_scores': catalog.rating_scores, 'title_offsets': title_offsets, 'title_data': titles,
+               'author_ids': book_authors, 'author_offsets': author_offsets, 'author_data': authors,
+               'genre_offsets': genre_offsets, 'genre_data': genres, 'book_indptr': catalog.book_indptr,
+               'book_genres': catalog.book_genres, 'genre_indptr': catalog.genre_indptr,
+               'genre_books': catalog.genre_books, 'index_genre_books': index.genre_books,
+               'index_genre_keys': index.genre_keys, 'index_all_books': index.all_books,
+               'index_all_keys': index.all_keys}
+
+    position = _align(HEADER.size + SECTION_ENTRY.size * len(SECTIONS))
+    entries = []
+    for name in SECTIONS:
+        columns[name] = np.ascontiguousarray(columns[name], dtype=np.dtype(SECTION_TYPES[name]).newbyteorder('<'))
+        entries.append((position, columns[name].nbytes))
+        position = _align(position + columns[name].nbytes)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(catalog), len(catalog.genre_names), len(SECTIONS)))
+        for entry in entries:
+            file.write(SECTION_ENTRY.pack(*entry))
+        for name, (offset, _) in zip(SECTIONS, entries):
+            file.write(b'\0' * (offset - file.tell()))
+            file.write(columns[name].tobytes())
+    os.chmod(file.name, _file_mode(filename))
+    os.replace(file.name, filename)
+
+
+def load_binary_catalog(filename: str) -> Catalog:
+    """Return the catalog stored in filename, mapping the file into memory instead of reading it.
+    >>> path = os.path.join(tempfile.mkdtemp(), 'book_info.lcat')
+    >>> csv_to_binary('book_info.csv', path)
+    >>> catalog = load_binary_catalog(path)
+    >>> catalog.titles[17], catalog.authors[17], float(catalog.ratings[17]), catalog.genres_of(17)[:2]
+    ('Lessons in Chemistry', 'Bonnie Garmus', 4.32, ['Fiction', 'Historical Fiction'])
+    >>> from catalog import get_catalog
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> bool((catalog.combined_scores(votes) == get_catalog().combined_scores(votes)).all())
+    True
+    >>> catalog.genre_index().top_k(votes, 3).tolist()
+    [17, 40, 67]
+    """
+    with open(filename, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, book_count, genre_count, section_count = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise ValueError(f'{filename} is not a binary catalog')
+    if version != FORMAT_VERSION or section_count != len(SECTIONS):
+        raise ValueError(f'{filename} uses binary catalog format version {version}, '
+                         f'but only version {FORMAT_VERSION} is supported')
+
+    columns = {}
+    for i, name in enumerate(SECTIONS):
+        offset, length = SECTION_ENTRY.unpack_from(mapped, HEADER.size + i * SECTION_ENTRY.size)
+        dtype = np.dtype(SECTION_TYPES[name]).newbyteorder('<')
+        columns[name] = np.frombuffer(mapped, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+    catalog = Catalog(
+        StringTable(columns['title_offsets'], columns['title_data']),
+        InternedStrings(columns['author_ids'], StringTable(columns['author_offsets'], columns['author_data'])),
+        columns['ratings'],
+        columns['rating_counts'],
+        list(StringTable(columns['genre_offsets'], columns['genre_data'])),
+        columns['book_indptr'],
+        columns['book_genres'],
+        columns['rating_scores'],
+        columns['genre_indptr'],
+        columns['genre_books'],
+        {'genre_books': columns['index_genre_books'], 'genre_keys': columns['index_genre_keys'],
+         'all_books': columns['index_all_books'], 'all_keys': columns['index_all_keys']}
+    )
+    catalog.version = catalog_version(filename)
+    return catalog
+
+
+def csv_to_binary(csv_filename: str, binary_filename: str) -> None:
+    """Convert a csv catalog in the layout written by write_to_csv to a binary catalog.
+    Repeated genres within one row are stored once, since they do not change any score.
+    """
+    write_binary_catalog(Catalog.from_csv(csv_filename), binary_filename)
+
+
+def binary_to_csv(binary_filename: str, csv_filename: str) -> None:
+    """Convert a binary catalog to a csv catalog in the layout written by write_to_csv, replacing csv_filename.
+    >>> workspace = tempfile.mkdtemp()
+    >>> csv_to_binary('book_info.csv', os.path.join(workspace, 'book_info.lcat'))
+    >>> binary_to_csv(os.path.join(workspace, 'book_info.lcat'), os.path.join(workspace, 'book_info.csv'))
+    >>> def read_rows(filename):
+    ...     with open(filename, newline='', encoding='utf-8') as csvfile:
+    ...         return list(csv.reader(csvfile))
+    >>> read_rows(os.path.join(workspace, 'book_info.csv')) == read_rows('book_info.csv')
+    True
+    """
+    catalog = load_binary_catalog(binary_filename)
+    rows = [['Title', 'Author', 'Rating', 'Rating Count', 'Genres']]
+    rows.extend([catalog.titles[i], catalog.authors[i], float(catalog.ratings[i]), int(catalog.rating_counts[i]),
+                 catalog.genres_of(i)] for i in range(len(catalog)))
+    directory = os.path.dirname(os.path.abspath(csv_filename))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as file:
+        temporary = file.name
+    write_to_csv(rows, temporary)
+    os.chmod(temporary, _file_mode(csv_filename))
+    os.replace(temporary, csv_filename)
+
+
+def binary_snapshot(filename: str) -> str:
+    """Return the path of a binary catalog with the current contents of the catalog file filename: filename
+    itself if it is a binary catalog, or else a snapshot beside it named after the csv catalog's version, which
+    is written if it does not exist yet. Writing a snapshot removes the older snapshots of filename; processes
+    that have one mapped keep using it.
+    >>> import shutil
+    >>> from catalog_store import CatalogStore
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+    >>> _ = shutil.copy('book_info.csv', filename)
+    >>> first = binary_snapshot(filename)
+    >>> binary_snapshot(filename) == first, len(load_binary_catalog(first))
+    (True, 205)
+    >>> CatalogStore(filename).delete('Lessons in Chemistry', 'Bonnie Garmus')
+    >>> second = binary_snapshot(filename)
+    >>> second != first, os.path.exists(first), len(load_binary_catalog(second))
+    (True, False, 204)
+    """
+    if filename.endswith(BINARY_SUFFIX):
+        return filename
+    catalog = get_catalog(filename)
+    path = f"{filename}.{'-'.join(str(part) for part in catalog.version)}{BINARY_SUFFIX}"
+    if not os.path.exists(path):
+        write_binary_catalog(catalog, path)
+        for stale in glob.glob(glob.escape(filename) + '.*' + BINARY_SUFFIX):
+            if stale != path:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+    return path
+
+
+def _file_mode(filename: str) -> int:
+    # A file replaced through a temporary file keeps its own mode, instead of the temporary file's 0600.
+    try:
+        return os.stat(filename).st_mode & 0o777
+    except FileNotFoundError:
+        return 0o644
+
+
+def _encode_strings(strings: Sequence[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+def main():
+    csv_to_binary('book_info.csv', 'book_info' + BINARY_SUFFIX)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,116 @@
-"""This file contains the functions used to scrape publicly available data from various sites, in order
-to create Books, a custom class.
+"""This file contains Books, a custom class, and the functions used to score them and to read and write the csv
+catalog of books scraped from goodreads.com. The scraping itself is in scraper.
 """
-from typing import Dict, Callable
+from typing import Dict, Callable, Iterable, Union
 
-import bs4
-from bs4 import BeautifulSoup
-import requests
-import re
-from datetime import datetime
+import ast
+import heapq
 import csv
 import math
+import sys
 
+from telemetry import STAGE_SECONDS
 
-class Book:
+# The scraping functions moved to scraper, which imports bs4 and requests. They can still be imported from here:
+# scraper is imported the first time one of them is used, so that serving recommendations never imports it.
+SCRAPER_FUNCTIONS = frozenset({
+    'generate_popular_by_date_urls', 'get_book_links', 'book_links_from_soup', 'new_book', 'create_book_list',
+    'generate_recently_published_books', 'get_book_soup', 'get_book_title', 'get_title', 'get_author', 'get_genres',
+    'get_rating', 'get_rating_count', 'get_book_info', 'get_book_info_mass'})
+
+
+def __getattr__(name: str):
+    if name in SCRAPER_FUNCTIONS:
+        import scraper
+        return getattr(scraper, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+_genre_ids: dict[str, int] = {}
+
+
+def genre_id(genre: str) -> int:
+    """Return the process-wide id of genre, interning it on first use. Genre ids are small integers, so that a
+    set of genres can be held as an integer bitmask.
+    >>> genre_id('Fiction') == genre_id('Fiction')
+    True
     """
-    #TODO: Fix class introduction.
+    genre_id_ = _genre_ids.get(genre)
+    if genre_id_ is None:
+        genre_id_ = _genre_ids.setdefault(genre, len(_genre_ids))
+    return genre_id_
+
+
+class GenreWeights:
+    """A genre votes dictionary compiled for scoring many books against it.
+
+    Genres that no book has have no genre id and are left out of mask and weights, since they add nothing to any
+    score; they are not interned, so votes for unknown genres never grow the genre id table.
+
+    Instance Attributes:
+    - mask: the bitmask of the genre ids that received votes
+    - weights: maps the genre id of each genre that received votes to its number of votes
+    - vote_count: the total number of votes, including votes for genres no book has
+
+    >>> weights = GenreWeights({'Fiction': 2, 'No Such Genre': 3})
+    >>> weights.vote_count, len(weights.weights), 'No Such Genre' in _genre_ids
+    (5, 1, False)
+    """
+    __slots__ = ('mask', 'weights', 'vote_count')
+    mask: int
+    weights: dict[int, int]
+    vote_count: int
+
+    def __init__(self, genre_votes: dict[str, int]) -> None:
+        self.vote_count = sum(value for value in genre_votes.values())
+        self.weights = {}
+        self.mask = 0
+        for genre, votes in genre_votes.items():
+            genre_id_ = _genre_ids.get(genre)
+            if votes and genre_id_ is not None:
+                self.weights[genre_id_] = votes
+                self.mask |= 1 << genre_id_
+
+
+def compile_genre_votes(genre_votes: Union[dict[str, int], GenreWeights]) -> GenreWeights:
+    """Return genre_votes compiled for scoring. Compile the votes once per request and pass the result to
+    get_genre_score or get_combined_score for every book.
+    >>> weights = compile_genre_votes({'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1})
+    >>> weights.vote_count
+    10
+    >>> compile_genre_votes(weights) is weights
+    True
+    """
+    if isinstance(genre_votes, GenreWeights):
+        return genre_votes
+    return GenreWeights(genre_votes)
+
+
+class Book:
+    """A book, with the information used to score how well it suits a reading group.
+
+    Instance Attributes:
+    - title: the title of the book
+    - author: the name of the book's author
+    - rating: the book's average rating, out of 5
+    - rating_count: the number of ratings the book has
+    - genres: the genres of the book, as a tuple
+    - genre_mask: the bitmask of the genre ids of genres
+
+    Representation Invariants:
+    - self.genre_mask has exactly the bits genre_id(genre) for each genre in self.genres
+
+    genres is a tuple so that it cannot be changed in place, which would leave genre_mask out of date; any list
+    assigned to it is stored as a tuple.
+    >>> book = Book('Legendborn', 'Tracy Deonn', 4.18, 118424, ['Fantasy'])
+    >>> book.genres = book.genres + ('Young Adult',)
+    >>> book.genres, book.genre_mask == 1 << genre_id('Fantasy') | 1 << genre_id('Young Adult')
+    (('Fantasy', 'Young Adult'), True)
     """
+    __slots__ = ('title', 'author', '_rating', '_rating_count', '_rating_score', '_genres', 'genre_mask')
+    title: str
+    author: str
+    genre_mask: int
 
     def __init__(self, title, author, rating, rating_count, genres):
         self.title = title
@@ -24,18 +119,62 @@ class Book:
         self.rating_count = rating_count
         self.genres = genres
 
-    def get_genre_score(self, genre_votes):
+    @property
+    def rating(self) -> float:
+        return self._rating
+
+    @rating.setter
+    def rating(self, value: float) -> None:
+        self._rating = value
+        self._rating_score = None
+
+    @property
+    def rating_count(self) -> int:
+        return self._rating_count
+
+    @rating_count.setter
+    def rating_count(self, value: int) -> None:
+        self._rating_count = value
+        self._rating_score = None
+
+    @property
+    def genres(self) -> tuple[str, ...]:
+        return self._genres
+
+    @genres.setter
+    def genres(self, value: Iterable[str]) -> None:
+        self._genres = tuple(value)
+        mask = 0
+        for genre in self._genres:
+            mask |= 1 << genre_id(genre)
+        self.genre_mask = mask
+
+    def get_genre_score(self, genre_votes: Union[dict[str, int], GenreWeights]):
         """Gives the book a genre score and returns it, based on the genre votes dictionary.
         The genre score should be a number between 1 and 100
+        The votes may also be given already compiled by compile_genre_votes, which is much faster when
+        scoring many books.
         >>> books = create_books_from_csv()
         >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
         >>> books[17].get_genre_score(votes)
         90.0
+        >>> books[17].get_genre_score(compile_genre_votes(votes))
+        90.0
         """
+        if isinstance(genre_votes, GenreWeights):
+            matched = self.genre_mask & genre_votes.mask
+            score = 0
+            while matched:
+                lowest = matched & -matched
+                score += genre_votes.weights[lowest.bit_length() - 1]
+                matched ^= lowest
+            return 100 * score / genre_votes.vote_count
+
         vote_count = sum(value for value in genre_votes.values())
         score = 0
         for genre in genre_votes:
-            if genre in self.genres:
+            genre_id_ = _genre_ids.get(genre)
+            if genre_id_ is not None and self.genre_mask >> genre_id_ & 1:
                 score += genre_votes[genre]
         return 100 * score / vote_count
 
@@ -46,19 +185,36 @@ class Book:
         >>> book_list[17].get_rating_score()
         31.99999998434544
         """
-        advantage = self.rating - (1 / (math.exp(0.00003 * self.rating_count)) + 4)
-        max_advantage = 1
-        if advantage <= 0:
-            return 0.0
-        else:
-            return advantage * 100
-
-    def get_combined_score(self, genre_votes: dict[str, int]) -> float:
+        if self._rating_score is None:
+            self._rating_score = rating_score(self._rating, self._rating_count)
+        return self._rating_score
+
+    def get_combined_score(self, genre_votes: Union[dict[str, int], GenreWeights]) -> float:
         """Return the sum of the rating score and genre score
         """
         return self.get_genre_score(genre_votes) + self.get_rating_score()
 
 
+def rating_score(rating: float, rating_count: int) -> float:
+    """Return the adjusted rating score of a book with the given rating and rating count.
+    The rating score must be between 0 and 100.
+    >>> rating_score(4.5, 0)
+    0.0
+    >>> rating_score(4.44, 2418584)
+    44.00000000000004
+    >>> rating_score(4.44, 50_000_000)
+    44.00000000000004
+    """
+    exponent = 0.00003 * rating_count
+    # Past this point math.exp overflows, while 1 / math.exp(exponent) is already too small to change the sum.
+    decay = 1 / math.exp(exponent) if exponent < 700 else 0.0
+    advantage = rating - (decay + 4)
+    if advantage <= 0:
+        return 0.0
+    else:
+        return advantage * 100
+
+
 def genre_match(genre_votes: dict[str, int]) -> dict[str, float]:
     """ Based on the genre_votes dictionary i.e. the votes on which genres reading group members want to read,
     this function generates and returns a dictionary containing the percentage of members who like each genre.
@@ -81,7 +237,7 @@ def get_genre_scores(books: list[Book]) -> dict[Book, Callable[[dict[str, int]],
     return genre_scores
 
 
-def create_books_from_csv() -> list[Book]:
+def create_books_from_csv(filename: str = 'book_info.csv') -> list[Book]:
     """
     Return a list of book objectives from a csv file of books and their related information.
     >>> book_list = create_books_from_csv()
@@ -89,264 +245,74 @@ def create_books_from_csv() -> list[Book]:
     'Lessons in Chemistry'
     """
     books = []
-    with open('book_info.csv', 'r', newline='', encoding='utf-8') as csvfile:
+    with STAGE_SECONDS.time(stage='create_books_from_csv'), \
+            open(filename, 'r', newline='', encoding='utf-8') as csvfile:
         csv_reader = csv.reader(csvfile)
         next(csv_reader)
         for row in csv_reader:
-            title, author, rating, rating_count, genres = row[0], row[1], float(row[2]), int(row[3]), eval(row[4])
-            book = Book(title, author, rating, rating_count, genres)
-            books.append(book)
+            books.append(book_from_row(row))
 
     return books
 
 
-def sort_books_by_combined_score(book_list: list[Book], genre_votes: dict[str, int]) -> None:
+def book_from_row(row: list[str]) -> Book:
     """
-    Sort the books by their combined score using insertion sort, given the genre votes.
-    >>> books = create_books_from_csv()
-    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1, 'Thriller': 2}
-    >>> sort_books_by_combined_score(books, votes)
-    >>> all(books[i].get_combined_score(votes) <= books[i + 1].get_combined_score(votes) for i in range(0, len(books) - 2))
-    True
+    Return the book in a row of a csv file in the layout written by write_to_csv.
+    >>> book_from_row(['Legendborn', 'Tracy Deonn', '4.18', '118424', "['Fantasy', 'Young Adult']"]).genres
+    ('Fantasy', 'Young Adult')
     """
-    for i in range(1, len(book_list)):
-        current_book = book_list[i]
-        current_score = current_book.get_combined_score(genre_votes)
-
-        j = i - 1
-        while j >= 0 and current_score < book_list[j].get_combined_score(genre_votes):
-            book_list[j + 1] = book_list[j]
-            j -= 1
+    title, author, rating, rating_count = row[0], sys.intern(row[1]), float(row[2]), int(row[3])
+    return Book(title, author, rating, rating_count, parse_genres(row[4]))
 
-        book_list[j + 1] = current_book
 
-
-def generate_popular_by_date_urls() -> list[str]:
-    """ Collects all the "popular by date published"  urls from last year and all available from this year.
-    Returns a list of urls.
-    >>> recent = generate_popular_by_date_urls()
-    >>> len(recent)
-    2
+def parse_genres(text: str) -> list[str]:
     """
-    urls = []
-    current_date = datetime.now().date()
-    current_month = current_date.month
-    current_year = current_date.year
-
-    months = [i for i in range(current_month - 2, current_month)]
-
-    for month in months:
-        urls.append(f"https://www.goodreads.com/book/popular_by_date/{current_year}/{month}")
-
-    return urls
-
-
-def get_book_links(urls: list[str], book_links=None) -> list[str]:
-    """ Returns a list of book links based on the "popular by date published" urls.
-    >>> urls = ['https://www.goodreads.com/book/popular_by_date/2023/7','https://www.goodreads.com/book/popular_by_date/2023/6']
-    >>> len(get_book_links(urls))
-    30
+    Return the genres in the Genres column of a csv file in the layout written by write_to_csv, which is the
+    repr of a list of strings.
+    Most lists are split directly, which is much faster than evaluating them: repr only puts a genre in double
+    quotes or escapes characters in it when it contains a quote or a backslash.
+    >>> parse_genres("['Fiction', 'Science Fiction']")
+    ['Fiction', 'Science Fiction']
+    >>> parse_genres(repr(["Children's", 'Fantasy'])), parse_genres('[]')
+    (["Children's", 'Fantasy'], [])
     """
-    if book_links is None:
-        book_links = []
-    for url in urls:
-        soup = get_book_soup(url)
-        h3_elements = soup.find_all('h3', class_='Text Text__title3 Text__umber')
-        for h3 in h3_elements:
-            a_tags = h3.find_all('a', href=True)
-            for a_tag in a_tags:
-                link = a_tag['href']
-                book_links.append(link)
-
-    return book_links
+    if text.startswith("['") and text.endswith("']") and '"' not in text and '\\' not in text:
+        return [sys.intern(genre) for genre in text[2:-2].split("', '")]
+    return [sys.intern(genre) for genre in ast.literal_eval(text)]
 
 
-def new_book(book_link: str) -> Book:
-    """
-    This function should return a Book object containing the book title, author,
-    rating, number of ratings, and a list of relevant genres.
-    >>> SevenHusbands = new_book('https://www.goodreads.com/book/show/32620332-the-seven-husbands-of-evelyn-hugo')
-    >>> isinstance(SevenHusbands, Book)
-    True
-    >>> SevenHusbands.author
-    'Taylor Jenkins Reid'
-    >>> SevenHusbands.rating
-    4.44
-    """
-    soup = get_book_soup(book_link)
-    return Book(
-        get_title(soup),
-        get_author(soup),
-        get_rating(soup),
-        get_rating_count(soup),
-        get_genres(soup)
-    )
-
-
-def create_book_list(book_links: list[str]) -> list[Book]:
-    """Returns a list of all the books referred to by links in a list of book links
-    >>> book_links = ['https://www.goodreads.com/book/show/61884987-hello-stranger', 'https://www.goodreads.com/book/show/59651557-under-one-roof', 'https://www.goodreads.com/book/show/58293924-book-of-night', 'https://www.goodreads.com/book/show/59345253-something-wilder']
-    >>> book_list = create_book_list(book_links)
-    >>> len(book_list) == 4
-    True
-    >>> book_list[0].title
-    'Hello Stranger'
-    """
-    books = []
-    for book_link in book_links:
-        book = new_book(book_link)
-        if book.rating > 0.0:
-            books.append(book)
-
-    return books
-
-
-def generate_recently_published_books() -> list[Book]:
-    """Returns a list of books that were published this year or last year
-    >>> generate_recently_published_books()
-    'None Of This is True'
+def sort_books_by_combined_score(book_list: list[Book], genre_votes: dict[str, int]) -> None:
     """
-    urls = ['https://www.goodreads.com/book/popular_by_date/2023/8']  # generate_popular_by_date_urls()
-    book_links = get_book_links(urls)
-    return create_book_list(book_links)
-
-
-def get_book_soup(book_link: str) -> bs4.BeautifulSoup:
-    """Returns the given book link's 'soup', i.e. its html content.
-    >>> get_book_soup('https://www.goodreads.com/book/show/62022434-things-we-hide-from-the-light') is not None
-    True
-    >>> get_book_soup('https://www.goodreads.com/book/show/58065033-lessons-in-chemistry') is not None
-    True
-    >>> get_book_soup('https://www.goodreads.com/book/show/58733693-remarkably-bright-creatures') is not None
+    Sort the books in place by their combined score, given the genre votes.
+    Each book's combined score is computed once, and books with equal scores keep their relative order.
+    >>> books = create_books_from_csv()
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1, 'Thriller': 2}
+    >>> sort_books_by_combined_score(books, votes)
+    >>> all(books[i].get_combined_score(votes) <= books[i + 1].get_combined_score(votes) for i in range(0, len(books) - 2))
     True
     """
-    response = requests.get(book_link)
-    html_content = response.text
-    return BeautifulSoup(html_content, 'html.parser')
-
-
-def get_book_title(url) -> str:
-    """
-    Returns a book's title from its url
-    """
-    parts = url.split('/')
-    last_part_section = url.split('-')[1:]
-    title = ''
-    for part in last_part_section:
-        title += part.capitalize()
-        title += ''
-    return title
-
-
-def get_title(book_soup: bs4.BeautifulSoup) -> str:
-    """Returns the title of the book referred to by its book_soup.
-    >>> get_title(get_book_soup('https://www.goodreads.com/book/show/58733693-remarkably-bright-creatures'))
-    'Remarkably Bright Creatures'
-    >>> get_title(get_book_soup('https://www.goodreads.com/book/show/61169384-playing-hard-to-get'))
-    'Playing Hard to Get'
-    >>> get_title(get_book_soup('https://www.goodreads.com/book/show/60495147-nine-liars'))
-    'Nine Liars'
-    >>> get_title(get_book_soup('https://www.goodreads.com/book/show/60316881-the-headmaster-s-list'))
-    "The Headmaster's List"
-    >>> get_title(get_book_soup('https://www.goodreads.com/book/show/61398911-girl-forgotten'))
-    'Girl Forgotten'
-    """
-    # Find the div with class "BookPageTitleSection"
-    title_div = book_soup.find("div", class_="BookPageTitleSection")
-    if title_div is not None:
-        title = title_div.get_text()
-        if '#' not in title_div.get_text():
-            return title
-        else:
-            return title.split('#')[1][1:]
-    return 'Title Unavailable'
-
-
-def get_author(book_soup: bs4.BeautifulSoup) -> str:
-    """Returns the name of the author of a book using its link's soup.
-    >>> get_author(get_book_soup('https://www.goodreads.com/book/show/61884987-hello-stranger'))
-    'Katherine Center'
-    >>> get_author(get_book_soup('https://www.goodreads.com/book/show/58733693-remarkably-bright-creatures'))
-    'Shelby Van Pelt'
-    >>> get_author(get_book_soup('https://www.goodreads.com/book/show/59912428-mad-honey'))
-    'Jodi Picoult'
-    >>> get_author(get_book_soup('https://www.goodreads.com/book/show/32620332-the-seven-husbands-of-evelyn-hugo'))
-    'Taylor Jenkins Reid'
-    """
-    span_tag = book_soup.find('span', class_='ContributorLink__name', attrs={'data-testid': 'name'})
-    if span_tag is None:
-        return 'Author name not found.'
-    author_name = span_tag.get_text()
-    return author_name
-
-
-def get_genres(book_soup: bs4.BeautifulSoup) -> list[str]:
-    """Returns the genres of a book as given by its book link's soup.
-    Note that the following doctest may be particular to my computer window size.
-    >>> get_genres(get_book_soup("https://www.goodreads.com/book/show/61884987-hello-stranger"))
-    ['Romance', 'Fiction', 'Contemporary', 'Contemporary Romance', 'Chick Lit', 'Audiobook', 'Adult']
-    >>> get_genres(get_book_soup('https://www.goodreads.com/book/show/32620332-the-seven-husbands-of-evelyn-hugo'))
-    ['Fiction', 'Romance', 'Historical Fiction', 'LGBT', 'Contemporary', 'Audiobook', 'Adult']
-    """
-    genre_buttons = book_soup.find_all('span', class_='BookPageMetadataSection__genreButton')
-    genres = []
-    for genre in genre_buttons:
-        if genre is not None:
-            genres.append(genre.get_text())
-    return genres
-
-
-def get_rating(book_soup: bs4.BeautifulSoup) -> float:
-    """Returns the rating of a book using its link's soup.
-    >>> get_rating(get_book_soup('https://www.goodreads.com/book/show/61884987-hello-stranger'))
-    4.09
-    >>> get_rating(get_book_soup('https://www.goodreads.com/book/show/32620332-the-seven-husbands-of-evelyn-hugo'))
-    4.44
-    >>> get_rating(get_book_soup('https://www.goodreads.com/book/show/60435878-carrie-soto-is-back'))
-    4.23
-    >>> get_rating(get_book_soup('https://www.goodreads.com/book/show/62971668-someone-else-s-shoes'))
-    3.99
-    """
-    value = book_soup.find('div', class_="RatingStatistics__rating")
-    if value is None:
-        return 0.0
-    else:
-        return float(value.get_text())
-
-
-def get_rating_count(book_soup: bs4.BeautifulSoup) -> int:
-    """Returns the number of ratings given to a book using its link's soup.
-    >>> get_rating_count(get_book_soup('https://www.goodreads.com/book/show/61884987-hello-stranger'))
-    23926
-    >>> get_rating_count(get_book_soup('https://www.goodreads.com/book/show/32620332-the-seven-husbands-of-evelyn-hugo'))
-    2418584
-    """
-    rating_count_descriptor = book_soup.find('span', {'data-testid': 'ratingsCount'})
-    if rating_count_descriptor is None:
-        return 1
-    text = rating_count_descriptor.get_text().replace(',', '')
-    return int(re.search(r'\d+', text).group())
+    weights = compile_genre_votes(genre_votes)
+    scores = [book.get_combined_score(weights) for book in book_list]
+    order = sorted(range(len(book_list)), key=scores.__getitem__)
+    book_list[:] = [book_list[i] for i in order]
 
 
-def get_book_info(book_link: str) -> (str, float, int, int,):
+def top_k_books(book_list: list[Book], genre_votes: dict[str, int], k: int) -> list[Book]:
     """
-    This function should list containing the book title, the book rating, and the number of ratings,
-    plus a sublist of relevant genres.
-
-    >>> get_book_info("https://www.goodreads.com/book/show/61884987-hello-stranger")
-    ['Hello Stranger', 'Katherine Center', 4.08, 24236, ['Romance', 'Fiction', 'Contemporary', 'Contemporary Romance', 'Chick Lit', 'Audiobook', 'Adult']]
-    """
-    soup = get_book_soup(book_link)
-    return [get_title(soup), get_author(soup), get_rating(soup), get_rating_count(soup), get_genres(soup)]
-
-
-def get_book_info_mass(urls: list[str]) -> list[list]:
-    """ Return from a list of book links a list of lists in which each list contains a list of the book information for a different book.
+    Return the k books with the highest combined scores, highest first, given the genre votes.
+    Ties are broken in favour of the book that appears first in book_list.
+    >>> books = create_books_from_csv()
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> [book.title for book in top_k_books(books, votes, 3)]
+    ['Lessons in Chemistry', 'House of Sky and Breath', 'A Court of Silver Flames']
+    >>> tied = [Book('A', 'X', 4.5, 0, []), Book('B', 'Y', 4.5, 0, []), Book('C', 'Z', 4.5, 0, [])]
+    >>> [book.title for book in top_k_books(tied, votes, 2)]
+    ['A', 'B']
     """
-    book_list = []
-    for url in urls:
-        book_list.append(get_book_info(url))
-    return book_list
+    weights = compile_genre_votes(genre_votes)
+    scores = [book.get_combined_score(weights) for book in book_list]
+    top = heapq.nlargest(k, range(len(book_list)), key=scores.__getitem__)
+    return [book_list[i] for i in top]
 
 
 def write_to_csv(book_info_list, filename):
@@ -355,18 +321,15 @@ def write_to_csv(book_info_list, filename):
         csv_writer.writerows(book_info_list)  # Write book info
 
 
-def remove_invalid_entries() -> None:
+def remove_invalid_entries(filename: str = 'book_info.csv') -> None:
     """Remove entries from a csv file that start with 'Title Unavailable'
+    The entries are tombstoned in the catalog's change log, and the catalog is then compacted, which replaces the
+    file in one rename: readers never see it half written.
     """
-    with open('book_info.csv', 'r', newline='', encoding='utf-8') as csvfile:
-        rows = list(csv.reader(csvfile))
-
-    with open('book_info.csv', 'w', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.writer(csvfile)
-
-        for row in rows:
-            if row and not row[0].startswith('Title Unavailable'):
-                csv_writer.writerow(row)
+    from catalog_store import CatalogStore
+    store = CatalogStore(filename)
+    store.delete_many({(row[0], row[1]) for row in store.rows() if row[0].startswith('Title Unavailable')})
+    store.compact()
 
 
 def main():
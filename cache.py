@@ -0,0 +1,156 @@
+"""This file contains the cache that sits in front of the recommendation engines.
+
+Recommendations only depend on the catalog and on the genre votes, and many book clubs submit the same
+selections, so results are cached under a canonical form of the votes and dropped whenever the catalog changes.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def normalize_votes(genre_votes: dict[str, int]) -> tuple[tuple[str, int], ...]:
+    """Return a canonical, hashable form of genre_votes.
+
+    Genres with no votes are dropped and the genres are sorted. Whole-number votes are divided by their greatest
+    common divisor, since scaling every vote by the same amount leaves every genre score unchanged.
+    >>> normalize_votes({'Romance': 2, 'Fiction': 4, 'Horror': 0})
+    (('Fiction', 2), ('Romance', 1))
+    >>> normalize_votes({'Fiction': 1, 'Romance': 1}) == normalize_votes({'Romance': 3, 'Fiction': 3})
+    True
+    >>> normalize_votes({'Fiction': 1.5, 'Romance': 3})
+    (('Fiction', 1.5), ('Romance', 3))
+    """
+    votes = sorted((genre, value) for genre, value in genre_votes.items() if value)
+    if votes and all(isinstance(value, int) for _, value in votes):
+        divisor = math.gcd(*(value for _, value in votes))
+        votes = [(genre, value // divisor) for genre, value in votes]
+    return tuple(votes)
+
+
+# The values of RecommendationCache.stats() that processes add up; the size of the caches is added up too.
+COUNTED_STATS = ('hits', 'misses', 'evictions', 'invalidations', 'size')
+
+
+class RecommendationCache:
+    """A bounded, thread-safe, least-recently-used cache of recommendation results.
+
+    Entries optionally expire ttl seconds after they were computed. Every entry belongs to a catalog version,
+    and the whole cache is cleared the first time a different catalog version is seen.
+
+    Instance Attributes:
+    - maxsize: the maximum number of entries kept
+    - ttl: the number of seconds an entry stays valid, or None if entries never expire
+    - hits: the number of lookups answered from the cache
+    - misses: the number of lookups that had to compute their result
+    - evictions: the number of entries dropped to stay within maxsize
+    - invalidations: the number of times the cache was cleared because the catalog changed
+
+    >>> cache = RecommendationCache(maxsize=2)
+    >>> cache.get_or_compute('a', lambda: 1, version=1)
+    1
+    >>> cache.get_or_compute('a', lambda: 2, version=1)
+    1
+    >>> cache.get_or_compute('a', lambda: 3, version=2)
+    3
+    >>> cache.stats()
+    {'hits': 1, 'misses': 2, 'evictions': 0, 'invalidations': 1, 'size': 1, 'maxsize': 2}
+    """
+    maxsize: int
+    ttl: Optional[float]
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any], version: Hashable = None) -> Any:
+        """Return the cached result for key under the given catalog version, calling compute on a miss.
+        """
+        with self._lock:
+            if version != self._version:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or self._clock() - entry[0] < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        result = compute()
+
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = (self._clock(), result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return result
+
+    def clear(self) -> None:
+        """Remove every entry from the cache, keeping the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit, miss, eviction and invalidation counters and the current size of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class CacheCounts:
+    """Running totals of the changes in RecommendationCache.stats() reported by caches in other processes, such
+    as those of the recommendation service's worker processes, which can be exposed alongside a local cache.
+    >>> counts = CacheCounts()
+    >>> counts.add({'hits': 2, 'misses': 1, 'size': 1})
+    >>> counts.add({'hits': 1, 'evictions': 1})
+    >>> counts.stats()
+    {'hits': 3, 'misses': 1, 'evictions': 1, 'invalidations': 0, 'size': 1}
+    """
+
+    def __init__(self) -> None:
+        self._counts = {name: 0 for name in COUNTED_STATS}
+        self._lock = threading.Lock()
+
+    def add(self, changes: dict[str, int]) -> None:
+        """Add changes, a dictionary of changes in the values of COUNTED_STATS, to the totals.
+        """
+        with self._lock:
+            for name, change in changes.items():
+                if name in self._counts:
+                    self._counts[name] += change
+
+    def stats(self) -> dict[str, int]:
+        """Return the totals, keyed like RecommendationCache.stats().
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+def stats_changes(before: dict[str, int], after: dict[str, int]) -> dict[str, int]:
+    """Return the change in each of COUNTED_STATS between two RecommendationCache.stats() results.
+    >>> stats_changes({'hits': 1, 'misses': 2, 'evictions': 0, 'invalidations': 0, 'size': 2, 'maxsize': 8},
+    ...               {'hits': 1, 'misses': 3, 'evictions': 0, 'invalidations': 0, 'size': 3, 'maxsize': 8})
+    {'hits': 0, 'misses': 1, 'evictions': 0, 'invalidations': 0, 'size': 1}
+    """
+    return {name: after[name] - before[name] for name in COUNTED_STATS}
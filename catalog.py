@@ -0,0 +1,421 @@
+"""This file contains the in-memory, column-oriented catalog that the recommendation engines score against.
+
+The catalog is built once per process from book_info.csv. Ratings, rating counts and rating scores are held
+in arrays, and the book x genre incidence matrix is held in compressed sparse form, so that scoring every
+book against a set of genre votes is a handful of array operations instead of a Python loop per book.
+"""
+import os
+import sys
+import threading
+from typing import TYPE_CHECKING, Hashable, Iterator, Optional, Sequence
+
+import numpy as np
+
+from books import Book, compile_genre_votes, create_books_from_csv, parse_genres, rating_score
+from telemetry import STAGE_SECONDS
+
+if TYPE_CHECKING:
+    from genre_index import GenreIndex
+
+
+class Catalog:
+    """An immutable, column-oriented collection of books.
+
+    A Catalog can be used anywhere a list of books is expected: indexing and iterating it yields Book objects,
+    which are built once and reused.
+
+    Instance Attributes:
+    - titles: the title of each book
+    - authors: the author of each book
+    - ratings: the rating of each book
+    - rating_counts: the number of ratings of each book
+    - rating_scores: the precomputed get_rating_score of each book
+    - genre_names: the name of each genre id
+    - genre_ids: maps each genre name to its genre id
+    - book_indptr, book_genres: the incidence matrix by book; the genre ids of book i are
+      book_genres[book_indptr[i]:book_indptr[i + 1]]
+    - genre_indptr, genre_books: the incidence matrix by genre; the ids of the books in genre g are
+      genre_books[genre_indptr[g]:genre_indptr[g + 1]], in catalog order
+    - version: identifies the catalog file contents this catalog was loaded from, or None
+
+    Representation Invariants:
+    - len(self.titles) == len(self.authors) == len(self.ratings) == len(self.rating_counts)
+    - no book lists the same genre id twice
+    """
+    titles: Sequence[str]
+    authors: Sequence[str]
+    ratings: np.ndarray
+    rating_counts: np.ndarray
+    rating_scores: np.ndarray
+    genre_names: list[str]
+    genre_ids: dict[str, int]
+    book_indptr: np.ndarray
+    book_genres: np.ndarray
+    genre_indptr: np.ndarray
+    genre_books: np.ndarray
+    version: Hashable
+
+    def __init__(self, titles: Sequence[str], authors: Sequence[str], ratings: np.ndarray,
+                 rating_counts: np.ndarray, genre_names: list[str], book_indptr: np.ndarray,
+                 book_genres: np.ndarray, rating_scores: Optional[np.ndarray] = None,
+                 genre_indptr: Optional[np.ndarray] = None, genre_books: Optional[np.ndarray] = None,
+                 genre_index_arrays: Optional[dict[str, np.ndarray]] = None) -> None:
+        self.titles = titles
+        self.authors = authors
+        self.ratings = ratings
+        self.rating_counts = rating_counts
+        self.genre_names = genre_names
+        self.genre_ids = {name: genre_id for genre_id, name in enumerate(genre_names)}
+        self.book_indptr = book_indptr
+        self.book_genres = book_genres
+
+        if rating_scores is None:
+            rating_scores = np.array([rating_score(rating, count) for rating, count
+                                      in zip(ratings.tolist(), rating_counts.tolist())], dtype=np.float64)
+        self.rating_scores = rating_scores
+
+        if genre_indptr is None or genre_books is None:
+            # Transpose the incidence matrix. A stable sort keeps each genre's books in catalog order.
+            order = np.argsort(book_genres, kind='stable')
+            book_ids = np.repeat(np.arange(len(ratings), dtype=np.int32), np.diff(book_indptr))
+            genre_books = book_ids[order]
+            genre_indptr = np.zeros(len(genre_names) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(book_genres, minlength=len(genre_names)), out=genre_indptr[1:])
+        self.genre_indptr = genre_indptr
+        self.genre_books = genre_books
+
+        self.version = None
+        self._books = None
+        self._book_cache = {}
+        self._genre_index = None
+        self._genre_index_arrays = genre_index_arrays or {}
+
+    @classmethod
+    def from_books(cls, book_list: list[Book]) -> 'Catalog':
+        """Return a catalog containing the given books, in order.
+        >>> catalog = Catalog.from_books(create_books_from_csv())
+        >>> len(catalog)
+        205
+        >>> catalog.titles[17]
+        'Lessons in Chemistry'
+        """
+        genre_ids = {}
+        indptr = [0]
+        book_genres = []
+        for book in book_list:
+            seen = set()
+            for genre in book.genres:
+                genre_id = genre_ids.setdefault(genre, len(genre_ids))
+                if genre_id not in seen:
+                    seen.add(genre_id)
+                    book_genres.append(genre_id)
+            indptr.append(len(book_genres))
+
+        catalog = cls(
+            [book.title for book in book_list],
+            [book.author for book in book_list],
+            np.array([book.rating for book in book_list], dtype=np.float64),
+            np.array([book.rating_count for book in book_list], dtype=np.int64),
+            list(genre_ids),
+            np.array(indptr, dtype=np.int64),
+            np.array(book_genres, dtype=np.int32),
+            np.array([book.get_rating_score() for book in book_list], dtype=np.float64)
+        )
+        catalog._books = list(book_list)
+        return catalog
+
+    @classmethod
+    def from_rows(cls, rows: list[list[str]]) -> 'Catalog':
+        """Return a catalog of the books in the given rows of a csv file in the layout written by write_to_csv,
+        in order, without building a Book for each.
+        >>> catalog = Catalog.from_rows([['A', 'X', '4.5', '10', "['Fiction', 'Horror', 'Fiction']"],
+        ...                              ['B', 'Y', '3.9', '200', '[]']])
+        >>> catalog.genres_of(0), catalog[1].rating_count
+        (['Fiction', 'Horror'], 200)
+        """
+        genre_ids = {}
+        indptr = [0]
+        book_genres = []
+        for row in rows:
+            seen = set()
+            for genre in parse_genres(row[4]):
+                genre_id = genre_ids.setdefault(genre, len(genre_ids))
+                if genre_id not in seen:
+                    seen.add(genre_id)
+                    book_genres.append(genre_id)
+            indptr.append(len(book_genres))
+
+        return cls(
+            [row[0] for row in rows],
+            [sys.intern(row[1]) for row in rows],
+            np.array([float(row[2]) for row in rows], dtype=np.float64),
+            np.array([int(row[3]) for row in rows], dtype=np.int64),
+            list(genre_ids),
+            np.array(indptr, dtype=np.int64),
+            np.array(book_genres, dtype=np.int32)
+        )
+
+    @classmethod
+    def from_csv(cls, filename: str = 'book_info.csv') -> 'Catalog':
+        """Return a catalog of the books in a csv file in the layout written by write_to_csv.
+        """
+        return cls.from_books(create_books_from_csv(filename))
+
+    def __len__(self) -> int:
+        return len(self.ratings)
+
+    def __getitem__(self, index: int) -> Book:
+        if self._books is not None:
+            return self._books[index]
+        # Build only the requested book, so that formatting a few results does not build every Book.
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('catalog index out of range')
+        book = self._book_cache.get(index)
+        if book is None:
+            book = self._book_cache.setdefault(index, self._make_book(index))
+        return book
+
+    def __iter__(self) -> Iterator[Book]:
+        return iter(self.books())
+
+    def books(self) -> list[Book]:
+        """Return the books in this catalog as Book objects, building them on first use.
+        """
+        if self._books is None:
+            self._books = [self._book_cache.get(i) or self._make_book(i) for i in range(len(self))]
+            self._book_cache.clear()
+        return self._books
+
+    def genres_of(self, index: int) -> list[str]:
+        """Return the genres of the book at the given index.
+        >>> catalog = get_catalog()
+        >>> catalog.genres_of(17)[:3]
+        ['Fiction', 'Historical Fiction', 'Audiobook']
+        """
+        start, end = self.book_indptr[index], self.book_indptr[index + 1]
+        return [self.genre_names[genre_id] for genre_id in self.book_genres[start:end].tolist()]
+
+    def genre_scores(self, genre_votes: dict[str, int]) -> np.ndarray:
+        """Return the get_genre_score of every book in the catalog, in catalog order.
+        >>> catalog = get_catalog()
+        >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+        >>> float(catalog.genre_scores(votes)[17])
+        90.0
+        """
+        vote_count = sum(value for value in genre_votes.values())
+        totals = np.zeros(len(self), dtype=np.float64)
+        for genre, votes in genre_votes.items():
+            genre_id = self.genre_ids.get(genre)
+            if genre_id is not None and votes:
+                totals[self.genre_books[self.genre_indptr[genre_id]:self.genre_indptr[genre_id + 1]]] += votes
+        if vote_count == 0:
+            raise ZeroDivisionError('division by zero')
+        return 100 * totals / vote_count
+
+    def combined_scores(self, genre_votes: dict[str, int]) -> np.ndarray:
+        """Return the get_combined_score of every book in the catalog, in catalog order.
+        >>> catalog = get_catalog()
+        >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+        >>> scores = catalog.combined_scores(votes)
+        >>> all(scores[i] == book.get_combined_score(votes) for i, book in enumerate(create_books_from_csv()))
+        True
+        """
+        return self.genre_scores(genre_votes) + self.rating_scores
+
+    def top_k(self, genre_votes: dict[str, int], k: int) -> np.ndarray:
+        """Return the indices of the k books with the highest combined scores, highest first.
+        Ties are broken in favour of the book that appears first in the catalog.
+        >>> catalog = get_catalog()
+        >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+        >>> catalog.top_k(votes, 3).tolist()
+        [17, 40, 67]
+        """
+        return top_k_indices(self.combined_scores(genre_votes), k)
+
+    def genre_index(self) -> 'GenreIndex':
+        """Return the genre inverted index of this catalog, creating it on first use: from the sorted lists the
+        catalog was created with, if any, and otherwise by sorting.
+        """
+        if self._genre_index is None:
+            from genre_index import GenreIndex
+            with STAGE_SECONDS.time(stage='genre_index_build'):
+                self._genre_index = GenreIndex(self, **self._genre_index_arrays)
+        return self._genre_index
+
+    def batch_top_k(self, profiles: list[dict[str, int]], k: int, max_cells: int = 1 << 22) -> list[np.ndarray]:
+        """Return, for each genre votes profile, the indices of the k books with the highest combined scores,
+        highest first, exactly as top_k would.
+
+        All the profiles are scored in one pass over the catalog: a profiles x genres matrix of votes is
+        multiplied by the genres x books incidence matrix, one chunk of books at a time, with chunks small enough
+        that no intermediate matrix holds more than max_cells scores.
+        >>> import random
+        >>> generator = random.Random(0)
+        >>> genres = ['Fiction', 'Romance', 'Fantasy', 'Thriller', 'Horror', 'Nonfiction', 'Poetry']
+        >>> profiles = [{genre: generator.randint(0, 5) for genre in genres} for _ in range(50)]
+        >>> catalog = get_catalog()
+        >>> results = catalog.batch_top_k(profiles, 10, max_cells=1000)
+        >>> all((result == catalog.top_k(profile, 10)).all() for result, profile in zip(results, profiles))
+        True
+        """
+        genre_columns = {}
+        for profile in profiles:
+            for genre, votes in profile.items():
+                if votes and genre in self.genre_ids:
+                    genre_columns.setdefault(self.genre_ids[genre], len(genre_columns))
+        column_of = np.full(len(self.genre_names), -1, dtype=np.int64)
+        column_of[list(genre_columns)] = list(genre_columns.values())
+
+        weights = np.zeros((len(profiles), len(genre_columns)), dtype=np.float64)
+        vote_counts = np.zeros(len(profiles), dtype=np.float64)
+        for row, profile in enumerate(profiles):
+            vote_counts[row] = sum(value for value in profile.values())
+            for genre, votes in profile.items():
+                genre_id = self.genre_ids.get(genre)
+                if votes and genre_id is not None:
+                    weights[row, column_of[genre_id]] = votes
+        if not vote_counts.all():
+            raise ZeroDivisionError('division by zero')
+
+        best_books = [np.zeros(0, dtype=np.int64) for _ in profiles]
+        best_scores = [np.zeros(0, dtype=np.float64) for _ in profiles]
+        chunk_size = max(1, max_cells // max(1, len(profiles), len(genre_columns)))
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            incidence = np.zeros((end - start, len(genre_columns)), dtype=np.float64)
+            entries = slice(self.book_indptr[start], self.book_indptr[end])
+            rows = np.repeat(np.arange(end - start), np.diff(self.book_indptr[start:end + 1]))
+            columns = column_of[self.book_genres[entries]]
+            voted = columns >= 0
+            incidence[rows[voted], columns[voted]] = 1
+
+            scores = 100 * (weights @ incidence.T) / vote_counts[:, None] + self.rating_scores[start:end]
+            keep = min(k, end - start)
+            if keep <= 0:
+                continue
+            thresholds = np.partition(scores, end - start - keep, axis=1)[:, end - start - keep]
+            for row, threshold in enumerate(thresholds.tolist()):
+                candidates = np.flatnonzero(scores[row] >= threshold)
+                books = np.concatenate((best_books[row], candidates + start))
+                book_scores = np.concatenate((best_scores[row], scores[row, candidates]))
+                order = np.lexsort((books, -book_scores))[:k]
+                best_books[row] = books[order]
+                best_scores[row] = book_scores[order]
+        return best_books
+
+    def _make_book(self, index: int) -> Book:
+        return Book(self.titles[index], self.authors[index], float(self.ratings[index]),
+                    int(self.rating_counts[index]), self.genres_of(index))
+
+
+def combined_scores(book_list: Sequence[Book], genre_votes: dict[str, int]) -> list[float]:
+    """Return the get_combined_score of every book in book_list, scoring a Catalog all at once.
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> combined_scores(get_catalog(), votes) == combined_scores(create_books_from_csv(), votes)
+    True
+    """
+    if isinstance(book_list, Catalog):
+        return book_list.combined_scores(genre_votes).tolist()
+    weights = compile_genre_votes(genre_votes)
+    return [book.get_combined_score(weights) for book in book_list]
+
+
+TOP_K_BLOCK = 64
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the k highest scores, highest first, breaking ties by lowest index.
+    The selection is a linear-time partition followed by a sort of the candidates only.
+    >>> top_k_indices(np.array([1.0, 3.0, 2.0, 3.0, 0.0]), 3).tolist()
+    [1, 3, 2]
+    >>> top_k_indices(np.array([1.0, 2.0]), 5).tolist()
+    [1, 0]
+    >>> scores = np.random.default_rng(0).integers(0, 50, 100_000).astype(float)
+    >>> top_k_indices(scores, 10).tolist() == np.lexsort((np.arange(len(scores)), -scores))[:10].tolist()
+    True
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k >= n:
+        candidates = np.arange(n)
+    elif n >= 64 * TOP_K_BLOCK and k <= n // (4 * TOP_K_BLOCK):
+        # At least k blocks have a maximum at or above the k-th largest block maximum, so every one of the k
+        # highest scores is at or above it too. Filtering on it first leaves a small set to select from.
+        maxima = scores[:n - n % TOP_K_BLOCK].reshape(-1, TOP_K_BLOCK).max(axis=1)
+        if n % TOP_K_BLOCK:
+            maxima = np.append(maxima, scores[n - n % TOP_K_BLOCK:].max())
+        lower_bound = np.partition(maxima, len(maxima) - k)[len(maxima) - k]
+        candidates = np.flatnonzero(scores >= lower_bound)
+        if len(candidates) > k:
+            kth_largest = np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k]
+            candidates = candidates[scores[candidates] >= kth_largest]
+    else:
+        kth_largest = np.partition(scores, n - k)[n - k]
+        candidates = np.flatnonzero(scores >= kth_largest)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:k]]
+
+
+def catalog_version(filename: str) -> tuple[int, int, int]:
+    """Return a cheap fingerprint of a catalog file: its modification time in nanoseconds and its size, and the
+    size of its change log (see catalog_store), which only ever grows until the catalog is compacted.
+    """
+    stat = os.stat(filename)
+    try:
+        log_size = os.stat(filename + LOG_SUFFIX).st_size
+    except FileNotFoundError:
+        log_size = 0
+    return stat.st_mtime_ns, stat.st_size, log_size
+
+
+BINARY_SUFFIX = '.lcat'
+LOG_SUFFIX = '.log'
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def load_catalog(filename: str = 'book_info.csv') -> Catalog:
+    """Return a new catalog loaded from filename, which is either a csv file or, if its name ends in
+    BINARY_SUFFIX, a binary catalog. A csv catalog is loaded with its change log applied and its genre index
+    built; a binary catalog's genre index is stored in the file, and is used from there when first needed.
+    """
+    with STAGE_SECONDS.time(stage='catalog_load'):
+        if filename.endswith(BINARY_SUFFIX):
+            from binary_catalog import load_binary_catalog
+            return load_binary_catalog(filename)
+        from catalog_store import CatalogStore
+        catalog = CatalogStore(filename).snapshot()
+    catalog.genre_index()
+    return catalog
+
+
+def get_catalog(filename: str = 'book_info.csv') -> Catalog:
+    """Return the process-wide catalog for the given csv or binary catalog file, loading it on first use and
+    reloading it whenever the file changes.
+
+    Catalogs are never changed once loaded, so a reload swaps in a new one and callers still holding the old one
+    are unaffected. While one thread reloads, other callers keep getting the old catalog instead of waiting.
+    >>> get_catalog() is get_catalog()
+    True
+    >>> get_catalog().version == catalog_version('book_info.csv')
+    True
+    """
+    version = catalog_version(filename)
+    catalog = _catalogs.get(filename)
+    if catalog is not None and catalog.version == version:
+        return catalog
+    if not _catalogs_lock.acquire(blocking=catalog is None):
+        return catalog
+    try:
+        catalog = _catalogs.get(filename)
+        if catalog is None or catalog.version != catalog_version(filename):
+            catalog = load_catalog(filename)
+            _catalogs[filename] = catalog
+        return catalog
+    finally:
+        _catalogs_lock.release()
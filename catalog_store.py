@@ -0,0 +1,312 @@
+"""This file contains the catalog store, which lets book_info.csv change while the app is serving it, without a
+crash or a concurrent reader ever seeing a part-written catalog.
+
+The csv file is a snapshot that is never written in place. Changes are appended to a log beside it
+(book_info.csv.log), one JSON record per line: a put record adds a book or replaces the books with its title and
+author, and a tombstone removes them. A line cut short by a crash has no newline, and is ignored by readers and
+cut off by the next writer. Compaction writes the snapshot with the log applied to a temporary file, renames it
+over the snapshot and then empties the log. Applying the log again to a snapshot that already contains it gives
+the same catalog, so a crash between the rename and emptying the log loses nothing. Readers hold the log in
+memory, so a write that takes the log past a size limit compacts it straight away.
+
+Readers and writers take a shared or exclusive lock on the log, so a reader sees the snapshot and log from before
+or after a compaction, never one of each. Readers never modify anything: a catalog loaded from the store is an
+immutable snapshot, and a newer one is loaded alongside it when the store changes.
+"""
+import csv
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import IO, Callable, Iterable, Iterator, Optional
+
+from catalog import LOG_SUFFIX, Catalog, get_catalog
+from telemetry import REGISTRY
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock, only the threads of one process are kept apart.
+    fcntl = None
+
+RELOADS_TOTAL = REGISTRY.counter('litloom_catalog_reloads_total',
+                                 'Catalog reloads by the background reloader, by result.', ('result',))
+
+# The default size of the change log, in bytes, past which a write compacts it.
+MAX_LOG_BYTES = 16 * 2 ** 20
+
+_thread_lock = threading.RLock()
+
+
+class CatalogStore:
+    """A csv catalog snapshot and the append-only log of changes made to it since it was written.
+
+    Books are identified by their title and author. Every change is on disk by the time the method making it
+    returns.
+
+    Instance Attributes:
+    - filename: the csv snapshot, in the layout written by write_to_csv
+    - log_path: the change log
+    - sync: whether changes are flushed to the disk itself, not only to the operating system, before returning
+    - max_log_bytes: the size of the log past which a write compacts it, which bounds the memory readers hold
+      the log in, or None to only compact when compact() is called
+
+    >>> import shutil
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+    >>> _ = shutil.copy('book_info.csv', filename)
+    >>> store = CatalogStore(filename)
+    >>> store.put(['Piranesi', 'Susanna Clarke', 4.23, 312842, ['Fantasy', 'Fiction', 'Mystery']])
+    >>> store.delete('Lessons in Chemistry', 'Bonnie Garmus')
+    >>> catalog = store.snapshot()
+    >>> len(catalog), catalog.titles[-1], 'Lessons in Chemistry' in catalog.titles
+    (205, 'Piranesi', False)
+    >>> store.compact()
+    >>> os.path.getsize(store.log_path), [book.title for book in store.snapshot()] == list(catalog.titles)
+    (0, True)
+    """
+    filename: str
+    log_path: str
+    sync: bool
+    max_log_bytes: Optional[int]
+
+    def __init__(self, filename: str = 'book_info.csv', sync: bool = True,
+                 max_log_bytes: Optional[int] = MAX_LOG_BYTES) -> None:
+        self.filename = filename
+        self.log_path = filename + LOG_SUFFIX
+        self.sync = sync
+        self.max_log_bytes = max_log_bytes
+
+    def put(self, row: list) -> None:
+        """Add the book in row, which is in the layout written by write_to_csv, replacing any books with the same
+        title and author.
+        """
+        self.put_many([row])
+
+    def put_many(self, rows: Iterable[list]) -> None:
+        """Put every row in rows, in order, in one write.
+        >>> import shutil
+        >>> filename = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+        >>> _ = shutil.copy('book_info.csv', filename)
+        >>> store = CatalogStore(filename, max_log_bytes=1000)
+        >>> for number in range(20):
+        ...     store.put_many([[f'Book {number}', 'Ann Author', 4.0, 10, ['Fiction']]])
+        >>> os.path.getsize(store.log_path) < 1000, len(store.snapshot())
+        (True, 225)
+        """
+        self._append([{'put': [str(value) for value in row]} for row in rows])
+
+    def delete(self, title: str, author: str) -> None:
+        """Remove the books with the given title and author.
+        """
+        self.delete_many([(title, author)])
+
+    def delete_many(self, keys: Iterable[tuple[str, str]]) -> None:
+        """Remove the books with each (title, author) in keys, in one write.
+        """
+        self._append([{'delete': [title, author]} for title, author in keys])
+
+    def rows(self) -> Iterator[list[str]]:
+        """Yield the rows of the catalog, without the header: the snapshot's rows, in order, with each book put
+        replacing the rows with its title and author and each tombstone removing them, followed by the books put
+        that are not in the snapshot. Only the log is held in memory, not the snapshot, and the log is kept
+        below max_log_bytes.
+        """
+        csvfile, changes, _ = self._open()
+        with csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            yield from _apply(reader, changes)
+
+    def snapshot(self) -> Catalog:
+        """Return the catalog as it is now, whose version is the catalog_version of the store at the time.
+        """
+        csvfile, changes, version = self._open()
+        with csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            catalog = Catalog.from_rows(list(_apply(reader, changes)))
+        catalog.version = version
+        return catalog
+
+    def compact(self) -> None:
+        """Replace the snapshot with one that has the log applied, and empty the log.
+        """
+        with self._locked(shared=False) as log:
+            self._compact(log)
+
+    def _compact(self, log: IO[bytes]) -> None:
+        # The caller holds the exclusive lock on log.
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        changes = _read_changes(log)
+        with open(self.filename, 'r', newline='', encoding='utf-8') as csvfile, \
+                tempfile.NamedTemporaryFile('w', newline='', encoding='utf-8', dir=directory,
+                                            delete=False) as temporary:
+            reader = csv.reader(csvfile)
+            writer = csv.writer(temporary)
+            writer.writerow(next(reader, ['Title', 'Author', 'Rating', 'Rating Count', 'Genres']))
+            writer.writerows(_apply(reader, changes))
+            temporary.flush()
+            if self.sync:
+                os.fsync(temporary.fileno())
+        os.chmod(temporary.name, os.stat(self.filename).st_mode & 0o777)
+        os.replace(temporary.name, self.filename)
+        if self.sync:
+            _sync_directory(directory)
+        log.truncate(0)
+        if self.sync:
+            os.fsync(log.fileno())
+
+    def _append(self, records: list[dict]) -> None:
+        if not records:
+            return
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+        with self._locked(shared=False) as log:
+            # Cut off a record left part-written by a crash, so the new records start on a line of their own.
+            size = log.seek(0, os.SEEK_END)
+            if size:
+                log.seek(size - 1)
+                if log.read(1) != b'\n':
+                    log.seek(0)
+                    log.truncate(log.read().rfind(b'\n') + 1)
+            log.seek(0, os.SEEK_END)
+            log.write(data)
+            log.flush()
+            if self.sync:
+                os.fsync(log.fileno())
+            if self.max_log_bytes is not None and log.tell() > self.max_log_bytes:
+                self._compact(log)
+
+    def _open(self) -> tuple[IO[str], dict, tuple[int, int, int]]:
+        """Open the snapshot and read the log, consistently with each other, and return the open snapshot, the
+        changes in the log and the catalog_version they correspond to.
+        """
+        if not os.path.exists(self.log_path):
+            csvfile = open(self.filename, 'r', newline='', encoding='utf-8')
+            return csvfile, {}, _version(csvfile, 0)
+        with self._locked(shared=True) as log:
+            csvfile = open(self.filename, 'r', newline='', encoding='utf-8')
+            changes = _read_changes(log)
+            return csvfile, changes, _version(csvfile, os.fstat(log.fileno()).st_size)
+
+    @contextmanager
+    def _locked(self, shared: bool) -> Iterator[IO[bytes]]:
+        with open(self.log_path, 'a+b') as log:
+            if fcntl is None:
+                with _thread_lock:
+                    log.seek(0)
+                    yield log
+                return
+            fcntl.flock(log.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            log.seek(0)
+            yield log
+
+
+def _read_changes(log: IO[bytes]) -> dict[tuple[str, str], Optional[list[str]]]:
+    """Return the row each book in the log was last put with, or None if it was last deleted, by title and
+    author, in the order the books first appear in the log.
+    """
+    log.seek(0)
+    data = log.read()
+    end = data.rfind(b'\n') + 1
+    changes = {}
+    for line in data[:end].splitlines():
+        record = json.loads(line)
+        if 'put' in record:
+            changes[(record['put'][0], record['put'][1])] = record['put']
+        else:
+            changes[tuple(record['delete'])] = None
+    return changes
+
+
+def _apply(rows: Iterable[list[str]], changes: dict[tuple[str, str], Optional[list[str]]]) -> Iterator[list[str]]:
+    seen = set()
+    for row in rows:
+        if len(row) < 2:
+            continue
+        key = (row[0], row[1])
+        if key in changes:
+            seen.add(key)
+            row = changes[key]
+            if row is None:
+                continue
+        yield row
+    for key, row in changes.items():
+        if row is not None and key not in seen:
+            yield row
+
+
+def _version(csvfile: IO[str], log_size: int) -> tuple[int, int, int]:
+    stat = os.fstat(csvfile.fileno())
+    return stat.st_mtime_ns, stat.st_size, log_size
+
+
+def _sync_directory(directory: str) -> None:
+    # Makes a rename within the directory durable. Directories cannot be opened on Windows, where it is skipped.
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class CatalogReloader:
+    """A background thread that reloads the process-wide catalog for a file whenever the file changes, so that
+    requests find the new catalog already loaded instead of loading it themselves.
+
+    A reload swaps the new catalog in once it is fully loaded; requests already using the old one finish with
+    it. A catalog that fails to load is left for the next check, and the old one is kept in the meantime.
+
+    Instance Attributes:
+    - filename: the catalog file
+    - interval: the number of seconds between checks
+    - on_reload: called with no arguments after every reload, if given; a reload it fails is retried at the
+      next check
+    """
+    filename: str
+    interval: float
+    on_reload: Optional[Callable[[], None]]
+
+    def __init__(self, filename: str = 'book_info.csv', interval: float = 5.0,
+                 on_reload: Optional[Callable[[], None]] = None) -> None:
+        self.filename = filename
+        self.interval = interval
+        self.on_reload = on_reload
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='litloom-catalog-reloader', daemon=True)
+
+    def start(self) -> 'CatalogReloader':
+        """Start checking the catalog file, unless this reloader already has, and return this reloader.
+        """
+        with self._lock:
+            if self._thread.ident is None:
+                self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop checking the catalog file.
+        """
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        catalog = get_catalog(self.filename)
+        while not self._stopped.wait(self.interval):
+            try:
+                reloaded = get_catalog(self.filename)
+            except Exception:
+                RELOADS_TOTAL.inc(result='failed')
+                continue
+            if reloaded is not catalog:
+                try:
+                    if self.on_reload is not None:
+                        self.on_reload()
+                except Exception:
+                    RELOADS_TOTAL.inc(result='failed')
+                    continue
+                catalog = reloaded
+                RELOADS_TOTAL.inc(result='ok')
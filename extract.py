@@ -0,0 +1,174 @@
+"""This file contains the fast book page extractor, which pulls a book's title, author, rating, rating count and
+genres out of its goodreads page in a single streaming pass.
+
+It produces the same results as running get_title, get_author, get_rating, get_rating_count and get_genres from
+books.py on a BeautifulSoup tree of the page, without building the tree or searching it five times.
+"""
+import re
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import Iterable, Optional
+
+# Elements that never have an end tag, as treated by BeautifulSoup's html.parser builder.
+VOID_ELEMENTS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+                 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+                 'spacer', 'track', 'wbr'}
+# Elements whose text BeautifulSoup's get_text leaves out.
+HIDDEN_TEXT_ELEMENTS = {'script', 'style', 'template'}
+
+
+class BookPageExtractor(HTMLParser):
+    """An event-based parser that collects the text of the elements holding a book's information.
+
+    Feed it a page, in one piece or in chunks, then call close() and result().
+
+    Instance Attributes:
+    - texts: maps 'title', 'author', 'rating' and 'rating_count' to the text of the first matching element,
+      once that element has been read in full
+    - genres: the text of every genre button read so far
+    """
+    texts: dict[str, str]
+    genres: list[str]
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.texts = {}
+        self.genres = []
+        self._stack = []
+        self._open = []
+        self._hidden = 0
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> None:
+        field = self._match(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            return
+        self._stack.append(tag)
+        if tag in HIDDEN_TEXT_ELEMENTS:
+            self._hidden += 1
+        if field is not None:
+            self._open.append((field, len(self._stack), []))
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> None:
+        # A self-closing element has no text, but it still counts as found.
+        field = self._match(tag, attrs)
+        if field is not None:
+            self._finish(field, '')
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag not in self._stack:
+            return
+        while self._stack:
+            depth = len(self._stack)
+            open_tag = self._stack.pop()
+            if open_tag in HIDDEN_TEXT_ELEMENTS:
+                self._hidden -= 1
+            while self._open and self._open[-1][1] == depth:
+                field, _, parts = self._open.pop()
+                self._finish(field, ''.join(parts))
+            if open_tag == tag:
+                return
+
+    def handle_data(self, data: str) -> None:
+        if self._hidden:
+            return
+        for _, _, parts in self._open:
+            parts.append(data)
+
+    def close(self) -> None:
+        super().close()
+        # Elements left open at the end of the page end with it.
+        while self._open:
+            field, _, parts = self._open.pop()
+            self._finish(field, ''.join(parts))
+
+    def result(self) -> list:
+        """Return the title, author, rating, rating count and genres of the book, in the layout used by
+        scraper.get_book_info.
+        """
+        title = self.texts.get('title')
+        if title is None:
+            title = 'Title Unavailable'
+        elif '#' in title:
+            title = title.split('#')[1][1:]
+
+        author = self.texts.get('author', 'Author name not found.')
+
+        rating = self.texts.get('rating')
+        rating = 0.0 if rating is None else float(rating)
+
+        rating_count = self.texts.get('rating_count')
+        if rating_count is None:
+            rating_count = 1
+        else:
+            rating_count = int(re.search(r'\d+', rating_count.replace(',', '')).group())
+
+        return [title, author, rating, rating_count, list(self.genres)]
+
+    def _match(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> Optional[str]:
+        if tag not in ('div', 'span'):
+            return None
+        classes = ()
+        testid = None
+        for name, value in attrs:
+            if name == 'class' and value:
+                classes = value.split()
+            elif name == 'data-testid':
+                testid = value
+        if tag == 'div':
+            if 'BookPageTitleSection' in classes:
+                return self._first('title')
+            if 'RatingStatistics__rating' in classes:
+                return self._first('rating')
+        else:
+            if 'BookPageMetadataSection__genreButton' in classes:
+                return 'genre'
+            if testid == 'ratingsCount':
+                return self._first('rating_count')
+            if testid == 'name' and 'ContributorLink__name' in classes:
+                return self._first('author')
+        return None
+
+    def _first(self, field: str) -> Optional[str]:
+        if field in self.texts or any(open_field == field for open_field, _, _ in self._open):
+            return None
+        return field
+
+    def _finish(self, field: str, text: str) -> None:
+        if field == 'genre':
+            self.genres.append(text)
+        else:
+            self.texts[field] = text
+
+
+def extract_book_info(html: str) -> list:
+    """Return the title, author, rating, rating count and genres of the book whose goodreads page is html,
+    in the layout used by scraper.get_book_info.
+    >>> import glob
+    >>> from bs4 import BeautifulSoup
+    >>> from scraper import get_title, get_author, get_rating, get_rating_count, get_genres
+    >>> pages = [open(path, encoding='utf-8').read() for path in sorted(glob.glob('fixtures/goodreads/book/show/*.html'))]
+    >>> extract_book_info(pages[0])
+    ['Book of Night', 'Holly Black', 3.34, 61004, ['Fantasy', 'Urban Fantasy', 'Fiction', 'Adult', 'Audiobook', 'Magic', 'Fantasy']]
+    >>> soups = [BeautifulSoup(page, 'html.parser') for page in pages]
+    >>> expected = [[get_title(s), get_author(s), get_rating(s), get_rating_count(s), get_genres(s)] for s in soups]
+    >>> [extract_book_info(page) for page in pages] == expected
+    True
+    >>> extract_book_info(pages[5])
+    ['The Inline Scripts', 'Mara Quill', 3.87, 4512, ['Mystery', 'Thriller']]
+    >>> extract_book_info('<html><body><p>Not a book</p></body></html>')
+    ['Title Unavailable', 'Author name not found.', 0.0, 1, []]
+    """
+    extractor = BookPageExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.result()
+
+
+def extract_many(pages: Iterable[str], processes: Optional[int] = None, chunksize: int = 16) -> list[list]:
+    """Return extract_book_info of every page, in order. When processes is given, the pages are parsed in that
+    many worker processes.
+    """
+    if not processes:
+        return [extract_book_info(page) for page in pages]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(extract_book_info, pages, chunksize=chunksize))
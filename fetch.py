@@ -0,0 +1,172 @@
+"""This file contains the HTTP layer the scraper fetches pages through.
+
+Every request goes through one shared connection pool, is spaced out per host, and is retried with exponential
+backoff when it fails. Fetcher.map runs fetches concurrently while handing results back in input order.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# The most requests a fetcher starts per second to any one host, unless it is told otherwise. Only benchmarks and
+# tests against a local replay server should lift it.
+DEFAULT_REQUESTS_PER_SECOND = 2.0
+
+
+class HostRateLimiter:
+    """Spaces out the requests made to each host so that at most requests_per_second start per second.
+
+    Instance Attributes:
+    - requests_per_second: the maximum rate of requests to any one host, or None for no limit
+    """
+    requests_per_second: Optional[float]
+
+    def __init__(self, requests_per_second: Optional[float] = None) -> None:
+        self.requests_per_second = requests_per_second
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host: str) -> None:
+        """Block until a request to host may start.
+        """
+        if not self.requests_per_second:
+            return
+        interval = 1 / self.requests_per_second
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Fetcher:
+    """Fetches web pages over a shared connection pool, concurrently and politely.
+
+    Instance Attributes:
+    - concurrency: the number of requests that may be in flight at once
+    - retries: the number of times a failed request is retried
+    - backoff: the delay in seconds before the first retry; each further retry waits twice as long
+    - timeout: the number of seconds to wait for a server before giving up on a request
+    - rate_limiter: spaces out the requests made to each host, to DEFAULT_REQUESTS_PER_SECOND unless
+      requests_per_second is given; None lifts the limit
+
+    >>> from replay import ReplayServer
+    >>> pages = {f'/book/{i}': f'<p>{i}</p>' for i in range(20)}
+    >>> with ReplayServer(pages, latency=0.05) as server, Fetcher(10, requests_per_second=None) as fetcher:
+    ...     texts = list(fetcher.map(fetcher.get_text, [server.url(f'/book/{i}') for i in range(20)]))
+    >>> texts[:3]
+    ['<p>0</p>', '<p>1</p>', '<p>2</p>']
+    >>> texts == [pages[f'/book/{i}'] for i in range(20)]
+    True
+    """
+    concurrency: int
+    retries: int
+    backoff: float
+    timeout: float
+    rate_limiter: HostRateLimiter
+
+    def __init__(self, concurrency: int = 8, requests_per_second: Optional[float] = DEFAULT_REQUESTS_PER_SECOND,
+                 retries: int = 3, backoff: float = 0.5, timeout: float = 30.0) -> None:
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get(self, url: str, headers: Optional[dict[str, str]] = None) -> requests.Response:
+        """Return the response to a GET request for url, retrying on connection errors and on
+        429 and 5xx responses. The last response is returned even if it is an error.
+        """
+        host = urlsplit(url).netloc
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait(host)
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def get_text(self, url: str) -> str:
+        """Return the body of the page at url.
+        """
+        return self.get(url).text
+
+    def map(self, func: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        """Yield func(item) for each item, in order, running up to concurrency calls at once.
+
+        Results are yielded as soon as they and every earlier result are ready, and at most twice concurrency
+        items are taken from items ahead of the consumer.
+        """
+        executor = self._get_executor()
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * self.concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self) -> None:
+        """Release the worker threads and pooled connections.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        self.session.close()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fetch')
+            return self._executor
+
+    def __enter__(self) -> 'Fetcher':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+_fetcher: Optional[Fetcher] = None
+
+
+def get_fetcher() -> Fetcher:
+    """Return the process-wide fetcher, creating it with default settings on first use.
+    """
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = Fetcher()
+    return _fetcher
+
+
+def configure_fetcher(**settings) -> Fetcher:
+    """Replace the process-wide fetcher with one built from the given Fetcher settings and return it.
+    >>> configure_fetcher(concurrency=4, requests_per_second=2).concurrency
+    4
+    """
+    global _fetcher
+    if _fetcher is not None:
+        _fetcher.close()
+    _fetcher = Fetcher(**settings)
+    return _fetcher
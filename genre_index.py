@@ -0,0 +1,207 @@
+"""This file contains the genre inverted index, which finds the top-k books for a set of genre votes without
+scoring the whole catalog.
+
+A book's combined score is its rating score plus a bonus for each voted genre it has, so the best books for a
+query are found among the books with the highest rating scores in each voted genre, and among the books with the
+highest rating scores overall. The index keeps, for every genre, the books in it sorted by rating score, and
+reads the voted genres' lists from the top, down to a rating score threshold that is lowered every round, until
+no book it has not read can score high enough to enter the top k (the threshold algorithm). Only books with a
+voted genre are ever scored, so the work done depends on the size of the voted genres, not of the catalog.
+The time spent scoring books and the time spent choosing among them are recorded as the 'score' and 'select'
+stages.
+"""
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+from telemetry import STAGE_SECONDS
+
+if TYPE_CHECKING:
+    from catalog import Catalog
+
+# The depth of the list of all books that sets the first round's rating score threshold; every round at least
+# doubles it.
+FIRST_BLOCK = 32
+
+
+class GenreIndex:
+    """Per-genre lists of book ids sorted by rating score, highest first, for one catalog.
+
+    The lists are sorted when the index is created, unless they are given already sorted, as they are stored in
+    a binary catalog.
+
+    Instance Attributes:
+    - catalog: the catalog the index is for
+    - genre_books: the ids of the books in genre g are genre_books[catalog.genre_indptr[g]:
+      catalog.genre_indptr[g + 1]], sorted by decreasing rating score and then by id
+    - genre_keys: the negated rating score of each entry of genre_books, so that np.searchsorted can find
+      thresholds in lists sorted highest first
+    - all_books: the ids of every book, sorted by decreasing rating score and then by id
+    - all_keys: the negated rating score of each entry of all_books
+    """
+    catalog: 'Catalog'
+    genre_books: np.ndarray
+    genre_keys: np.ndarray
+    all_books: np.ndarray
+    all_keys: np.ndarray
+
+    def __init__(self, catalog: 'Catalog', genre_books: Optional[np.ndarray] = None,
+                 genre_keys: Optional[np.ndarray] = None, all_books: Optional[np.ndarray] = None,
+                 all_keys: Optional[np.ndarray] = None) -> None:
+        self.catalog = catalog
+        if genre_books is None or genre_keys is None or all_books is None or all_keys is None:
+            ratings = catalog.rating_scores
+            entry_genres = np.repeat(np.arange(len(catalog.genre_names)), np.diff(catalog.genre_indptr))
+            order = np.lexsort((catalog.genre_books, -ratings[catalog.genre_books], entry_genres))
+            genre_books = catalog.genre_books[order]
+            genre_keys = -ratings[genre_books]
+            all_books = np.lexsort((np.arange(len(catalog)), -ratings)).astype(np.int32)
+            all_keys = -ratings[all_books]
+        self.genre_books = genre_books
+        self.genre_keys = genre_keys
+        self.all_books = all_books
+        self.all_keys = all_keys
+        self._local = threading.local()
+
+    def top_k(self, genre_votes: dict[str, int], k: int) -> np.ndarray:
+        """Return the indices of the k books with the highest combined scores, highest first, with ties broken
+        in favour of the book that appears first in the catalog: exactly what Catalog.top_k returns.
+        >>> import random
+        >>> from catalog import get_catalog
+        >>> catalog = get_catalog()
+        >>> index = GenreIndex(catalog)
+        >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+        >>> index.top_k(votes, 3).tolist()
+        [17, 40, 67]
+        >>> generator = random.Random(0)
+        >>> genres = catalog.genre_names
+        >>> queries = [{genre: generator.randint(0, 5)
+        ...             for genre in generator.sample(genres, generator.randint(1, 6))} for _ in range(300)]
+        >>> queries = [query for query in queries if sum(query.values())]
+        >>> all(index.top_k(query, k).tolist() == catalog.top_k(query, k).tolist()
+        ...     for query in queries for k in (1, 10, 50))
+        True
+        """
+        scratch = self._scratch()
+        scratch.score_seconds = 0.0
+        start = time.perf_counter()
+        try:
+            return self._top_k(genre_votes, k)
+        finally:
+            STAGE_SECONDS.observe(scratch.score_seconds, stage='score')
+            STAGE_SECONDS.observe(time.perf_counter() - start - scratch.score_seconds, stage='select')
+
+    def _top_k(self, genre_votes: dict[str, int], k: int) -> np.ndarray:
+        catalog = self.catalog
+        n = len(catalog)
+        vote_count = sum(value for value in genre_votes.values())
+        if vote_count == 0:
+            raise ZeroDivisionError('division by zero')
+        if k <= 0 or n == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # The voted genres in the catalog, in the order their votes are added up by Catalog.genre_scores.
+        weights = []
+        starts = []
+        ends = []
+        for genre, votes in genre_votes.items():
+            genre_id = catalog.genre_ids.get(genre)
+            if genre_id is not None and votes:
+                weights.append(votes)
+                starts.append(int(catalog.genre_indptr[genre_id]))
+                ends.append(int(catalog.genre_indptr[genre_id + 1]))
+        if any(votes < 0 for votes in weights):
+            # Negative votes break the bound below, so such queries are scored in full.
+            return catalog.top_k(genre_votes, k)
+
+        # Books with none of the voted genres score their rating score, so only the k with the highest rating
+        # scores can make the top k.
+        head = self.all_books[:k]
+        outside = -float(self.all_keys[k]) if k < n else -np.inf
+        depth = max(FIRST_BLOCK, k)
+        while True:
+            # Read every entry with a rating score of at least threshold from each voted genre's list. A book
+            # read from one list has then been read from all of its voted genres' lists, so the votes added up
+            # from what was read are its exact genre score.
+            threshold = -float(self.all_keys[min(depth, n) - 1])
+            cuts = [start + int(np.searchsorted(self.genre_keys[start:end], -threshold, side='right'))
+                    for start, end in zip(starts, ends)]
+            lists = [self.genre_books[start:cut] for start, cut in zip(starts, cuts)]
+            best_books, best_scores = self._best(lists, weights, head, vote_count, k)
+
+            open_lists = [(-float(self.genre_keys[cut]), votes)
+                          for cut, end, votes in zip(cuts, ends, weights) if cut < end]
+            if not open_lists:
+                # Every book with a voted genre has been scored, and every other book is beaten by the head.
+                if len(best_books) < k or best_scores[-1] > outside:
+                    return best_books
+                # A book outside the head may tie with the k-th book, so the tie is settled in full.
+                return catalog.top_k(genre_votes, k)
+            if len(best_books) == k and best_scores[-1] > _bound(open_lists, outside, vote_count):
+                return best_books
+            # Read at least twice as deep, and past every entry tied with the current threshold.
+            depth = max(2 * depth, int(np.searchsorted(self.all_keys, -threshold, side='right')) + 1)
+
+    def _best(self, lists: list[np.ndarray], weights: list, head: np.ndarray, vote_count: float,
+              k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the k highest scoring of the books in lists and head, highest first and then by id, with their
+        combined scores, adding up the votes of the lists each book is in exactly as Catalog.genre_scores does.
+        """
+        catalog = self.catalog
+        scratch = self._scratch()
+        start = time.perf_counter()
+        # A book is in the list of every voted genre it has, and may be in the head too, but appears at most once in
+        # each, so each list's books can be marked seen with one assignment before the next list is checked.
+        seen = scratch.seen
+        unseen = []
+        for books_in_list in lists + [head]:
+            books_in_list = books_in_list[~seen[books_in_list]]
+            seen[books_in_list] = True
+            unseen.append(books_in_list)
+        books = np.concatenate(unseen)
+        seen[books] = False
+
+        totals = scratch.totals
+        totals[books] = 0.0
+        for books_in_genre, votes in zip(lists, weights):
+            totals[books_in_genre] += votes
+        scores = 100 * totals[books] / vote_count + catalog.rating_scores[books]
+        scratch.score_seconds += time.perf_counter() - start
+
+        if len(books) > k:
+            kth_largest = np.partition(scores, len(books) - k)[len(books) - k]
+            keep = scores >= kth_largest
+            books, scores = books[keep], scores[keep]
+        order = np.lexsort((books, -scores))[:k]
+        return books[order], scores[order]
+
+    def _scratch(self) -> threading.local:
+        # Per-thread work arrays of one entry per book, of which each query only touches the books it reads.
+        scratch = self._local
+        if not hasattr(scratch, 'totals'):
+            scratch.seen = np.zeros(len(self.catalog), dtype=bool)
+            scratch.totals = np.empty(len(self.catalog), dtype=np.float64)
+        return scratch
+
+
+def _bound(open_lists: list[tuple[float, int]], outside: float, vote_count: float) -> float:
+    """Return an upper bound on the combined score of every book that has not been read, given the rating score
+    and votes of the first unread entry of each voted genre list that has not been read to the end, and the
+    highest rating score of a book outside the head.
+
+    An unread book's rating score is at most outside, and at most the rating score of the first unread entry of
+    each of its voted genres' lists. Taking its voted genres to be the m genres with the highest such rating
+    scores gives the largest genre score for a rating score bounded by the m-th highest.
+    >>> _bound([(40.0, 1), (10.0, 3)], 50.0, 4)
+    110.0
+    >>> _bound([(40.0, 1), (10.0, 3)], 5.0, 4)
+    105.0
+    """
+    bound = outside
+    prefix = 0
+    for rating, votes in sorted(open_lists, reverse=True):
+        prefix += votes
+        bound = max(bound, 100 * prefix / vote_count + min(outside, rating))
+    return bound
@@ -0,0 +1,163 @@
+"""This file contains the background jobs that compute recommendations outside of the request that asked for them.
+
+Submitting a job returns its id straight away; a bounded pool of worker threads runs the jobs, and their results
+are kept in memory until they expire, for the page to pick up by polling or through server-sent events.
+"""
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the maximum number of jobs are already waiting or running."""
+
+
+class Job:
+    """One background computation and its outcome.
+
+    Instance Attributes:
+    - id: the job's identifier, safe to put in a url
+    - status: PENDING, RUNNING, DONE or FAILED
+    - result: the value the job returned, once it is DONE
+    - error: a description of the exception the job raised, once it has FAILED
+    - finished_at: the clock time the job finished at, or None if it has not
+
+    Representation Invariants:
+    - self.status in {PENDING, RUNNING, DONE, FAILED}
+    - (self.finished_at is None) == (self.status in {PENDING, RUNNING})
+    """
+    id: str
+    status: str
+    result: Any
+    error: Optional[str]
+    finished_at: Optional[float]
+
+    def __init__(self, job_id: str) -> None:
+        self.id = job_id
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self._finished = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the job has finished or timeout seconds have passed, and return whether it has finished.
+        """
+        return self._finished.wait(timeout)
+
+    def to_dict(self) -> dict:
+        """Return the job's id, status, result and error, for sending to the browser as json.
+        """
+        return {'id': self.id, 'status': self.status, 'result': self.result, 'error': self.error}
+
+
+class JobManager:
+    """A bounded pool of worker threads and the store of the jobs they run.
+
+    Finished jobs are kept for ttl seconds and then forgotten. Expired jobs are dropped whenever a job is
+    submitted or looked up, so the store never holds more than max_pending unfinished jobs plus the jobs that
+    finished within the last ttl seconds.
+
+    Instance Attributes:
+    - max_workers: the number of jobs run at the same time
+    - max_pending: the number of jobs that may be waiting or running at once
+    - ttl: the number of seconds a finished job's result is kept
+
+    >>> manager = JobManager(max_workers=1, max_pending=4, ttl=60)
+    >>> job_id = manager.submit(sum, [1, 2, 3])
+    >>> manager.get(job_id).wait(5)
+    True
+    >>> manager.get(job_id).to_dict() == {'id': job_id, 'status': 'done', 'result': 6, 'error': None}
+    True
+    >>> failed = manager.get(manager.submit(int, 'not a number'))
+    >>> failed.wait(5), failed.status
+    (True, 'failed')
+    >>> manager.get('unknown') is None
+    True
+    >>> manager.shutdown()
+    """
+    max_workers: int
+    max_pending: int
+    ttl: float
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 64, ttl: float = 600.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='litloom-job')
+        self._jobs = {}
+        self._finished = deque()
+        self._unfinished = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function: Callable, *args: Any) -> str:
+        """Schedule function(*args) to run in the background, and return the id of its job.
+        Raise JobQueueFull if max_pending jobs are already waiting or running.
+        >>> manager = JobManager(max_workers=1, max_pending=1)
+        >>> gate = threading.Event()
+        >>> _ = manager.submit(gate.wait)
+        >>> manager.submit(gate.wait)
+        Traceback (most recent call last):
+        ...
+        jobs.JobQueueFull: 1 jobs are already waiting or running
+        >>> gate.set()
+        >>> manager.shutdown()
+        """
+        with self._lock:
+            self._expire()
+            if self._unfinished >= self.max_pending:
+                raise JobQueueFull(f'{self._unfinished} jobs are already waiting or running')
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.id] = job
+            self._unfinished += 1
+        self._executor.submit(self._run, job, function, args)
+        return job.id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return the job with the given id, or None if there is none or its result has expired.
+        """
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of unfinished jobs and the number of jobs in the store.
+        """
+        with self._lock:
+            return {'unfinished': self._unfinished, 'stored': len(self._jobs)}
+
+    def shutdown(self) -> None:
+        """Wait for the running jobs to finish and stop the worker threads.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _run(self, job: Job, function: Callable, args: tuple) -> None:
+        job.status = RUNNING
+        try:
+            job.result = function(*args)
+            status = DONE
+        except Exception as error:
+            job.error = f'{type(error).__name__}: {error}'
+            status = FAILED
+        with self._lock:
+            job.finished_at = self._clock()
+            job.status = status
+            self._unfinished -= 1
+            self._finished.append(job)
+        job._finished.set()
+
+    def _expire(self) -> None:
+        # Jobs are appended to _finished as they finish, so the expired ones are at its front.
+        cutoff = self._clock() - self.ttl
+        while self._finished and self._finished[0].finished_at <= cutoff:
+            del self._jobs[self._finished.popleft().id]
@@ -2,50 +2,332 @@
 the optimal reading list for a book club.
 """
 
-from pulp import LpMaximize, LpProblem, LpVariable
-from books import Book, create_books_from_csv, sort_books_by_combined_score
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Hashable, Iterable, Optional, Sequence
 
+import numpy as np
+from books import Book, create_books_from_csv, top_k_books
+from cache import CacheCounts, RecommendationCache, normalize_votes
+from catalog import Catalog, combined_scores, get_catalog, top_k_indices
+from telemetry import REGISTRY, STAGE_SECONDS, cache_collector
 
-def get_recommendations_lpp(book_list: list[Book], genre_votes: dict[str, int], num_books=10) -> list[Book]:
+# PuLP is only imported once a model is built or a solver made, since ranking without constraints never needs it.
+if TYPE_CHECKING:
+    from pulp import LpProblem, LpSolver, LpVariable
+
+# A constraint adds rows to a model, given the model and the binary variable of each book.
+Constraint = Callable[['LpProblem', dict[Book, 'LpVariable']], None]
+
+
+def get_recommendations_lpp(book_list: list[Book], genre_votes: dict[str, int], num_books=10,
+                            constraints: Optional[list[Constraint]] = None,
+                            solver: Optional['LpSolver'] = None) -> list[Book]:
     """
     Solves a linear programming problem to return a list of reccomended books.
+
+    Each callable in constraints adds rows to the model, given the model and its book variables. Without any,
+    the model only asks for the num_books books with the largest total score, so it is solved exactly in-process
+    by selecting the num_books highest combined scores (ties going to the earlier book). PuLP is only used when
+    constraints are given or a solver is passed explicitly.
     >>> books = create_books_from_csv()
     >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
     >>> reccomendations_lpp = get_recommendations_lpp(books, votes)
     >>> lst = [reccomendations_lpp[i].title for i in range(0, 9)]
     >>> lst
     ['Lessons in Chemistry', 'Part of Your World', 'House of Sky and Breath', 'Reminders of Him', 'A Court of Silver Flames', 'Rule of Wolves', 'Chain of Iron', 'Better than the Movies', 'A Shadow in the Ember']
+    >>> from pulp import PULP_CBC_CMD
+    >>> get_recommendations_lpp(books, votes, solver=PULP_CBC_CMD(msg=False)) == reccomendations_lpp
+    True
+
+    Where several books tie for the last places, CBC may pick different ones, but the total score is the same.
+    >>> votes = {'Thriller': 5, 'Mystery': 2, 'Horror': 3}
+    >>> cbc = get_recommendations_lpp(books, votes, 25, solver=PULP_CBC_CMD(msg=False))
+    >>> fast = get_recommendations_lpp(books, votes, 25)
+    >>> round(sum(book.get_combined_score(votes) for book in cbc), 6) == round(sum(book.get_combined_score(votes) for book in fast), 6)
+    True
+    """
+    if not constraints and solver is None and isinstance(book_list, Catalog):
+        # The genre index only scores the books sharing a voted genre, and records its own stages.
+        selected = book_list.genre_index().top_k(genre_votes, num_books)
+        return [book_list[i] for i in sorted(selected.tolist())]
+    with STAGE_SECONDS.time(stage='score'):
+        scores = combined_scores(book_list, genre_votes)
+    if not constraints and solver is None:
+        with STAGE_SECONDS.time(stage='select'):
+            selected = top_k_indices(np.asarray(scores, dtype=np.float64), num_books)
+            return [book_list[i] for i in sorted(selected.tolist())]
+
+    if isinstance(book_list, Catalog):
+        model = get_recommendation_model(book_list, constraints)
+    else:
+        model = RecommendationModel(book_list, constraints)
+    return model.solve(genre_votes, num_books, solver=solver, scores=scores)
+
+
+def max_books_per_author(limit: int) -> Constraint:
+    """Return a constraint allowing at most limit books by any one author in the reading list.
+    >>> books = create_books_from_csv()
+    >>> votes = {'Fantasy': 3, 'Romance': 2}
+    >>> authors = [book.author for book in get_recommendations_sort(books, votes)]
+    >>> max(authors.count(author) for author in authors)
+    2
+    >>> authors = [book.author for book in get_recommendations_lpp(books, votes, constraints=[max_books_per_author(1)])]
+    >>> max(authors.count(author) for author in authors)
+    1
+    """
+    def constraint(model: 'LpProblem', book_vars: dict[Book, 'LpVariable']) -> None:
+        from pulp import lpSum
+        by_author = {}
+        for book, variable in book_vars.items():
+            by_author.setdefault(book.author, []).append(variable)
+        for i, variables in enumerate(by_author.values()):
+            if len(variables) > limit:
+                model += lpSum(variables) <= limit, f"Max_Per_Author_{i}"
+    return constraint
+
+
+def min_books_per_genre(genres: Iterable[str], minimum: int = 1) -> Constraint:
+    """Return a constraint requiring at least minimum books of each of the given genres in the reading list.
+    Genres with fewer than minimum books in the catalog are left out, since no reading list could cover them.
+    >>> books = create_books_from_csv()
+    >>> votes = {'Fantasy': 5, 'Memoir': 1}
+    >>> any('Memoir' in book.genres for book in get_recommendations_sort(books, votes))
+    False
+    >>> covered = get_recommendations_lpp(books, votes, constraints=[min_books_per_genre(votes, 2)])
+    >>> sum('Memoir' in book.genres for book in covered)
+    2
     """
-    model = LpProblem("Best_Books_Selection", LpMaximize)
-    book_vars = LpVariable.dicts("Book", book_list, cat="Binary")
+    genres = list(genres)
+
+    def constraint(model: 'LpProblem', book_vars: dict[Book, 'LpVariable']) -> None:
+        from pulp import lpSum
+        by_genre = {genre: [] for genre in genres}
+        for book, variable in book_vars.items():
+            for genre in set(book.genres):
+                if genre in by_genre:
+                    by_genre[genre].append(variable)
+        for i, variables in enumerate(by_genre.values()):
+            if len(variables) >= minimum:
+                model += lpSum(variables) >= minimum, f"Min_Per_Genre_{i}"
+    return constraint
 
-    total_score = sum(book.get_combined_score(genre_votes) * book_vars[book] for book in book_list)
-    model += total_score, "Total_Score_Objective"
-    model += sum(book_vars[book] for book in book_list) == num_books, "Select_Num_Books"
 
-    books_with_high_ratings = [book for book in book_list if book.rating > 4]
-    warm_start_books = books_with_high_ratings[:num_books]
-    for book in warm_start_books:
-        book_vars[book].setInitialValue(1)
+def max_total_cost(costs: Callable[[Book], float], budget: float) -> Constraint:
+    """Return a constraint keeping the total cost of the reading list within budget, where costs gives the cost
+    of each book: its page count, its price, or anything else the caller knows about it.
+    >>> books = create_books_from_csv()
+    >>> votes = {'Fiction': 4, 'Romance': 3}
+    >>> def length(book: Book) -> float:
+    ...     return len(book.title)
+    >>> sum(length(book) for book in get_recommendations_lpp(books, votes))
+    181
+    >>> within_budget = get_recommendations_lpp(books, votes, constraints=[max_total_cost(length, 150)])
+    >>> sum(length(book) for book in within_budget) <= 150
+    True
+    """
+    def constraint(model: 'LpProblem', book_vars: dict[Book, 'LpVariable']) -> None:
+        from pulp import LpAffineExpression
+        model += LpAffineExpression((variable, costs(book)) for book, variable in book_vars.items()) <= budget, \
+            "Max_Total_Cost"
+    return constraint
 
-    model.solve()
 
-    selected_books = [book for book in book_list if book_vars[book].value() == 1]
-    return selected_books
+def make_solver(time_limit: Optional[float] = None, gap_rel: Optional[float] = None,
+                backend: str = 'cbc') -> 'LpSolver':
+    """Return the solver used for constrained reading lists: with backend 'cbc', CBC started from a previous
+    solution, or with backend 'highs', HiGHS, which runs in-process through highspy. time_limit is in seconds;
+    gap_rel is the relative optimality gap at which the solver may stop with a good, but possibly not optimal,
+    reading list.
+
+    CBC is the default: HiGHS saves starting a process and writing the model to a file, but takes longer to
+    solve these models than warm-started CBC does, increasingly so for larger catalogs.
+    >>> type(make_solver(time_limit=1.0)).__name__, type(make_solver(backend='highs')).__name__
+    ('PULP_CBC_CMD', 'HiGHS')
+    >>> books = create_books_from_csv()
+    >>> model = RecommendationModel(books, [max_books_per_author(1)])
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> model.solve(votes, solver=make_solver(backend='highs')) == model.solve(votes, solver=make_solver())
+    True
+    """
+    from pulp import HiGHS, PULP_CBC_CMD
+
+    if backend == 'cbc':
+        return PULP_CBC_CMD(msg=False, timeLimit=time_limit, gapRel=gap_rel, warmStart=True)
+    if backend == 'highs':
+        return HiGHS(msg=False, timeLimit=time_limit, gapRel=gap_rel)
+    raise ValueError(f"backend must be 'cbc' or 'highs', not {backend!r}")
+
+
+class RecommendationModel:
+    """A book selection model built once for a list of books and a set of constraints, then solved again for
+    every request by replacing only its objective and the number of books it selects.
+
+    Each solve starts from the reading list the previous solve chose, or from the highest scoring books the
+    first time, for solvers that accept a starting solution.
+
+    Instance Attributes:
+    - book_list: the books the model selects from
+    - version: the version of the catalog the model was built for, or None if it was built for a list
+    - problem: the PuLP problem
+    - book_vars: the binary variable of each book, which is 1 if the book is selected
+
+    >>> books = create_books_from_csv()
+    >>> model = RecommendationModel(books, [max_books_per_author(1)])
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> model.solve(votes) == get_recommendations_lpp(books, votes, constraints=[max_books_per_author(1)])
+    True
+    >>> len(model.solve({'Thriller': 1}, num_books=5))
+    5
+    """
+    book_list: Sequence[Book]
+    version: Optional[Hashable]
+    problem: 'LpProblem'
+    book_vars: dict[Book, 'LpVariable']
+
+    def __init__(self, book_list: Sequence[Book], constraints: Optional[list[Constraint]] = None) -> None:
+        from pulp import LpMaximize, LpProblem, LpVariable, lpSum
+        with STAGE_SECONDS.time(stage='model_build'):
+            self.book_list = book_list
+            self.version = book_list.version if isinstance(book_list, Catalog) else None
+            self.problem = LpProblem("Best_Books_Selection", LpMaximize)
+            self.book_vars = {book: LpVariable(f"Book_{i}", cat="Binary") for i, book in enumerate(book_list)}
+            self._variables = list(self.book_vars.values())
+            self.problem += lpSum(self._variables) == 0, "Select_Num_Books"
+            for constraint in constraints or []:
+                constraint(self.problem, self.book_vars)
+            self._base_constraints = set(self.problem.constraints)
+            self._previous = None
+            self._lock = threading.Lock()
+
+    def solve(self, genre_votes: dict[str, int], num_books: int = 10,
+              constraints: Optional[list[Constraint]] = None, solver: Optional['LpSolver'] = None,
+              scores: Optional[Sequence[float]] = None) -> list[Book]:
+        """Return the num_books books with the largest total combined score that satisfy the model's constraints
+        and the given extra constraints, in the order of book_list. The extra constraints only apply to this solve.
+        scores may pass in the books' combined scores if they are already known.
+        Raise ValueError if no reading list satisfies the constraints.
+        """
+        from pulp import LpAffineExpression, LpSolutionIntegerFeasible, LpSolutionOptimal
+        if scores is None:
+            scores = combined_scores(self.book_list, genre_votes)
+        with self._lock:
+            with STAGE_SECONDS.time(stage='model_update'):
+                self.problem.setObjective(LpAffineExpression(zip(self._variables, scores)))
+                self.problem.constraints["Select_Num_Books"].constant = -num_books
+                for constraint in constraints or []:
+                    constraint(self.problem, self.book_vars)
+                if self._previous is None:
+                    self._previous = set(top_k_indices(np.asarray(scores, dtype=np.float64), num_books).tolist())
+                for i, variable in enumerate(self._variables):
+                    variable.setInitialValue(1 if i in self._previous else 0)
+
+            with STAGE_SECONDS.time(stage='solve'):
+                try:
+                    self.problem.solve(solver or make_solver())
+                finally:
+                    for name in set(self.problem.constraints) - self._base_constraints:
+                        del self.problem.constraints[name]
+            if self.problem.sol_status not in (LpSolutionOptimal, LpSolutionIntegerFeasible):
+                raise ValueError('no reading list satisfies the constraints')
+
+            selected = [i for i, variable in enumerate(self._variables) if variable.value() > 0.5]
+            self._previous = set(selected)
+        return [self.book_list[i] for i in selected]
+
+
+_models = OrderedDict()
+_models_lock = threading.Lock()
+MAX_MODELS = 8
+
+
+def get_recommendation_model(catalog: Catalog, constraints: Optional[list[Constraint]] = None) -> RecommendationModel:
+    """Return the model for the catalog with the given constraints, building it on first use and again whenever
+    the catalog's version changes. Models are looked up by the identity of the constraint callables, so callers
+    reusing a model should build their constraints once and pass the same ones every time.
+    >>> constraints = [max_books_per_author(2)]
+    >>> get_recommendation_model(get_catalog(), constraints) is get_recommendation_model(get_catalog(), constraints)
+    True
+    """
+    key = (id(catalog), tuple(constraints or ()))
+    with _models_lock:
+        model = _models.get(key)
+        if model is None or model.book_list is not catalog or model.version != catalog.version:
+            model = RecommendationModel(catalog, constraints)
+            _models[key] = model
+        _models.move_to_end(key)
+        while len(_models) > MAX_MODELS:
+            _models.popitem(last=False)
+    return model
 
 
 def get_recommendations_sort(book_list: list[Book], genre_votes: dict[str, int], num_books=10) -> list[Book]:
     """
-    Sorts book options to return a list of reccomended books
+    Ranks book options to return a list of reccomended books, highest combined score first
     >>> books = create_books_from_csv()
     >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
     >>> reccomendations = get_recommendations_sort(books, votes)
     >>> titles = [reccomendations[i].title for i in range(0, len(reccomendations))]
     >>> titles
-    ['The Spanish Love Deception', 'Lessons in Chemistry', 'House of Sky and Breath', 'A Court of Silver Flames', 'A Shadow in the Ember', 'Reminders of Him', 'Rule of Wolves', 'Legendborn', 'Part of Your World', 'Chain of Iron']
+    ['Lessons in Chemistry', 'House of Sky and Breath', 'A Court of Silver Flames', 'A Shadow in the Ember', 'Reminders of Him', 'Rule of Wolves', 'Legendborn', 'Part of Your World', 'Chain of Iron', 'Better than the Movies']
+    >>> [book.title for book in get_recommendations_sort(get_catalog(), votes)] == titles
+    True
     """
-    sort_books_by_combined_score(book_list, genre_votes)
-    return [book_list[-i] for i in range(0, num_books)]
+    if isinstance(book_list, Catalog):
+        return [book_list[i] for i in book_list.genre_index().top_k(genre_votes, num_books).tolist()]
+    return top_k_books(book_list, genre_votes, num_books)
+
+
+def get_recommendations_batch(catalog: Catalog, profiles: list[dict[str, int]], num_books=10,
+                              ranking: str = 'lpp') -> list[list[Book]]:
+    """
+    Returns the recommended books for every genre votes profile, scoring the whole catalog against all the
+    profiles in one vectorized pass. With ranking 'lpp', each list holds the same books as get_recommendations_lpp
+    would return, in catalog order; with ranking 'sort', the same books as get_recommendations_sort, highest
+    combined score first.
+    >>> catalog = get_catalog()
+    >>> profiles = [{'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}, {'Romance': 1, 'Feminism': 1}]
+    >>> batch = get_recommendations_batch(catalog, profiles)
+    >>> batch == [get_recommendations_lpp(catalog, profile) for profile in profiles]
+    True
+    >>> batch = get_recommendations_batch(catalog, profiles, 5, ranking='sort')
+    >>> batch == [get_recommendations_sort(catalog, profile, 5) for profile in profiles]
+    True
+    """
+    if ranking not in ('lpp', 'sort'):
+        raise ValueError(f"ranking must be 'lpp' or 'sort', not {ranking!r}")
+    recommendations = []
+    for selected in catalog.batch_top_k(profiles, num_books):
+        indices = selected.tolist()
+        if ranking == 'lpp':
+            indices.sort()
+        recommendations.append([catalog[i] for i in indices])
+    return recommendations
+
+
+recommendation_cache = RecommendationCache(maxsize=1024)
+# The changes in the recommendation caches of the service's worker processes, sent back with their results.
+worker_cache_counts = CacheCounts()
+REGISTRY.register_collector(cache_collector('litloom_recommendation_cache', recommendation_cache,
+                                            worker_cache_counts))
+
+
+def get_cached_recommendations(catalog: Catalog, genre_votes: dict[str, int], num_books=10,
+                               engine: Callable[..., list[Book]] = get_recommendations_lpp) -> list[Book]:
+    """Return engine's recommendations from the catalog, reusing the result of any earlier request with
+    equivalent genre votes. Cached results are dropped as soon as the catalog's version changes.
+    >>> catalog = get_catalog()
+    >>> hits = recommendation_cache.hits
+    >>> first = get_cached_recommendations(catalog, {'Romance': 1, 'Feminism': 1})
+    >>> get_cached_recommendations(catalog, {'Feminism': 3, 'Romance': 3, 'Horror': 0}) == first
+    True
+    >>> recommendation_cache.hits - hits
+    1
+    """
+    key = (engine.__name__, num_books, normalize_votes(genre_votes))
+    recommendations = recommendation_cache.get_or_compute(
+        key, lambda: tuple(engine(catalog, genre_votes, num_books)), version=catalog.version)
+    return list(recommendations)
 
 
 def get_recommendations(selected_genres: list[str]) -> list[str]:
@@ -53,13 +335,18 @@ def get_recommendations(selected_genres: list[str]) -> list[str]:
     >>> get_recommendations(['Romance', 'Feminism'])
     ["'Lessons in Chemistry' by Bonnie Garmus", "'Part of Your World' by Abby Jimenez", "'House of Sky and Breath' by Sarah J. Maas", "'Reminders of Him' by Colleen Hoover", "'Heartstopper: Volume Four' by Alice Oseman", "'A Court of Silver Flames' by Sarah J. Maas", "'Rule of Wolves' by Leigh Bardugo", "'Chain of Iron' by Cassandra Clare", "'A Shadow in the Ember' by Jennifer L. Armentrout"]
     """
-    books = create_books_from_csv()
+    books = get_catalog()
     genres_dict = {selected_genre: 1 for selected_genre in selected_genres}
-    recommendations = get_recommendations_lpp(books, genres_dict)
+    recommendations = get_cached_recommendations(books, genres_dict)
+    return format_recommendations(recommendations)
+
+
+def format_recommendations(recommendations: list[Book]) -> list[str]:
+    """Return the first nine recommended books as they are shown on the results page.
+    """
     refined = [f"'{recommendations[i].title}' by {recommendations[i].author}" for i in range(0, 9)]
     return refined
 
 
 # TODO: Get metrics for improvement by switching to LPP.
-# TODO: Create user system for submitting genre votes.
 # TODO: Create UI for the application.
@@ -1,16 +1,48 @@
 """This file is for testing the performance of the recommendation algorithm(s)
+
+Run `python metrics.py run` to benchmark the recommendation engines on synthetic catalogs,
+`python metrics.py compare OLD.json NEW.json` to flag regressions between two saved runs,
+`python metrics.py scrape` to measure scraping throughput against recorded pages,
+`python metrics.py crawl` to check that a crawl's memory does not grow with the number of months crawled and
+`python metrics.py startup` to check how quickly a freshly started server answers.
 """
+import argparse
+import glob
+import json
+import os
+import platform
 import random
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from lpp import get_recommendations_lpp, get_recommendations_sort
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence
+
+import numpy as np
+from bs4 import BeautifulSoup
+from pulp import PULP_CBC_CMD
+from lpp import (RecommendationModel, get_recommendation_model, get_recommendations_lpp, get_recommendations_sort,
+                 make_solver, max_books_per_author, min_books_per_genre)
 from books import Book, create_books_from_csv
+from binary_catalog import load_binary_catalog, write_binary_catalog
+from catalog import Catalog, top_k_indices
+from extract import extract_book_info
+from scraper import get_author, get_genres, get_rating, get_rating_count, get_title
+from telemetry import STAGE_SECONDS
+from votes import VoteStore
 
 
-def generate_random_genre_votes(count=100) -> list[dict[str, int]]:
+def generate_random_genre_votes(count=100, seed: Optional[int] = None) -> list[dict[str, int]]:
     """
     Generates random genre vote dictionaries.
-    >>> generate_random_genre_votes()
+    >>> votes = generate_random_genre_votes(3, seed=0)
+    >>> len(votes), len(votes[0]), all(0 <= value <= 10 for value in votes[0].values())
+    (3, 34, True)
     """
+    generator = random.Random(seed)
     dictionaries = []
     genres = [
         'Romance', 'Fiction', 'Contemporary', 'Contemporary Romance', 'Audiobook',
@@ -24,7 +56,7 @@ def generate_random_genre_votes(count=100) -> list[dict[str, int]]:
     for i in range(0, count):
         dictionary = {}
         for genre in genres:
-            dictionary[genre] = random.randint(0, 10)
+            dictionary[genre] = generator.randint(0, 10)
         dictionaries.append(dictionary)
 
     return dictionaries
@@ -33,11 +65,11 @@ def generate_random_genre_votes(count=100) -> list[dict[str, int]]:
 def lpp_metrics(book_list: list[Book], genre_votes: dict[str, int]):
     """Measure metrics for the LPP-based algorithm
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     get_recommendations_lpp(book_list, genre_votes)
 
-    end_time = time.time()
+    end_time = time.perf_counter()
     elapsed_time = end_time - start_time
 
     return elapsed_time
@@ -46,28 +78,28 @@ def lpp_metrics(book_list: list[Book], genre_votes: dict[str, int]):
 def sort_metrics(book_list: list[Book], genre_votes: dict[str, int]):
     """Measure metrics for the sorting-based algorithm
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     get_recommendations_sort(book_list, genre_votes)
 
-    end_time = time.time()
+    end_time = time.perf_counter()
     elapsed_time = end_time - start_time
 
     return elapsed_time
 
 
 def time_test(runs=100) -> None:
-    """Test the time performance of both algorithms over 100 repetitions.
+    """Test the time performance of both algorithms over 100 repetitions, on the book_info.csv sample.
     Print the results.
     Preconditions:
     - runs > 0
     - isinstance(runs, int)
     """
     genre_votes_dict = generate_random_genre_votes(runs)
+    book_list = create_books_from_csv()
     total_time_lpp = 0
     total_time_sort = 0
     for dictionary in genre_votes_dict:
-        book_list = create_books_from_csv()
         total_time_lpp += lpp_metrics(book_list, dictionary)
         total_time_sort += sort_metrics(book_list, dictionary)
     average_time_lpp = total_time_lpp / runs
@@ -76,12 +108,683 @@ def time_test(runs=100) -> None:
     print(f"Sort took {average_time_sort:.10f} seconds")
 
 
-def main():
-    time_test(250)
-    # over 250 iterations, it was found that LPP was on average 26% faster
+def extract_metrics(repeat=100, pattern='fixtures/goodreads/book/show/*.html') -> None:
+    """Compare how many book pages per second the BeautifulSoup functions and the single-pass extractor
+    can parse, over the saved fixture pages. Print the results.
+    Preconditions:
+    - repeat > 0
+    """
+    pages = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r', encoding='utf-8') as file:
+            pages.append(file.read())
+    page_count = len(pages) * repeat
 
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            soup = BeautifulSoup(page, 'html.parser')
+            [get_title(soup), get_author(soup), get_rating(soup), get_rating_count(soup), get_genres(soup)]
+    soup_time = time.perf_counter() - start_time
 
-if __name__ == "__main__":
-    main()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            extract_book_info(page)
+    extract_time = time.perf_counter() - start_time
+
+    print(f"BeautifulSoup parsed {page_count / soup_time:.1f} pages/sec")
+    print(f"Single-pass extractor parsed {page_count / extract_time:.1f} pages/sec "
+          f"({soup_time / extract_time:.1f}x faster)")
+
+
+###############################################################################
+# Benchmark suite
+###############################################################################
+class SyntheticNames(Sequence[str]):
+    """The names '<prefix> 0', '<prefix> 1', ..., built on access instead of being stored.
+    Every name repeats after modulo entries, so that, for example, authors can have several books.
+    """
+    prefix: str
+    length: int
+    modulo: int
+
+    def __init__(self, prefix: str, length: int, modulo: Optional[int] = None) -> None:
+        self.prefix = prefix
+        self.length = length
+        self.modulo = modulo or max(length, 1)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('name index out of range')
+        return f'{self.prefix} {index % self.modulo}'
+
+
+def generate_synthetic_catalog(num_books: int, num_genres: int = 500, genres_per_book: int = 7,
+                               distribution: str = 'zipf', skew: float = 1.1, seed: int = 0) -> Catalog:
+    """Return a catalog of num_books randomly generated books, for benchmarking at scale.
+
+    Ratings and rating counts follow the rough shape of the goodreads sample. Each book draws genres_per_book
+    genres (repeats collapse) from num_genres genres, either uniformly or, with distribution 'zipf', with the
+    i-th most popular genre drawn in proportion to 1 / i ** skew.
+    >>> catalog = generate_synthetic_catalog(1000, num_genres=50, seed=1)
+    >>> len(catalog), len(catalog.genre_names), catalog.titles[3]
+    (1000, 50, 'Book 3')
+    >>> bool(1 <= np.diff(catalog.book_indptr).min() and np.diff(catalog.book_indptr).max() <= 7)
+    True
+    """
+    if distribution == 'zipf':
+        probabilities = 1 / np.arange(1, num_genres + 1) ** skew
+        probabilities /= probabilities.sum()
+    elif distribution == 'uniform':
+        probabilities = None
+    else:
+        raise ValueError(f"distribution must be 'zipf' or 'uniform', not {distribution!r}")
+
+    generator = np.random.default_rng(seed)
+    ratings = np.round(np.clip(generator.normal(3.95, 0.3, num_books), 1.0, 5.0), 2)
+    rating_counts = generator.lognormal(8.0, 2.0, num_books).astype(np.int64)
+
+    draws = generator.choice(num_genres, size=(num_books, genres_per_book), p=probabilities)
+    draws.sort(axis=1)
+    distinct = np.ones(draws.shape, dtype=bool)
+    distinct[:, 1:] = draws[:, 1:] != draws[:, :-1]
+    book_indptr = np.zeros(num_books + 1, dtype=np.int64)
+    np.cumsum(distinct.sum(axis=1), out=book_indptr[1:])
+
+    return Catalog(SyntheticNames('Book', num_books), SyntheticNames('Author', num_books, num_books // 3 + 1),
+                   ratings, rating_counts, [f'Genre {i}' for i in range(num_genres)], book_indptr,
+                   draws[distinct].astype(np.int32))
+
+
+def generate_queries(catalog: Catalog, count: int, genres_per_query: int = 5, seed: int = 0) -> list[dict[str, int]]:
+    """Return count random genre votes dictionaries over the catalog's genres, each with up to
+    genres_per_query genres receiving 1 to 10 votes.
+    """
+    generator = random.Random(seed)
+    return [{generator.choice(catalog.genre_names): generator.randint(1, 10) for _ in range(genres_per_query)}
+            for _ in range(count)]
+
+
+@contextmanager
+def stage(timings: dict[str, float], name: str) -> Iterator[None]:
+    """Add the time spent in the block, in seconds, to timings[name].
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start_time
+
+
+@contextmanager
+def recorded_stages(timings: dict[str, float], *names: str) -> Iterator[None]:
+    """Add the seconds the block records in STAGE_SECONDS under each of the given stage names to timings[name],
+    for timing the stages inside a public function.
+    """
+    before = {name: STAGE_SECONDS.total(stage=name) for name in names}
+    try:
+        yield
+    finally:
+        for name in names:
+            timings[name] = timings.get(name, 0.0) + STAGE_SECONDS.total(stage=name) - before[name]
+
+
+def _format_recommendations(catalog: Catalog, selected: list[int]) -> list[str]:
+    return [f"'{catalog[i].title}' by {catalog[i].author}" for i in selected]
+
+
+def _run_sort(catalog: Catalog, genre_votes: dict[str, int], num_books: int, timings: dict[str, float]) -> list[str]:
+    with recorded_stages(timings, 'score', 'select'):
+        books = get_recommendations_sort(catalog, genre_votes, num_books)
+    with stage(timings, 'format'):
+        return [f"'{book.title}' by {book.author}" for book in books]
+
+
+def _run_lpp(catalog: Catalog, genre_votes: dict[str, int], num_books: int, timings: dict[str, float]) -> list[str]:
+    with recorded_stages(timings, 'score', 'select'):
+        books = get_recommendations_lpp(catalog, genre_votes, num_books)
+    with stage(timings, 'format'):
+        return [f"'{book.title}' by {book.author}" for book in books]
+
+
+def _run_scan(catalog: Catalog, genre_votes: dict[str, int], num_books: int,
+              timings: dict[str, float]) -> list[str]:
+    # Scores the whole catalog instead of using the genre index: the baseline the index is measured against.
+    with stage(timings, 'score'):
+        scores = catalog.combined_scores(genre_votes)
+    with stage(timings, 'solve'):
+        selected = top_k_indices(scores, num_books).tolist()
+    with stage(timings, 'format'):
+        return _format_recommendations(catalog, selected)
+
+
+def _run_lpp_cbc(catalog: Catalog, genre_votes: dict[str, int], num_books: int,
+                 timings: dict[str, float]) -> list[str]:
+    with stage(timings, 'score'):
+        catalog.combined_scores(genre_votes)
+    # get_recommendations_lpp scores the catalog again while building the model; that is part of 'solve' here.
+    with stage(timings, 'solve'):
+        books = get_recommendations_lpp(catalog, genre_votes, num_books, solver=PULP_CBC_CMD(msg=False))
+    with stage(timings, 'format'):
+        return [f"'{book.title}' by {book.author}" for book in books]
+
+
+# The constraints of the constrained engines: at most two books by one author, and at least one book of every
+# voted genre, which changes with every query.
+BENCHMARK_CONSTRAINTS = [max_books_per_author(2)]
+
+
+def _run_lpp_constrained(catalog: Catalog, genre_votes: dict[str, int], num_books: int,
+                         timings: dict[str, float]) -> list[str]:
+    with stage(timings, 'score'):
+        scores = catalog.combined_scores(genre_votes)
+    with stage(timings, 'model'):
+        model = get_recommendation_model(catalog, BENCHMARK_CONSTRAINTS)
+    with stage(timings, 'solve'):
+        books = model.solve(genre_votes, num_books, [min_books_per_genre(genre_votes)], scores=scores)
+    with stage(timings, 'format'):
+        return [f"'{book.title}' by {book.author}" for book in books]
+
+
+def _run_lpp_constrained_highs(catalog: Catalog, genre_votes: dict[str, int], num_books: int,
+                               timings: dict[str, float]) -> list[str]:
+    with stage(timings, 'score'):
+        scores = catalog.combined_scores(genre_votes)
+    with stage(timings, 'model'):
+        model = get_recommendation_model(catalog, BENCHMARK_CONSTRAINTS)
+    with stage(timings, 'solve'):
+        books = model.solve(genre_votes, num_books, [min_books_per_genre(genre_votes)],
+                            solver=make_solver(backend='highs'), scores=scores)
+    with stage(timings, 'format'):
+        return [f"'{book.title}' by {book.author}" for book in books]
+
+
+def _run_lpp_constrained_rebuild(catalog: Catalog, genre_votes: dict[str, int], num_books: int,
+                                 timings: dict[str, float]) -> list[str]:
+    with stage(timings, 'score'):
+        scores = catalog.combined_scores(genre_votes)
+    with stage(timings, 'model'):
+        model = RecommendationModel(catalog, BENCHMARK_CONSTRAINTS)
+    with stage(timings, 'solve'):
+        books = model.solve(genre_votes, num_books, [min_books_per_genre(genre_votes)], scores=scores)
+    with stage(timings, 'format'):
+        return [f"'{book.title}' by {book.author}" for book in books]
+
+
+# Maps each engine name to the function that runs one query through it, recording the time spent in each
+# stage, and the largest catalog it is benchmarked on (None for no limit).
+ENGINES: dict[str, tuple[Callable[[Catalog, dict[str, int], int, dict[str, float]], list[str]], Optional[int]]] = {
+    'lpp': (_run_lpp, None),
+    'sort': (_run_sort, None),
+    'scan': (_run_scan, None),
+    'lpp-cbc': (_run_lpp_cbc, 20_000),
+    'lpp-constrained': (_run_lpp_constrained, 20_000),
+    'lpp-constrained-rebuild': (_run_lpp_constrained_rebuild, 20_000),
+    'lpp-constrained-highs': (_run_lpp_constrained_highs, 5_000),
+}
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """Return the count, mean, minimum, maximum and 50th, 95th and 99th percentiles of samples.
+    >>> summarize([1.0, 2.0, 3.0, 4.0])['p50']
+    2.5
+    """
+    values = np.asarray(samples, dtype=np.float64)
+    return {'n': len(samples), 'mean': float(values.mean()), 'min': float(values.min()),
+            'max': float(values.max()), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99))}
+
+
+def _peak_memory(function: Callable[[], object]) -> int:
+    """Return the peak number of bytes allocated while function runs, beyond what was allocated before.
+    """
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        function()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
 
-# TODO: Try with more linear constraints.
+
+def benchmark_load(catalog: Catalog, repeat: int = 5, csv_limit: int = 100_000) -> dict[str, dict]:
+    """Return timings and peak memory for loading the catalog from a binary catalog file and, for catalogs of
+    at most csv_limit books, from a csv file.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as workspace:
+        binary_path = os.path.join(workspace, 'catalog.lcat')
+        write_binary_catalog(catalog, binary_path)
+        loaders = {'binary': lambda: load_binary_catalog(binary_path)}
+        if len(catalog) <= csv_limit:
+            from binary_catalog import binary_to_csv
+            csv_path = os.path.join(workspace, 'catalog.csv')
+            binary_to_csv(binary_path, csv_path)
+            loaders['csv'] = lambda: Catalog.from_csv(csv_path)
+
+        for name, loader in loaders.items():
+            loader()
+            samples = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                loader()
+                samples.append(time.perf_counter() - start_time)
+            results[name] = summarize(samples)
+            results[name]['peak_memory_bytes'] = _peak_memory(loader)
+    return results
+
+
+def benchmark_engine(engine: str, catalog: Catalog, queries: list[dict[str, int]], num_books: int = 10,
+                     warmup: int = 3) -> dict:
+    """Return per-stage latency statistics and the peak memory of one query for the given engine.
+    The first warmup queries are run but not measured.
+    >>> catalog = generate_synthetic_catalog(1000, num_genres=50)
+    >>> queries = generate_queries(catalog, 5)
+    >>> [sorted(benchmark_engine(engine, catalog, queries, warmup=1)['stages']) for engine in ('lpp', 'sort')]
+    [['format', 'score', 'select', 'total'], ['format', 'score', 'select', 'total']]
+    """
+    run = ENGINES[engine][0]
+    for genre_votes in queries[:warmup]:
+        run(catalog, genre_votes, num_books, {})
+
+    samples = {}
+    for genre_votes in queries[warmup:]:
+        timings = {}
+        run(catalog, genre_votes, num_books, timings)
+        timings['total'] = sum(timings.values())
+        for name, seconds in timings.items():
+            samples.setdefault(name, []).append(seconds)
+
+    return {'stages': {name: summarize(values) for name, values in samples.items()},
+            'peak_memory_bytes': _peak_memory(lambda: run(catalog, queries[-1], num_books, {}))}
+
+
+def run_benchmarks(sizes: list[int], engines: list[str], num_queries: int = 100, warmup: int = 5,
+                   num_genres: int = 500, distribution: str = 'zipf', num_books: int = 10,
+                   seed: int = 0) -> dict:
+    """Benchmark loading and each engine on synthetic catalogs of the given sizes and return the results,
+    ready to be saved as JSON.
+    """
+    results = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'catalogs': []}
+    for size in sizes:
+        catalog = generate_synthetic_catalog(size, num_genres, distribution=distribution, seed=seed)
+        queries = generate_queries(catalog, num_queries + warmup, seed=seed)
+        entry = {'books': size, 'genres': num_genres, 'distribution': distribution,
+                 'load': benchmark_load(catalog), 'engines': {}}
+        for engine in engines:
+            limit = ENGINES[engine][1]
+            if limit is None or size <= limit:
+                entry['engines'][engine] = benchmark_engine(engine, catalog, queries, num_books, warmup)
+        results['catalogs'].append(entry)
+        print_results({'catalogs': [entry]})
+    return results
+
+
+def print_results(results: dict) -> None:
+    """Print a table of the p50, p95 and p99 latencies in results, in milliseconds.
+    """
+    for entry in results['catalogs']:
+        print(f"{entry['books']:,} books, {entry['genres']} genres ({entry['distribution']})")
+        for name, stats in entry['load'].items():
+            print(f"  load {name:<8} p50 {stats['p50'] * 1000:9.3f} ms  p95 {stats['p95'] * 1000:9.3f} ms  "
+                  f"peak {stats['peak_memory_bytes'] / 2 ** 20:8.1f} MiB")
+        for engine, result in entry['engines'].items():
+            for name, stats in result['stages'].items():
+                print(f"  {engine:<23} {name:<9} p50 {stats['p50'] * 1000:9.3f} ms  p95 {stats['p95'] * 1000:9.3f} ms"
+                      f"  p99 {stats['p99'] * 1000:9.3f} ms")
+            print(f"  {engine:<23} peak memory {result['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def compare_results(old: dict, new: dict, threshold: float = 0.1, min_delta: float = 0.0001) -> list[str]:
+    """Return a description of every p50 or p95 latency in new that is more than threshold (as a fraction) and
+    min_delta seconds slower than in old, for the catalogs and engines both runs measured.
+    >>> old = {'catalogs': [{'books': 10, 'genres': 5, 'distribution': 'zipf', 'load': {},
+    ...        'engines': {'lpp': {'stages': {'total': {'p50': 0.010, 'p95': 0.020}}}}}]}
+    >>> new = {'catalogs': [{'books': 10, 'genres': 5, 'distribution': 'zipf', 'load': {},
+    ...        'engines': {'lpp': {'stages': {'total': {'p50': 0.015, 'p95': 0.020}}}}}]}
+    >>> compare_results(old, new)
+    ['10 books (zipf) lpp total p50: 10.000 ms -> 15.000 ms (+50.0%)']
+    """
+    def key(entry: dict) -> tuple:
+        return entry['books'], entry['genres'], entry['distribution']
+
+    regressions = []
+    old_entries = {key(entry): entry for entry in old['catalogs']}
+    for entry in new['catalogs']:
+        previous = old_entries.get(key(entry))
+        if previous is None:
+            continue
+        pairs = [(f'load {name}', stats, previous['load'].get(name)) for name, stats in entry['load'].items()]
+        for engine, result in entry['engines'].items():
+            if engine in previous['engines']:
+                old_stages = previous['engines'][engine]['stages']
+                pairs.extend((f'{engine} {name}', stats, old_stages.get(name))
+                             for name, stats in result['stages'].items())
+        for label, stats, old_stats in pairs:
+            if old_stats is None:
+                continue
+            for percentile in ('p50', 'p95'):
+                before, after = old_stats[percentile], stats[percentile]
+                if after > before * (1 + threshold) and after - before > min_delta:
+                    regressions.append(f"{entry['books']:,} books ({entry['distribution']}) {label} {percentile}: "
+                                       f"{before * 1000:.3f} ms -> {after * 1000:.3f} ms "
+                                       f"({(after / before - 1) * 100:+.1f}%)")
+    return regressions
+
+
+def benchmark_votes(num_clubs: int = 100, members_per_club: int = 100, threads: int = 16,
+                    genres_per_ballot: int = 5, num_genres: int = 200, reads: int = 1000, seed: int = 0) -> dict:
+    """Return the ballot ingestion rate of a fresh vote store with many members voting at once, and the latency
+    of reading a club's genre votes both while they vote and afterwards.
+    >>> results = benchmark_votes(num_clubs=3, members_per_club=10, threads=4, reads=10)
+    >>> results['ballots'], results['read']['n']
+    (30, 10)
+    """
+    rng = random.Random(seed)
+    genres = [f'Genre {i}' for i in range(num_genres)]
+    clubs = [f'club-{i}' for i in range(num_clubs)]
+    ballots = [(club, f'member-{j}', {genre: rng.randint(1, 5) for genre in rng.sample(genres, genres_per_ballot)})
+               for club in clubs for j in range(members_per_club)]
+    rng.shuffle(ballots)
+    store = VoteStore(os.path.join(tempfile.mkdtemp(), 'votes.db'))
+
+    def vote(share: list[tuple[str, str, dict[str, int]]]) -> None:
+        for club, member, ballot in share:
+            store.cast(club, member, ballot)
+
+    def read(samples: list[float], count: Optional[int] = None, until: Optional[threading.Event] = None) -> None:
+        while True:
+            club = rng.choice(clubs)
+            start_time = time.perf_counter()
+            store.genre_votes(club)
+            samples.append(time.perf_counter() - start_time)
+            if len(samples) == count or (until is not None and until.is_set()):
+                return
+
+    voted = threading.Event()
+    during = []
+    reader = threading.Thread(target=read, args=(during, None, voted))
+    voters = [threading.Thread(target=vote, args=(ballots[i::threads],)) for i in range(threads)]
+    start_time = time.perf_counter()
+    reader.start()
+    for voter in voters:
+        voter.start()
+    for voter in voters:
+        voter.join()
+    elapsed = time.perf_counter() - start_time
+    voted.set()
+    reader.join()
+
+    after = []
+    read(after, reads)
+    store.close()
+    results = {'ballots': len(ballots), 'threads': threads, 'seconds': elapsed,
+               'ballots_per_second': len(ballots) / elapsed,
+               'votes_per_second': len(ballots) * genres_per_ballot / elapsed,
+               'read_during_voting': summarize(during), 'read': summarize(after)}
+    return results
+
+
+# The scraper functions benchmark_scrape measures, with the recorded pages each one is given the urls of.
+SCRAPE_FUNCTIONS = {'get_book_links': '/book/popular_by_date/', 'create_book_list': '/book/show/',
+                    'get_book_info_mass': '/book/show/'}
+
+
+def benchmark_scrape(concurrency_levels: Sequence[int] = (1, 4, 16), copies: int = 20, latency: float = 0.02,
+                     jitter: float = 0.03, error_rate: float = 0.02, seed: int = 0) -> dict[str, dict[int, dict]]:
+    """Return the throughput of each scraper function in SCRAPE_FUNCTIONS at each concurrency level, by function
+    name and concurrency: the pages fetched per second, the CPU seconds this process spent fetching and parsing
+    them, and the peak memory allocated while doing so.
+
+    The pages are the recorded fixture pages, each served under copies different urls by a replay server in
+    another process, which waits latency seconds plus up to jitter seconds before answering and answers a
+    fraction error_rate of requests with 503, which the fetcher retries. The peak memory is traced in a second
+    run, since tracing slows the first.
+    >>> results = benchmark_scrape([2], copies=2, latency=0.0, jitter=0.0, error_rate=0.0)
+    >>> [results[name][2]['pages'] for name in SCRAPE_FUNCTIONS]
+    [2, 14, 14]
+    """
+    import scraper
+    from fetch import configure_fetcher
+    from replay import ReplayServer, serve_in_subprocess
+
+    recorded = ReplayServer.from_directory().pages
+    pages = {f'{path}?copy={copy}': page for path, page in recorded.items() for copy in range(copies)}
+    results = {}
+    with serve_in_subprocess(pages, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed,
+                             rewrite_host='https://www.goodreads.com') as root:
+        for name, prefix in SCRAPE_FUNCTIONS.items():
+            urls = [root + path for path in sorted(pages) if path.startswith(prefix)]
+            for concurrency in concurrency_levels:
+                configure_fetcher(concurrency=concurrency, requests_per_second=None, backoff=0.01, retries=5)
+                start_cpu, start = time.process_time(), time.perf_counter()
+                getattr(scraper, name)(urls)
+                seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+                tracemalloc.start()
+                getattr(scraper, name)(urls)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results.setdefault(name, {})[concurrency] = {
+                    'pages': len(urls), 'seconds': seconds, 'pages_per_second': len(urls) / seconds,
+                    'cpu_seconds': cpu_seconds, 'cpu_ms_per_page': cpu_seconds / len(urls) * 1000,
+                    'peak_memory': peak}
+    configure_fetcher()
+    return results
+
+
+# The most a crawl's peak memory may grow, as a multiple of the peak of the crawl of the fewest months, for
+# benchmark_crawl's memory check to pass. Crawls of about fifty months or more fill the pipeline's queues, so
+# their peaks only differ by what grows with the number of books crawled.
+CRAWL_MEMORY_GROWTH = 1.5
+
+
+def benchmark_crawl(months_levels: Sequence[int] = (64, 256), concurrency: int = 16, latency: float = 0.0,
+                    batch_size: Optional[int] = None) -> dict[int, dict]:
+    """Return the books written per second and the peak memory allocated by a crawl of each number of months in
+    months_levels, by number of months, and whether the peak stayed within CRAWL_MEMORY_GROWTH times the peak of
+    the crawl of the fewest months.
+
+    Every month's listing is the recorded fixture listing, linking to the recorded book pages under ids and
+    titles of the month's own, so every month adds new books to the catalog. The pages are served by a replay
+    server in another process, which waits latency seconds before answering. batch_size is passed to crawl if
+    given; the crawls are timed while memory is traced.
+    >>> results = benchmark_crawl([48, 96], batch_size=20)
+    >>> [(results[months]['listings'], results[months]['written']) for months in (48, 96)]
+    [(48, 240), (96, 480)]
+    >>> results[96]['within_growth']
+    True
+    """
+    from urllib.parse import urlsplit
+
+    from books import write_to_csv
+    from fetch import Fetcher
+    from pipeline import crawl, popular_by_date_urls
+    from replay import ReplayServer, serve_in_subprocess
+
+    recorded = ReplayServer.from_directory().pages
+    listing = recorded['/book/popular_by_date/2023/8']
+    books = {path: page for path, page in recorded.items() if path.startswith('/book/show/')}
+    titles = {path: extract_book_info(page)[0] for path, page in books.items()}
+    listing_paths = [urlsplit(url).path for url in popular_by_date_urls(max(months_levels))]
+    pages = {}
+    for month, listing_path in enumerate(listing_paths):
+        prefix = f'/book/show/{month + 1}0'
+        pages[listing_path] = listing.replace('/book/show/', prefix)
+        for path, page in books.items():
+            pages[path.replace('/book/show/', prefix)] = page.replace(titles[path], f'{titles[path]} {month + 1}')
+
+    options = {} if batch_size is None else {'batch_size': batch_size}
+    results = {}
+    with serve_in_subprocess(pages, latency=latency, rewrite_host='https://www.goodreads.com') as root:
+        for months in sorted(months_levels):
+            filename = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+            write_to_csv([['Title', 'Author', 'Rating', 'Rating Count', 'Genres']], filename)
+            urls = [root + path for path in listing_paths[-months:]]
+            tracemalloc.start()
+            start = time.perf_counter()
+            summary = crawl(urls, filename, Fetcher(concurrency, requests_per_second=None), **options)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[months] = dict(summary, seconds=seconds, books_per_second=summary['written'] / seconds,
+                                   peak_memory=peak)
+    smallest = results[min(months_levels)]['peak_memory']
+    for stats in results.values():
+        stats['within_growth'] = stats['peak_memory'] <= CRAWL_MEMORY_GROWTH * smallest
+    return results
+
+
+# The most seconds a freshly started server process may take to answer its first page request, counted from
+# the start of the interpreter, and to answer its first recommendation request.
+STARTUP_TARGETS = {'first_response': 1.0, 'first_recommendation': 5.0}
+
+# Run in a fresh interpreter by benchmark_startup: builds the app from the given module, requests the genre
+# selection page and then a reading list, and prints the time each answer arrived.
+_STARTUP_SCRIPT = """
+import json, sys, time
+module = __import__(sys.argv[1])
+imported = time.time()
+client = module.app.test_client()
+client.get('/select_genres')
+first_response = time.time()
+job = client.post('/process', data={'genres': ['Fiction', 'Romance'], 'form_submitted': 'true'}).location
+while client.get(job + '/status').json['status'] not in ('done', 'failed'):
+    time.sleep(0.01)
+print(json.dumps({'imported': imported, 'first_response': first_response, 'first_recommendation': time.time()}))
+"""
+
+
+def benchmark_startup(module: str = 'wsgi', repeat: int = 3, top: int = 10) -> dict:
+    """Return the cold start times of a server process that imports the app from module, each the median over
+    repeat fresh interpreters and counted from the start of the interpreter: until the module is imported, until
+    the first page is served and until the first reading list is ready. Also return the import time of the top
+    packages, from python -X importtime, with every module's own import time counted towards its top-level
+    package.
+    """
+    samples = {'imported': [], 'first_response': [], 'first_recommendation': []}
+    packages = {}
+    for _ in range(repeat):
+        started = time.time()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', _STARTUP_SCRIPT, module],
+                                 capture_output=True, text=True, check=True)
+        times = json.loads(process.stdout.strip().splitlines()[-1])
+        for name in samples:
+            samples[name].append(times[name] - started)
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            if line.startswith('import time:') and fields[0].split(':')[1].strip().isdigit():
+                package = fields[2].strip().split('.')[0]
+                packages[package] = packages.get(package, 0) + int(fields[0].split(':')[1]) / 1e6 / repeat
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {'module': module, **{name: float(np.median(values)) for name, values in samples.items()},
+            'packages': dict(heaviest)}
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='benchmark the engines on synthetic catalogs')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    run_parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    run_parser.add_argument('--queries', type=int, default=100)
+    run_parser.add_argument('--warmup', type=int, default=5)
+    run_parser.add_argument('--genres', type=int, default=500)
+    run_parser.add_argument('--distribution', choices=['zipf', 'uniform'], default='zipf')
+    run_parser.add_argument('--num-books', type=int, default=10)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='save the results as JSON to this file')
+    compare_parser = commands.add_parser('compare', help='flag regressions between two saved runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    commands.add_parser('extract', help='compare page parsing throughput')
+    commands.add_parser('sample', help='time the engines on the book_info.csv sample')
+    votes_parser = commands.add_parser('votes', help='benchmark vote ingestion and genre vote reads')
+    votes_parser.add_argument('--clubs', type=int, default=100)
+    votes_parser.add_argument('--members', type=int, default=100)
+    votes_parser.add_argument('--threads', type=int, default=16)
+    scrape_parser = commands.add_parser('scrape', help='benchmark the scraper against a local replay server')
+    scrape_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    scrape_parser.add_argument('--copies', type=int, default=20)
+    scrape_parser.add_argument('--latency', type=float, default=0.02)
+    scrape_parser.add_argument('--jitter', type=float, default=0.03)
+    scrape_parser.add_argument('--error-rate', type=float, default=0.02)
+    crawl_parser = commands.add_parser('crawl', help='check that crawl memory does not grow with the months crawled')
+    crawl_parser.add_argument('--months', type=int, nargs='+', default=[64, 256])
+    crawl_parser.add_argument('--concurrency', type=int, default=16)
+    crawl_parser.add_argument('--latency', type=float, default=0.0)
+    startup_parser = commands.add_parser('startup', help='measure cold start and time to first response')
+    startup_parser.add_argument('--module', default='wsgi')
+    startup_parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.old, encoding='utf-8') as file:
+            old = json.load(file)
+        with open(args.new, encoding='utf-8') as file:
+            new = json.load(file)
+        regressions = compare_results(old, new, args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if not regressions:
+            print('No regressions.')
+        return 1 if regressions else 0
+    if args.command == 'startup':
+        results = benchmark_startup(args.module, args.repeat)
+        missed = [name for name, target in STARTUP_TARGETS.items() if results[name] > target]
+        print(f"{args.module}: imported in {results['imported']:.3f} s")
+        for name, target in STARTUP_TARGETS.items():
+            print(f"  {name:<20} {results[name]:.3f} s (target {target:.1f} s){'  MISSED' if name in missed else ''}")
+        for package, seconds in results['packages'].items():
+            print(f'  import {package:<20} {seconds * 1000:8.1f} ms')
+        return 1 if missed else 0
+    if args.command == 'scrape':
+        results = benchmark_scrape(args.concurrency, args.copies, args.latency, args.jitter, args.error_rate)
+        for name, levels in results.items():
+            for concurrency, stats in levels.items():
+                print(f"{name:<18} concurrency {concurrency:>3}: {stats['pages']:,} pages, "
+                      f"{stats['pages_per_second']:8.1f} pages/s, CPU {stats['cpu_ms_per_page']:6.2f} ms/page, "
+                      f"peak memory {stats['peak_memory'] / 2 ** 20:6.1f} MiB")
+        return 0
+    if args.command == 'crawl':
+        results = benchmark_crawl(args.months, args.concurrency, args.latency)
+        for months, stats in results.items():
+            print(f"{months:>4} months: {stats['written']:,} books, {stats['books_per_second']:8.1f} books/s, "
+                  f"peak memory {stats['peak_memory'] / 2 ** 20:6.1f} MiB"
+                  f"{'' if stats['within_growth'] else '  GREW'}")
+        return 0 if all(stats['within_growth'] for stats in results.values()) else 1
+    if args.command == 'extract':
+        extract_metrics()
+    elif args.command == 'sample':
+        time_test(250)
+    elif args.command == 'votes':
+        results = benchmark_votes(args.clubs, args.members, args.threads)
+        print(f"{results['ballots']:,} ballots from {results['threads']} threads in {results['seconds']:.2f} s: "
+              f"{results['ballots_per_second']:,.0f} ballots/s, {results['votes_per_second']:,.0f} votes/s")
+        for name in ('read_during_voting', 'read'):
+            stats = results[name]
+            print(f"  {name:<18} p50 {stats['p50'] * 1000:9.3f} ms  p95 {stats['p95'] * 1000:9.3f} ms"
+                  f"  p99 {stats['p99'] * 1000:9.3f} ms")
+    else:
+        if args.command is None:
+            args = run_parser.parse_args([])
+        results = run_benchmarks(args.sizes, args.engines, args.queries, args.warmup, args.genres,
+                                 args.distribution, args.num_books, args.seed)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""This file contains the crawl pipeline, which scrapes books from "popular by date published" pages into the
+catalog as it goes, instead of collecting every link and every book in lists before writing anything.
+
+Listing discovery, page fetching, parsing and validation run as concurrent stages, connected by bounded queues,
+so a stage that falls behind makes the stages before it wait rather than pile up work. Invalid books are dropped
+as they are parsed, and valid ones are put in the catalog store in batches, whose change log the store compacts
+once it passes CatalogStore.max_log_bytes, so the memory used does not grow with the number of listings crawled,
+and a crawl that fails part way keeps every batch written before the failure.
+"""
+import argparse
+import queue
+import threading
+from datetime import date
+from typing import Callable, Iterator, Optional
+
+from bs4 import BeautifulSoup
+
+from catalog_store import CatalogStore
+from extract import extract_book_info
+from fetch import Fetcher, get_fetcher
+from refresh import book_id
+from scraper import book_links_from_soup
+
+QUEUE_SIZE = 64
+BATCH_SIZE = 100
+# The number of the most recently discovered book ids kept to skip links to books already fetched. A book linked
+# again after that many other books is fetched again, and put over itself.
+SEEN_LINKS = 100_000
+
+# Marks the end of the items in a queue.
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised in a stage when another stage has failed and the crawl is stopping."""
+
+
+def popular_by_date_urls(months: int, today: Optional[date] = None) -> list[str]:
+    """Return the "popular by date published" urls of the given number of months up to and including the month
+    of today, oldest first.
+    >>> popular_by_date_urls(3, date(2024, 2, 10))
+    ['https://www.goodreads.com/book/popular_by_date/2023/12', 'https://www.goodreads.com/book/popular_by_date/2024/1', 'https://www.goodreads.com/book/popular_by_date/2024/2']
+    """
+    today = today or date.today()
+    month_index = today.year * 12 + today.month - 1
+    return [f'https://www.goodreads.com/book/popular_by_date/{index // 12}/{index % 12 + 1}'
+            for index in range(month_index - months + 1, month_index + 1)]
+
+
+def is_valid_book_info(info: list) -> bool:
+    """Return whether info, as returned by extract_book_info, describes a book worth keeping: one whose page had a
+    title and which has been rated.
+    >>> is_valid_book_info(['Hello Stranger', 'Katherine Center', 4.09, 23926, ['Romance']])
+    True
+    >>> is_valid_book_info(['Title Unavailable', 'Author name not found.', 0.0, 1, []])
+    False
+    """
+    return not info[0].startswith('Title Unavailable') and info[2] > 0.0
+
+
+def crawl(listing_urls: list[str], filename: str = 'book_info.csv', fetcher: Optional[Fetcher] = None,
+          parsers: int = 2, queue_size: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE,
+          seen_links: int = SEEN_LINKS) -> dict[str, int]:
+    """Scrape the books linked from the given "popular by date published" pages into the catalog in filename,
+    and return counts of what was done.
+
+    Each book is fetched once however many listings link to it, unless more than seen_links other books are
+    discovered in between, and parsed by one of parsers threads. Books whose pages could not be fetched or parsed
+    are counted as failed, and invalid books as invalid; neither is written. Valid books are put in the catalog
+    store batch_size at a time, replacing any books with the same title and author, and the catalog is compacted
+    at the end.
+
+    >>> import os, tempfile
+    >>> from books import write_to_csv
+    >>> from replay import ReplayServer
+    >>> catalog = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+    >>> write_to_csv([['Title', 'Author', 'Rating', 'Rating Count', 'Genres']], catalog)
+    >>> with ReplayServer.from_directory() as server:
+    ...     listing = server.url('/book/popular_by_date/2023/8')
+    ...     urls = [listing, listing, server.url('/book/popular_by_date/1999/1')]
+    ...     crawl(urls, catalog, Fetcher(requests_per_second=None), batch_size=2)
+    {'listings': 2, 'failed_listings': 1, 'links': 6, 'fetched': 6, 'failed': 0, 'invalid': 1, 'written': 5, 'batches': 3}
+    >>> sorted(book.title for book in CatalogStore(catalog).snapshot())[:2]
+    ['Book of Night', 'Hello Stranger']
+    """
+    fetcher = fetcher or get_fetcher()
+    store = CatalogStore(filename)
+    summary = {'listings': 0, 'failed_listings': 0, 'links': 0, 'fetched': 0, 'failed': 0, 'invalid': 0,
+               'written': 0, 'batches': 0}
+    summary_lock = threading.Lock()
+    links = queue.Queue(maxsize=queue_size)
+    pages = queue.Queue(maxsize=queue_size)
+    rows = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    errors = []
+
+    def count(name: str) -> None:
+        with summary_lock:
+            summary[name] += 1
+
+    def fetch(url: str) -> Optional[str]:
+        try:
+            response = fetcher.get(url)
+        except OSError:
+            return None
+        return response.text if response.status_code == 200 else None
+
+    def discover() -> None:
+        # The keys of a dict are kept in insertion order, so the first is the least recently discovered.
+        seen = {}
+        for body in fetcher.map(fetch, listing_urls):
+            if body is None:
+                count('failed_listings')
+                continue
+            count('listings')
+            for link in book_links_from_soup(BeautifulSoup(body, 'html.parser')):
+                if book_id(link) not in seen:
+                    seen[book_id(link)] = None
+                    if len(seen) > seen_links:
+                        del seen[next(iter(seen))]
+                    count('links')
+                    _put(links, link, stopped)
+        _put(links, _DONE, stopped)
+
+    def download() -> None:
+        for body in fetcher.map(fetch, _drain(links, stopped)):
+            if body is None:
+                count('failed')
+            else:
+                count('fetched')
+                _put(pages, body, stopped)
+        for _ in range(parsers):
+            _put(pages, _DONE, stopped)
+
+    def parse() -> None:
+        for body in _drain(pages, stopped):
+            try:
+                info = extract_book_info(body)
+            except (ValueError, IndexError):
+                count('failed')
+                continue
+            if is_valid_book_info(info):
+                _put(rows, info, stopped)
+            else:
+                count('invalid')
+        _put(rows, _DONE, stopped)
+
+    threads = [_start(stage, stopped, errors) for stage in [discover, download] + [parse] * parsers]
+    batch = []
+    try:
+        finished = 0
+        while finished < parsers:
+            row = _get(rows, stopped)
+            if row is _DONE:
+                finished += 1
+                continue
+            batch.append(row)
+            if len(batch) == batch_size:
+                _write(store, batch, summary)
+        _write(store, batch, summary)
+        store.compact()
+    except _Stopped:
+        pass
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return summary
+
+
+def _write(store: CatalogStore, batch: list[list], summary: dict[str, int]) -> None:
+    if batch:
+        store.put_many(batch)
+        summary['written'] += len(batch)
+        summary['batches'] += 1
+        batch.clear()
+
+
+def _start(stage: Callable[[], None], stopped: threading.Event, errors: list[BaseException]) -> threading.Thread:
+    """Run stage in a new thread. If it fails, record the error and stop the other stages."""
+    def run() -> None:
+        try:
+            stage()
+        except _Stopped:
+            pass
+        except BaseException as error:
+            errors.append(error)
+            stopped.set()
+
+    thread = threading.Thread(target=run, name=f'litloom-crawl-{stage.__name__}', daemon=True)
+    thread.start()
+    return thread
+
+
+def _put(items: queue.Queue, item: object, stopped: threading.Event) -> None:
+    while True:
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            if stopped.is_set():
+                raise _Stopped
+
+
+def _get(items: queue.Queue, stopped: threading.Event) -> object:
+    while True:
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            if stopped.is_set():
+                raise _Stopped
+
+
+def _drain(items: queue.Queue, stopped: threading.Event) -> Iterator[object]:
+    item = _get(items, stopped)
+    while item is not _DONE:
+        yield item
+        item = _get(items, stopped)
+
+
+def main():
+    from streaming import peak_memory
+
+    parser = argparse.ArgumentParser(description='Crawl recent "popular by date published" pages into the catalog.')
+    parser.add_argument('filename', nargs='?', default='book_info.csv')
+    parser.add_argument('--months', type=int, default=2)
+    parser.add_argument('--parsers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    print(crawl(popular_by_date_urls(args.months), args.filename, parsers=args.parsers,
+                batch_size=args.batch_size))
+    memory = peak_memory()
+    print(f"peak memory {'unknown' if memory is None else f'{memory / 2 ** 20:.1f} MiB'}")
+
+
+if __name__ == "__main__":
+    main()
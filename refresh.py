@@ -0,0 +1,234 @@
+"""This file contains the incremental catalog refresh, which brings book_info.csv up to date with goodreads.com
+without re-downloading and re-parsing pages that have not changed.
+
+Raw pages are cached on disk together with their ETag and Last-Modified headers, so that pages fetched before
+are requested conditionally. Books fetched recently are skipped altogether, and progress is checkpointed as the
+refresh goes, so an interrupted refresh resumes where it stopped.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Optional
+
+from bs4 import BeautifulSoup
+
+from books import write_to_csv
+from catalog_store import CatalogStore
+from extract import extract_book_info
+from fetch import Fetcher, get_fetcher
+from scraper import book_links_from_soup, generate_popular_by_date_urls
+
+BOOK_ID_PATTERN = re.compile(r'/book/show/(\d+)')
+
+
+def book_id(book_link: str) -> str:
+    """Return the goodreads id of the book at book_link, or the link itself if it has none.
+    >>> book_id('https://www.goodreads.com/book/show/61884987-hello-stranger')
+    '61884987'
+    """
+    match = BOOK_ID_PATTERN.search(book_link)
+    return match.group(1) if match else book_link
+
+
+class PageCache:
+    """The raw html of fetched pages, stored on disk and keyed by url.
+
+    The page for a url is stored in <key>.html and its response headers in <key>.json, where key is the SHA-1 of
+    the url. The headers file is written last, so a page is only cached once it has been written in full.
+
+    Instance Attributes:
+    - directory: the directory the pages are stored in
+    """
+    directory: str
+
+    def __init__(self, directory: str = 'page_cache') -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, url: str) -> Optional[tuple[dict, str]]:
+        """Return the cached headers and body for url, or None if url is not cached.
+        """
+        html_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            with open(html_path, 'r', encoding='utf-8') as file:
+                return meta, file.read()
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url: str, body: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        """Cache body as the current page at url, along with its validators.
+        """
+        html_path, meta_path = self._paths(url)
+        _write_atomically(html_path, body)
+        _write_atomically(meta_path, json.dumps({'url': url, 'etag': etag, 'last_modified': last_modified}))
+
+    def fetch(self, url: str, fetcher: Fetcher) -> tuple[str, bool]:
+        """Return the body of the page at url and whether it changed since it was cached.
+        A cached page is revalidated with If-None-Match and If-Modified-Since instead of being downloaded again.
+        """
+        cached = self.load(url)
+        headers = {}
+        if cached is not None:
+            meta = cached[0]
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response = fetcher.get(url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached[1], False
+        self.store(url, response.text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.text, True
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        return key + '.html', key + '.json'
+
+
+class RefreshState:
+    """The checkpointed progress of the catalog refresh: when each known book was last fetched,
+    and which catalog row it corresponds to.
+
+    Instance Attributes:
+    - path: the file the state is checkpointed to
+    - books: maps each book id to a dict with the time it was last fetched ('fetched_at') and, if it is in the
+      catalog, its 'title' and 'author'
+    """
+    path: str
+    books: dict[str, dict]
+
+    def __init__(self, path: str = 'refresh_state.json') -> None:
+        self.path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                self.books = json.load(file)['books']
+        except FileNotFoundError:
+            self.books = {}
+
+    def is_fresh(self, book: str, now: float, max_age: float) -> bool:
+        """Return whether the book with the given id was fetched less than max_age seconds before now.
+        """
+        record = self.books.get(book)
+        return record is not None and now - record['fetched_at'] < max_age
+
+    def save(self) -> None:
+        """Checkpoint the state to disk, atomically.
+        """
+        _write_atomically(self.path, json.dumps({'books': self.books}))
+
+
+def refresh_catalog(listing_urls: list[str], filename: str = 'book_info.csv',
+                    state_path: str = 'refresh_state.json', cache_dir: str = 'page_cache',
+                    max_age: float = 7 * 24 * 60 * 60, checkpoint_every: int = 20,
+                    fetcher: Optional[Fetcher] = None) -> dict[str, int]:
+    """Bring the catalog in filename up to date with the books on the given "popular by date published" pages
+    and return counts of what was done.
+
+    Books fetched less than max_age seconds ago are skipped. Other pages are revalidated against the page
+    cache, and only pages that changed are parsed. New and changed books are put in the catalog store. Every
+    checkpoint_every books, they are appended to the store's log and the refresh state is saved; at the end, the
+    catalog is compacted.
+
+    >>> from replay import ReplayServer
+    >>> workspace = tempfile.mkdtemp()
+    >>> catalog = os.path.join(workspace, 'book_info.csv')
+    >>> write_to_csv([['Title', 'Author', 'Rating', 'Rating Count', 'Genres']], catalog)
+    >>> options = {'filename': catalog, 'state_path': os.path.join(workspace, 'state.json'),
+    ...            'cache_dir': os.path.join(workspace, 'cache'), 'checkpoint_every': 2,
+    ...            'fetcher': Fetcher(requests_per_second=None)}
+    >>> with ReplayServer.from_directory() as server:
+    ...     listing = [server.url('/book/popular_by_date/2023/8')]
+    ...     first = refresh_catalog(listing, **options)
+    ...     second = refresh_catalog(listing, **options)
+    ...     third = refresh_catalog(listing, max_age=0, **options)
+    >>> first
+    {'skipped': 0, 'fetched': 6, 'not_modified': 0, 'added': 5, 'updated': 0, 'invalid': 1}
+    >>> second
+    {'skipped': 6, 'fetched': 0, 'not_modified': 0, 'added': 0, 'updated': 0, 'invalid': 0}
+    >>> third
+    {'skipped': 0, 'fetched': 0, 'not_modified': 6, 'added': 0, 'updated': 0, 'invalid': 0}
+    >>> with open(catalog, encoding='utf-8') as file:
+    ...     len(file.readlines())
+    6
+    """
+    fetcher = fetcher or get_fetcher()
+    cache = PageCache(cache_dir)
+    state = RefreshState(state_path)
+    summary = {'skipped': 0, 'fetched': 0, 'not_modified': 0, 'added': 0, 'updated': 0, 'invalid': 0}
+
+    book_links = {}
+    for body, _ in fetcher.map(lambda url: cache.fetch(url, fetcher), listing_urls):
+        for link in book_links_from_soup(BeautifulSoup(body, 'html.parser')):
+            book_links.setdefault(book_id(link), link)
+
+    now = time.time()
+    pending = []
+    for book, link in book_links.items():
+        if state.is_fresh(book, now, max_age):
+            summary['skipped'] += 1
+        else:
+            pending.append(link)
+
+    store = CatalogStore(filename)
+    catalog_keys = {(row[0], row[1]) for row in store.rows()}
+    new_rows = []
+    updated_rows = {}
+
+    def checkpoint() -> None:
+        # A book whose title or author changed is removed under its old key and put again under its new one.
+        store.delete_many(key for key, info in updated_rows.items() if key != (info[0], info[1]))
+        store.put_many(new_rows + list(updated_rows.values()))
+        new_rows.clear()
+        updated_rows.clear()
+        state.save()
+
+    results = fetcher.map(lambda url: (url,) + cache.fetch(url, fetcher), pending)
+    for processed, (link, body, changed) in enumerate(results, start=1):
+        book = book_id(link)
+        record = state.books.get(book)
+        if not changed and record is not None:
+            summary['not_modified'] += 1
+            record['fetched_at'] = time.time()
+        else:
+            summary['fetched'] += 1
+            info = extract_book_info(body)
+            if info[0].startswith('Title Unavailable') or info[2] <= 0.0:
+                summary['invalid'] += 1
+                state.books[book] = {'fetched_at': time.time()}
+            else:
+                key = (record['title'], record['author']) if record and 'title' in record else (info[0], info[1])
+                if key in catalog_keys:
+                    updated_rows[key] = info
+                    summary['updated'] += 1
+                else:
+                    new_rows.append(info)
+                    catalog_keys.add(key)
+                    summary['added'] += 1
+                state.books[book] = {'fetched_at': time.time(), 'title': info[0], 'author': info[1]}
+        if processed % checkpoint_every == 0:
+            checkpoint()
+    checkpoint()
+    store.compact()
+
+    return summary
+
+
+def _write_atomically(path: str, text: str) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, delete=False) as file:
+        file.write(text)
+    os.replace(file.name, path)
+
+
+def main():
+    print(refresh_catalog(generate_popular_by_date_urls()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""This file contains a local HTTP stand-in for goodreads.com, so that the scraper can be exercised without
+touching the real site.
+"""
+import hashlib
+import multiprocessing
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Mapping, Optional
+
+
+class ReplayServer:
+    """A local HTTP server that answers GET requests for known paths with recorded page bodies.
+
+    Use it as a context manager; it serves from a background thread until the block exits.
+
+    Instance Attributes:
+    - pages: maps each path (e.g. '/book/show/1-a') to the html served for it
+    - latency: the number of seconds to wait before answering each request
+    - jitter: the most seconds added at random to the latency of each request
+    - error_rate: the fraction of requests answered with 503 Service Unavailable instead of the page, at random
+    - requests: the number of requests answered so far
+    - errors: the number of requests answered with 503 so far
+    - rewrite_host: a base url (e.g. 'https://www.goodreads.com') that is replaced by this server's own url in
+      every page served, so that links found in the pages lead back to this server, or None
+
+    Every page is served with an ETag, and a request whose If-None-Match matches it is answered with
+    304 Not Modified.
+
+    >>> with ReplayServer({'/hello': '<p>Hello</p>'}) as server:
+    ...     import urllib.request
+    ...     urllib.request.urlopen(server.url('/hello')).read()
+    b'<p>Hello</p>'
+    >>> with ReplayServer({'/hello': '<p>Hello</p>'}, error_rate=0.5, seed=1) as server:
+    ...     statuses = [server.respond('/hello', {})[0] for _ in range(1000)]
+    >>> 400 < statuses.count(503) < 600, server.errors == statuses.count(503)
+    (True, True)
+    """
+    pages: dict[str, str]
+    latency: float
+    jitter: float
+    error_rate: float
+    requests: int
+    errors: int
+    rewrite_host: Optional[str]
+
+    def __init__(self, pages: dict[str, str], latency: float = 0.0, rewrite_host: Optional[str] = None,
+                 jitter: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None) -> None:
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.rewrite_host = rewrite_host
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_directory(cls, directory: str = os.path.join('fixtures', 'goodreads'), **options) -> 'ReplayServer':
+        """Return a server for the recorded pages in directory, where the page for the path /a/b is stored
+        in the file a/b.html. Links to goodreads.com in the pages are rewritten to point at the server.
+        >>> server = ReplayServer.from_directory()
+        >>> sorted(server.pages)[0]
+        '/book/popular_by_date/2023/8'
+        """
+        options.setdefault('rewrite_host', 'https://www.goodreads.com')
+        pages = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith('.html'):
+                    path = os.path.join(root, name)
+                    relative = os.path.relpath(path, directory)[:-len('.html')]
+                    with open(path, 'r', encoding='utf-8') as file:
+                        pages['/' + relative.replace(os.sep, '/')] = file.read()
+        return cls(pages, **options)
+
+    def url(self, path: str = '/') -> str:
+        """Return the url at which this server serves the given path.
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}{path}'
+
+    def start(self) -> None:
+        """Start serving on a free local port.
+        """
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving and release the port.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def respond(self, path: str, request_headers: Mapping[str, str]) -> tuple[int, dict[str, str], bytes]:
+        """Return the status, headers and body to answer a GET request for path with.
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return 503, {'Content-Type': 'text/plain'}, b'Service Unavailable'
+        page = self.pages.get(path)
+        if page is None:
+            return 404, {'Content-Type': 'text/plain'}, b'Not Found'
+        if self.rewrite_host:
+            page = page.replace(self.rewrite_host, self.url('').rstrip('/'))
+        body = page.encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if request_headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'Content-Type': 'text/html; charset=utf-8', 'ETag': etag}, body
+
+    def __enter__(self) -> 'ReplayServer':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+@contextmanager
+def serve_in_subprocess(pages: dict[str, str], **options) -> Iterator[str]:
+    """Serve pages with a ReplayServer, built with the given options, in a process of its own for the duration of
+    the block, and yield the url of its root without the trailing slash.
+
+    Serving from another process keeps the server's work out of the time and CPU measured in this one.
+    >>> import urllib.request
+    >>> with serve_in_subprocess({'/hello': '<p>Hello</p>'}) as root:
+    ...     urllib.request.urlopen(root + '/hello').read()
+    b'<p>Hello</p>'
+    """
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=_serve, args=(pages, options, child), daemon=True)
+    process.start()
+    try:
+        yield parent.recv()
+    finally:
+        parent.send(None)
+        process.join()
+
+
+def _serve(pages: dict[str, str], options: dict, connection) -> None:
+    with ReplayServer(pages, **options) as server:
+        connection.send(server.url('').rstrip('/'))
+        connection.recv()
+
+
+def _make_handler(server: ReplayServer) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self) -> None:
+            status, headers, body = server.respond(self.path, self.headers)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    return Handler
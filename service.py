@@ -0,0 +1,350 @@
+"""This file contains the recommendation service, which runs recommendation requests in a pool of worker
+processes so that scoring and solving use every core instead of blocking the web server's workers.
+
+The workers map a binary snapshot of the catalog instead of parsing the catalog file, so starting one takes
+milliseconds and the catalog's arrays are shared by every worker through the page cache. When the catalog
+changes, publish_catalog() writes a new snapshot and shares its path with the workers, and a thread in each
+worker maps it in the background, so no request waits for a reload. Each web server worker
+runs its own service, so by default the pools share the host's cores out between them. The stage timings and
+recommendation cache counts a worker records are sent back with each result and added to this process's
+metrics, so /metrics shows them. The number of requests waiting or running is bounded, and requests beyond that
+are turned away straight away instead of queueing without limit. Every request has a deadline: a solve that
+cannot finish in time is cut short, and the request is answered with the top-k ranking instead, which takes
+milliseconds.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from binary_catalog import binary_snapshot
+from books import Book
+from catalog import catalog_version, get_catalog, load_catalog
+from cache import stats_changes
+from lpp import (Constraint, get_cached_recommendations, get_recommendation_model, get_recommendations_lpp,
+                 get_recommendations_sort, make_solver, max_books_per_author, min_books_per_genre,
+                 recommendation_cache, worker_cache_counts)
+from telemetry import REGISTRY, STAGE_SECONDS
+
+REJECTED_TOTAL = REGISTRY.counter('litloom_service_rejected_total',
+                                  'Recommendation requests turned away because the service was full.')
+FALLBACKS_TOTAL = REGISTRY.counter('litloom_service_fallbacks_total',
+                                   'Recommendation requests answered with the top-k ranking, by reason.', ('reason',))
+
+# The longest path of a catalog snapshot that can be shared with the workers, in bytes.
+MAX_SNAPSHOT_PATH = 4096
+
+# The least time a solve is given; requests with less time left than this go straight to the top-k ranking.
+MIN_SOLVE_SECONDS = 0.05
+
+
+def default_processes() -> int:
+    """Return the number of worker processes a service starts by default: the host's cores, shared out between
+    the web server's worker processes, each of which runs its own service. The number of web server workers is
+    taken from uwsgi when running under it, and from the WEB_CONCURRENCY environment variable otherwise.
+    >>> from unittest import mock
+    >>> with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': str(2 * (os.cpu_count() or 1))}):
+    ...     default_processes()
+    1
+    """
+    try:
+        import uwsgi
+        web_workers = uwsgi.numproc
+    except ImportError:
+        web_workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    return max(1, (os.cpu_count() or 1) // max(1, web_workers))
+
+
+class ServiceOverloaded(Exception):
+    """Raised when a request is submitted while the service already has as many requests as it accepts."""
+
+
+class PendingRecommendation:
+    """A recommendation request submitted to the service, whose result is available until its deadline.
+
+    Instance Attributes:
+    - genre_votes: the genre votes of the request
+    - num_books: the number of books requested
+    - expires_at: the time.monotonic() time by which the request is answered
+    """
+    genre_votes: dict[str, int]
+    num_books: int
+    expires_at: float
+
+    def __init__(self, service: 'RecommendationService', executor: ProcessPoolExecutor, future: Future,
+                 genre_votes: dict[str, int], num_books: int, expires_at: float) -> None:
+        self.genre_votes = genre_votes
+        self.num_books = num_books
+        self.expires_at = expires_at
+        self._service = service
+        self._executor = executor
+        self._future = future
+        self._submitted_at = time.monotonic()
+
+    def result(self) -> list[Book]:
+        """Return the recommended books, waiting until the deadline at most. If the worker has not answered by
+        then, return the top-k ranking instead.
+        """
+        try:
+            books, reason, _ = self._future.result(timeout=max(0.0, self.expires_at - time.monotonic()))
+        except TimeoutError:
+            books, reason = self._service.fallback(self.genre_votes, self.num_books), 'deadline'
+        except BrokenProcessPool:
+            self._service.restart(self._executor)
+            books, reason = self._service.fallback(self.genre_votes, self.num_books), 'worker'
+        if reason is not None:
+            FALLBACKS_TOTAL.inc(reason=reason)
+        STAGE_SECONDS.observe(time.monotonic() - self._submitted_at, stage='service')
+        return books
+
+
+class RecommendationService:
+    """A pool of worker processes answering recommendation requests from a catalog file.
+
+    The pool is started on the first request, so creating a service in a module that is imported before the
+    web server forks its workers does not fork the pool as well.
+
+    Instance Attributes:
+    - filename: the catalog file the workers load a snapshot of
+    - processes: the number of worker processes, default_processes() unless given
+    - max_queue: the number of requests that may wait for a worker, on top of those being worked on
+    - deadline: the default number of seconds a request is given
+    - reload_interval: the number of seconds between the workers' checks for a new snapshot
+    """
+    filename: str
+    processes: int
+    max_queue: int
+    deadline: float
+    reload_interval: float
+
+    def __init__(self, filename: str = 'book_info.csv', processes: Optional[int] = None,
+                 max_queue: Optional[int] = None, deadline: float = 2.0, reload_interval: float = 1.0) -> None:
+        self.filename = filename
+        self.reload_interval = reload_interval
+        self.processes = processes or default_processes()
+        self.max_queue = self.processes * 2 if max_queue is None else max_queue
+        self.deadline = deadline
+        self._slots = threading.BoundedSemaphore(self.processes + self.max_queue)
+        self._in_flight = 0
+        self._executor = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def submit(self, genre_votes: dict[str, int], num_books: int = 10, max_per_author: Optional[int] = None,
+               min_per_genre: Optional[int] = None, deadline: Optional[float] = None) -> PendingRecommendation:
+        """Submit a request for the num_books books best matching genre_votes, with at most max_per_author books
+        by any one author and at least min_per_genre books of every voted genre, if given.
+        Raise ServiceOverloaded if the service is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            REJECTED_TOTAL.inc()
+            raise ServiceOverloaded(f'{self.processes + self.max_queue} recommendation requests are already '
+                                    f'waiting or running')
+        deadline = self.deadline if deadline is None else deadline
+        with self._lock:
+            self._in_flight += 1
+        try:
+            executor = self._get_executor()
+            future = executor.submit(_recommend, genre_votes, num_books, max_per_author, min_per_genre,
+                                     time.time() + deadline)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(_record_telemetry)
+        future.add_done_callback(self._release)
+        return PendingRecommendation(self, executor, future, genre_votes, num_books, time.monotonic() + deadline)
+
+    def recommend(self, genre_votes: dict[str, int], num_books: int = 10, max_per_author: Optional[int] = None,
+                  min_per_genre: Optional[int] = None, deadline: Optional[float] = None) -> list[Book]:
+        """Return the recommended books for the request, as submitted with submit().
+        >>> with RecommendationService(processes=2) as service:
+        ...     votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+        ...     books = service.recommend(votes)
+        ...     diverse = service.recommend(votes, max_per_author=1, deadline=30)
+        >>> expected = get_recommendations_lpp(get_catalog(), votes)
+        >>> [book.title for book in books] == [book.title for book in expected]
+        True
+        >>> len({book.author for book in diverse})
+        10
+        """
+        return self.submit(genre_votes, num_books, max_per_author, min_per_genre, deadline).result()
+
+    def fallback(self, genre_votes: dict[str, int], num_books: int) -> list[Book]:
+        """Return the top-k ranking for the request, computed in this process.
+        """
+        return get_recommendations_sort(get_catalog(self.filename), genre_votes, num_books)
+
+    def publish_catalog(self) -> None:
+        """Write a snapshot of the catalog file as it is now, if there is not one already, and have the workers
+        switch to it. The workers map it in the background and answer requests from the catalog they have until
+        then.
+        >>> import shutil, tempfile
+        >>> from catalog_store import CatalogStore
+        >>> filename = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+        >>> _ = shutil.copy('book_info.csv', filename)
+        >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+        >>> with RecommendationService(filename, processes=1, reload_interval=0.05) as service:
+        ...     first = service.recommend(votes, 1)[0]
+        ...     CatalogStore(filename).delete(first.title, first.author)
+        ...     service.publish_catalog()
+        ...     time.sleep(1.0)
+        ...     second = service.recommend(votes, 1)[0]
+        >>> first.title != second.title
+        True
+        """
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.value = binary_snapshot(self.filename).encode('utf-8')
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of requests the workers have not finished and the most the service accepts.
+        """
+        with self._lock:
+            return {'in_flight': self._in_flight, 'capacity': self.processes + self.max_queue}
+
+    def restart(self, executor: ProcessPoolExecutor) -> None:
+        """Replace executor, a pool that lost a worker process, with a fresh one started on the next request.
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        """Stop the worker processes once they finish the requests they have.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def __enter__(self) -> 'RecommendationService':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a threaded web server is unsafe, so the workers are started fresh.
+                context = multiprocessing.get_context('spawn')
+                if self._snapshot is None:
+                    self._snapshot = context.Array('c', MAX_SNAPSHOT_PATH)
+                self._snapshot.value = binary_snapshot(self.filename).encode('utf-8')
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                                     initializer=_start_worker,
+                                                     initargs=(self.filename, self._snapshot, self.reload_interval))
+            return self._executor
+
+    def _release(self, future: Optional[Future]) -> None:
+        # Slots are given back when a worker finishes, not at the deadline, so they count the real backlog.
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+
+def _record_telemetry(future: Future) -> None:
+    # Runs even when the request has passed its deadline, so the time the worker spent is still recorded.
+    if not future.cancelled() and future.exception() is None:
+        telemetry = future.result()[2]
+        STAGE_SECONDS.merge(telemetry['stages'])
+        worker_cache_counts.add(telemetry['cache'])
+
+
+# The path of the snapshot this worker process answers from, and the catalog loaded from it.
+_worker = {'path': None, 'catalog': None}
+_author_constraints = {}
+
+
+def _start_worker(filename: str, snapshot, interval: float) -> None:
+    """Load the snapshot whose path is in snapshot, a shared array, and start a thread that loads the next one
+    whenever the path or the snapshot changes. Runs in a worker process when it starts.
+    """
+    _load_snapshot(filename, snapshot.value.decode('utf-8'))
+    threading.Thread(target=_follow_snapshots, args=(filename, snapshot, interval),
+                     name='litloom-worker-reloader', daemon=True).start()
+
+
+def _load_snapshot(filename: str, path: str) -> None:
+    """Make the snapshot at path this worker's catalog, or the catalog file filename if the snapshot is gone.
+    Only the worker's current catalog is kept: snapshots are not loaded into the process-wide catalogs of
+    get_catalog, which would keep every version ever published, and the mapping of each snapshot file removed by
+    binary_snapshot, for the life of the worker.
+    >>> import shutil, tempfile
+    >>> from catalog import _catalogs
+    >>> from catalog_store import CatalogStore
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'book_info.csv')
+    >>> _ = shutil.copy('book_info.csv', filename)
+    >>> path = binary_snapshot(filename)
+    >>> loaded = set(_catalogs)
+    >>> _load_snapshot(filename, path)
+    >>> first = _worker['catalog']
+    >>> CatalogStore(filename).delete('Lessons in Chemistry', 'Bonnie Garmus')
+    >>> _load_snapshot(filename, binary_snapshot(filename))
+    >>> len(first), len(_worker['catalog']), set(_catalogs) - loaded
+    (205, 204, set())
+    >>> _worker.update(path=None, catalog=None)
+    """
+    try:
+        catalog = load_catalog(path)
+    except FileNotFoundError:
+        # A newer snapshot replaced it before it was loaded; the catalog file itself is as new.
+        catalog = load_catalog(filename)
+    # The catalog is swapped in whole, so a request uses either the old catalog or the new one throughout.
+    _worker['path'], _worker['catalog'] = path, catalog
+
+
+def _follow_snapshots(filename: str, snapshot, interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        path = snapshot.value.decode('utf-8')
+        try:
+            # A binary catalog file is its own snapshot, and is rewritten in place.
+            if path != _worker['path'] or (path == filename and catalog_version(path) != _worker['catalog'].version):
+                _load_snapshot(filename, path)
+        except Exception:
+            # Requests keep the catalog they have until the next check.
+            continue
+
+
+def _recommend(genre_votes: dict[str, int], num_books: int, max_per_author: Optional[int],
+               min_per_genre: Optional[int], deadline: float) -> tuple[list[Book], Optional[str], dict]:
+    """Return the recommended books for a request, the reason why if they are the top-k ranking instead of the
+    solver's answer, and the telemetry the worker recorded since its last result: the stage timings, as returned
+    by Histogram.drain(), and the changes in its recommendation cache's counts. Runs in a worker process;
+    deadline is a time.time() time.
+    """
+    cache_before = recommendation_cache.stats()
+    books, reason = _recommend_books(genre_votes, num_books, max_per_author, min_per_genre, deadline)
+    telemetry = {'stages': STAGE_SECONDS.drain(),
+                 'cache': stats_changes(cache_before, recommendation_cache.stats())}
+    return books, reason, telemetry
+
+
+def _recommend_books(genre_votes: dict[str, int], num_books: int, max_per_author: Optional[int],
+                     min_per_genre: Optional[int], deadline: float) -> tuple[list[Book], Optional[str]]:
+    catalog = _worker['catalog']
+    remaining = deadline - time.time()
+    if remaining < MIN_SOLVE_SECONDS:
+        return get_recommendations_sort(catalog, genre_votes, num_books), 'queue'
+
+    constraints: list[Constraint] = []
+    if max_per_author is not None:
+        # The same constraint object is passed every time, so that the model built for it is reused.
+        constraints.append(_author_constraints.setdefault(max_per_author, max_books_per_author(max_per_author)))
+    extra = [min_books_per_genre(genre_votes, min_per_genre)] if min_per_genre else []
+    if not constraints and not extra:
+        return get_cached_recommendations(catalog, genre_votes, num_books), None
+
+    try:
+        model = get_recommendation_model(catalog, constraints)
+        solver = make_solver(time_limit=max(MIN_SOLVE_SECONDS, deadline - time.time()))
+        return model.solve(genre_votes, num_books, extra, solver=solver), None
+    except ValueError:
+        return get_recommendations_sort(catalog, genre_votes, num_books), 'solver'
@@ -0,0 +1,152 @@
+"""This file contains the streaming recommendation mode, which ranks catalogs too large to load into memory.
+
+The catalog is read through a generator a chunk of rows at a time, each chunk is scored in one vectorized pass,
+and only the best books seen so far are kept. Memory use depends on the chunk size, the number of books kept and
+the size of the catalog's change log, not on the size of the catalog. The log is held in memory while the csv
+file is read, and the catalog store compacts it into the csv file once it grows past CatalogStore.max_log_bytes.
+With constraints, more books than requested are kept as candidates, and the constraints are solved over the
+candidates only.
+"""
+import argparse
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+
+from books import Book, book_from_row
+from catalog import Catalog, top_k_indices
+from catalog_store import CatalogStore
+from lpp import Constraint, RecommendationModel, max_books_per_author
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+CHUNK_SIZE = 10_000
+# Without a number of candidates given, a constrained request keeps this many times the books it asks for.
+CANDIDATE_FACTOR = 10
+
+
+def iter_chunks(filename: str = 'book_info.csv', chunk_size: int = CHUNK_SIZE) -> Iterator[list[list[str]]]:
+    """Yield the rows of the csv catalog filename, with its change log applied, chunk_size rows at a time.
+    >>> [len(chunk) for chunk in iter_chunks(chunk_size=100)]
+    [100, 100, 5]
+    """
+    chunk = []
+    for row in CatalogStore(filename).rows():
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_top_k(filename: str, genre_votes: dict[str, int], k: int, chunk_size: int = CHUNK_SIZE,
+                 stats: Optional[dict[str, float]] = None) -> list[Book]:
+    """Return the k books in the csv catalog filename with the highest combined scores, highest first, with ties
+    broken in favour of the book that appears first: the books get_recommendations_sort returns for the whole
+    catalog. If stats is given, the number of rows read, the seconds taken and the rows read per second are
+    recorded in it.
+    >>> from catalog import get_catalog
+    >>> from lpp import get_recommendations_sort
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> stats = {}
+    >>> books = stream_top_k('book_info.csv', votes, 10, chunk_size=16, stats=stats)
+    >>> [book.title for book in books] == [book.title for book in get_recommendations_sort(get_catalog(), votes)]
+    True
+    >>> stats['rows']
+    205
+    """
+    return _stream_best(filename, genre_votes, k, chunk_size, stats)[0]
+
+
+def stream_recommendations(filename: str, genre_votes: dict[str, int], num_books: int = 10,
+                           constraints: Optional[list[Constraint]] = None, candidates: Optional[int] = None,
+                           chunk_size: int = CHUNK_SIZE, stats: Optional[dict[str, float]] = None) -> list[Book]:
+    """Return the recommended books from the csv catalog filename, in catalog order.
+
+    Without constraints, these are the books get_recommendations_lpp returns for the whole catalog. With
+    constraints, they are the best books satisfying them among the candidates books with the highest combined
+    scores (CANDIDATE_FACTOR times num_books by default), which is the best in the whole catalog unless the
+    constraints rule out too many of the candidates. stats is filled in as by stream_top_k.
+    >>> from catalog import get_catalog
+    >>> from lpp import get_recommendations_lpp
+    >>> votes = {'Fiction': 4, 'Romance': 3, 'Feminism': 2, 'Horror': 1}
+    >>> books = stream_recommendations('book_info.csv', votes, chunk_size=16)
+    >>> [book.title for book in books] == [book.title for book in get_recommendations_lpp(get_catalog(), votes)]
+    True
+    >>> diverse = stream_recommendations('book_info.csv', votes, constraints=[max_books_per_author(1)])
+    >>> len(diverse), len({book.author for book in diverse})
+    (10, 10)
+    """
+    if not constraints:
+        candidates = num_books
+    elif candidates is None:
+        candidates = CANDIDATE_FACTOR * num_books
+    books, ids = _stream_best(filename, genre_votes, candidates, chunk_size, stats)
+    books = [books[i] for i in np.argsort(ids, kind='stable').tolist()]
+    if not constraints:
+        return books
+    return RecommendationModel(books, constraints).solve(genre_votes, num_books)
+
+
+def _stream_best(filename: str, genre_votes: dict[str, int], k: int, chunk_size: int,
+                 stats: Optional[dict[str, float]]) -> tuple[list[Book], np.ndarray]:
+    """Return the books stream_top_k returns and their positions in the catalog.
+    """
+    start = time.perf_counter()
+    best_rows = []
+    best_ids = np.zeros(0, dtype=np.int64)
+    best_scores = np.zeros(0, dtype=np.float64)
+    rows = 0
+    for chunk in iter_chunks(filename, chunk_size):
+        scores = Catalog.from_rows(chunk).combined_scores(genre_votes)
+        selected = top_k_indices(scores, k)
+        ids = np.concatenate((best_ids, selected + rows))
+        candidate_scores = np.concatenate((best_scores, scores[selected]))
+        candidates = best_rows + [chunk[i] for i in selected.tolist()]
+        order = np.lexsort((ids, -candidate_scores))[:k]
+        best_ids, best_scores = ids[order], candidate_scores[order]
+        best_rows = [candidates[i] for i in order.tolist()]
+        rows += len(chunk)
+
+    if stats is not None:
+        seconds = time.perf_counter() - start
+        stats.update({'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds else 0.0})
+    return [book_from_row(row) for row in best_rows], best_ids
+
+
+def peak_memory() -> Optional[int]:
+    """Return the peak resident memory of this process so far in bytes, or None where it cannot be measured.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank a csv catalog without loading it into memory.')
+    parser.add_argument('filename', nargs='?', default='book_info.csv')
+    parser.add_argument('--votes', nargs='+', default=['Fiction=1'], metavar='GENRE=VOTES')
+    parser.add_argument('--num-books', type=int, default=10)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--max-per-author', type=int)
+    args = parser.parse_args()
+
+    genre_votes = {genre: int(votes) for genre, votes in (vote.rsplit('=', 1) for vote in args.votes)}
+    constraints = [max_books_per_author(args.max_per_author)] if args.max_per_author else None
+    stats = {}
+    books = stream_recommendations(args.filename, genre_votes, args.num_books, constraints,
+                                   chunk_size=args.chunk_size, stats=stats)
+    for book in books:
+        print(f"'{book.title}' by {book.author}")
+    memory = peak_memory()
+    print(f"{stats['rows']:,} rows in {stats['seconds']:.2f} s ({stats['rows_per_second']:,.0f} rows/s), "
+          f"peak memory {'unknown' if memory is None else f'{memory / 2 ** 20:.1f} MiB'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""This file contains the counters and latency histograms the app records on its hot path, and renders them in
+the Prometheus text exposition format for the /metrics endpoint.
+"""
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from cache import COUNTED_STATS
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """A monotonically increasing count, kept separately for each combination of label values.
+
+    Instance Attributes:
+    - name: the metric name
+    - help: a one-line description of the metric
+    - label_names: the names of the labels each count is kept under
+    """
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {} if label_names else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add amount to the count for the given label values.
+        """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Return the count for the given label values.
+        """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.label_names, key)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    """A distribution of observed values, such as latencies in seconds, counted into cumulative buckets
+    separately for each combination of label values.
+
+    Instance Attributes:
+    - name: the metric name
+    - help: a one-line description of the metric
+    - label_names: the names of the labels each distribution is kept under
+    - buckets: the upper bounds of the buckets, in increasing order
+    """
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record one observation of value for the given label values.
+        """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the number of seconds the block takes, under the given label values.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def count(self, **labels: str) -> int:
+        """Return the number of observations recorded for the given label values.
+        """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            return 0 if series is None else series[2]
+
+    def total(self, **labels: str) -> float:
+        """Return the sum of the observations recorded for the given label values.
+        """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            return 0.0 if series is None else series[1]
+
+    def drain(self) -> dict[tuple[str, ...], tuple[list[int], float, int]]:
+        """Return the observations recorded so far, by label values, and forget them, so that they can be sent to
+        another process and merged into its histogram.
+        >>> latency = Histogram('demo_seconds', 'Demo latency.', ('stage',), buckets=(0.1, 1.0))
+        >>> latency.observe(0.5, stage='solve')
+        >>> other = Histogram('demo_seconds', 'Demo latency.', ('stage',), buckets=(0.1, 1.0))
+        >>> other.merge(latency.drain())
+        >>> other.count(stage='solve'), latency.count(stage='solve')
+        (1, 0)
+        """
+        with self._lock:
+            series, self._series = self._series, {}
+        return {key: (bucket_counts, total, count) for key, (bucket_counts, total, count) in series.items()}
+
+    def merge(self, series: dict[tuple[str, ...], tuple[list[int], float, int]]) -> None:
+        """Add the observations returned by drain() on a histogram with the same labels and buckets.
+        """
+        with self._lock:
+            for key, (bucket_counts, total, count) in series.items():
+                mine = self._series.get(key)
+                if mine is None:
+                    mine = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+                mine[0] = [a + b for a, b in zip(mine[0], bucket_counts)]
+                mine[1] += total
+                mine[2] += count
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _labels(self.label_names + ('le',), key + (_number(bound),))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _labels(self.label_names + ('le',), key + ('+Inf',))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Registry:
+    """The set of metrics exposed on /metrics.
+
+    Besides counters and histograms, the registry holds collectors: functions called at render time that return
+    (name, type, help, value) tuples for values kept elsewhere, such as the recommendation cache's counters.
+    """
+
+    def __init__(self) -> None:
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        """Return a new counter registered under name.
+        """
+        return self._register(Counter(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Return a new histogram registered under name.
+        """
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def register_collector(self, collector: Callable[[], list[tuple[str, str, str, float]]]) -> None:
+        """Call collector every time the registry is rendered, and expose the values it returns.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format.
+        >>> registry = Registry()
+        >>> latency = registry.histogram('demo_seconds', 'Demo latency.', ('stage',), buckets=(0.1, 1.0))
+        >>> latency.observe(0.5, stage='solve')
+        >>> registry.counter('demo_total', 'Demo count.').inc()
+        >>> print(registry.render())
+        # HELP demo_seconds Demo latency.
+        # TYPE demo_seconds histogram
+        demo_seconds_bucket{stage="solve",le="0.1"} 0
+        demo_seconds_bucket{stage="solve",le="1"} 1
+        demo_seconds_bucket{stage="solve",le="+Inf"} 1
+        demo_seconds_sum{stage="solve"} 0.5
+        demo_seconds_count{stage="solve"} 1
+        # HELP demo_total Demo count.
+        # TYPE demo_total counter
+        demo_total 1
+        <BLANKLINE>
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            for name, metric_type, help, value in collector():
+                lines.extend([f'# HELP {name} {help}', f'# TYPE {name} {metric_type}', f'{name} {_number(value)}'])
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f'a metric named {metric.name} is already registered')
+            self._metrics.append(metric)
+        return metric
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _number(value: float) -> str:
+    return repr(value) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'litloom_stage_seconds', 'Time spent in each stage of producing recommendations.', ('stage',))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'litloom_request_seconds', 'Time spent handling each HTTP request, by endpoint.', ('endpoint',))
+REQUESTS_TOTAL = REGISTRY.counter(
+    'litloom_requests_total', 'HTTP requests handled, by endpoint and status code.', ('endpoint', 'status'))
+PROFILES_TOTAL = REGISTRY.counter('litloom_profiles_total', 'Request profiles written to disk.')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# The help text of each value cache_collector exposes, by its name in RecommendationCache.stats().
+_CACHE_HELP = {'hits': 'Lookups answered from the cache.', 'misses': 'Lookups that computed their result.',
+               'evictions': 'Entries dropped to stay within maxsize.',
+               'invalidations': 'Times the cache was cleared by a catalog change.', 'size': 'Entries currently cached.'}
+
+
+def cache_collector(prefix: str, *caches) -> Callable[[], list[tuple[str, str, str, float]]]:
+    """Return a collector exposing the counters and size of RecommendationCaches under the given name prefix,
+    added up over caches, which may also include CacheCounts received from other processes.
+    >>> from cache import RecommendationCache
+    >>> cache = RecommendationCache(maxsize=8)
+    >>> _ = cache.get_or_compute('a', lambda: 1)
+    >>> _ = cache.get_or_compute('a', lambda: 1)
+    >>> [(name, value) for name, _, _, value in cache_collector('demo_cache', cache)()]
+    [('demo_cache_hits_total', 1), ('demo_cache_misses_total', 1), ('demo_cache_evictions_total', 0), ('demo_cache_invalidations_total', 0), ('demo_cache_size', 1)]
+    """
+    def collect() -> list[tuple[str, str, str, float]]:
+        stats = {name: 0 for name in COUNTED_STATS}
+        for cache in caches:
+            for name, value in cache.stats().items():
+                if name in stats:
+                    stats[name] += value
+        # The size is a gauge; every other value only grows, so it is a counter.
+        return [(f'{prefix}_{name}', 'gauge', _CACHE_HELP[name], value) if name == 'size' else
+                (f'{prefix}_{name}_total', 'counter', _CACHE_HELP[name], value) for name, value in stats.items()]
+    return collect
+
+
+class RequestProfiler:
+    """Opt-in cProfile profiling of Flask requests.
+
+    Nothing is profiled unless the app's PROFILING config flag is set. Then, a request carrying the PROFILE_HEADER
+    header is profiled and its profile written to PROFILE_DIR; and if PROFILE_SLOWER_THAN is a number of seconds,
+    requests are profiled until the first one to take at least that long, whose profile is written before
+    PROFILE_SLOWER_THAN is reset to None. Only one request is profiled at a time.
+
+    Profiles are pstats files, named after the time and endpoint of the request, and can be read with
+    python -m pstats or snakeviz.
+    """
+    header = 'X-Profile'
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def start(self, config: dict, headers) -> Optional[cProfile.Profile]:
+        """Return a running profiler for the current request, or None if it is not to be profiled.
+        """
+        if not config.get('PROFILING'):
+            return None
+        if not headers.get(self.header) and config.get('PROFILE_SLOWER_THAN') is None:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: cProfile.Profile, config: dict, headers, endpoint: str,
+               elapsed: float) -> Optional[str]:
+        """Stop profile and write it out if the request asked for it or was slow, returning the file written.
+        """
+        profile.disable()
+        try:
+            threshold = config.get('PROFILE_SLOWER_THAN')
+            requested = bool(headers.get(self.header))
+            if not requested and (threshold is None or elapsed < threshold):
+                return None
+            if not requested:
+                config['PROFILE_SLOWER_THAN'] = None
+            directory = config.get('PROFILE_DIR', 'profiles')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, '{}-{}-{:.0f}ms.prof'.format(
+                time.strftime('%Y%m%dT%H%M%S'), endpoint, elapsed * 1000))
+            profile.dump_stats(path)
+            PROFILES_TOTAL.inc()
+            return path
+        finally:
+            self._lock.release()
+
+    def abandon(self, profile: cProfile.Profile) -> None:
+        """Stop profile without writing it out, for a request that failed before it finished.
+        """
+        profile.disable()
+        self._lock.release()
+
+
+def instrument(app) -> None:
+    """Record the latency and status of every request the Flask app handles, and profile requests as configured
+    by its PROFILING, PROFILE_SLOWER_THAN and PROFILE_DIR settings (see RequestProfiler).
+    """
+    from flask import g, request
+
+    app.config.setdefault('PROFILING', False)
+    app.config.setdefault('PROFILE_SLOWER_THAN', None)
+    app.config.setdefault('PROFILE_DIR', 'profiles')
+    profiler = RequestProfiler()
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.request_profile = profiler.start(app.config, request.headers)
+
+    @app.after_request
+    def record_request(response):
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        REQUESTS_TOTAL.inc(endpoint=endpoint, status=response.status_code)
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            profiler.finish(profile, app.config, request.headers, endpoint, elapsed)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exception):
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            profiler.abandon(profile)
@@ -0,0 +1,193 @@
+"""This file contains the vote store, where the members of each book club cast weighted votes for genres.
+
+Votes are kept in a SQLite database. Alongside the ballots, the store keeps every club's total votes per genre,
+updated in the same transaction as each ballot, so reading a club's genre votes only reads that club's totals.
+
+The database runs in write-ahead logging mode, so reads never wait for writes. All writes go through a single
+writer thread, which commits every ballot waiting for it in one transaction: many members voting at once share
+one commit instead of queueing for the database lock one by one.
+"""
+import queue
+import sqlite3
+import threading
+from typing import Iterable
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ballots (
+    club TEXT NOT NULL,
+    member TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (club, member, genre)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS genre_totals (
+    club TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (club, genre)
+) WITHOUT ROWID;
+"""
+
+
+class VoteStore:
+    """The genre votes of every book club's members, and each club's running totals per genre.
+
+    Each member has one ballot per club, mapping genres to whole-number weights; casting a new ballot replaces
+    the member's previous one.
+
+    Instance Attributes:
+    - path: the SQLite database file
+    - batch_size: the most ballots committed in one transaction
+
+    >>> import os, tempfile
+    >>> store = VoteStore(os.path.join(tempfile.mkdtemp(), 'votes.db'))
+    >>> store.cast('tuesday', 'ana', {'Fantasy': 3, 'Romance': 1})
+    >>> store.cast('tuesday', 'ben', {'Fantasy': 1, 'Horror': 2})
+    >>> store.genre_votes('tuesday')
+    {'Fantasy': 4, 'Horror': 2, 'Romance': 1}
+    >>> store.cast('tuesday', 'ana', {'Mystery': 2})
+    >>> store.genre_votes('tuesday')
+    {'Fantasy': 1, 'Horror': 2, 'Mystery': 2}
+    >>> store.ballot('tuesday', 'ana'), store.genre_votes('thursday')
+    ({'Mystery': 2}, {})
+    >>> store.close()
+    """
+    path: str
+    batch_size: int
+
+    def __init__(self, path: str = 'votes.db', batch_size: int = 512) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        connection.close()
+        self._local = threading.local()
+        self._pending = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='litloom-votes', daemon=True)
+        self._writer.start()
+
+    def cast(self, club: str, member: str, ballot: dict[str, int]) -> None:
+        """Replace member's ballot in club with ballot, returning once it is committed.
+        Genres with no votes are left out. Raise ValueError if a weight is negative or not a whole number.
+        """
+        self.cast_many([(club, member, ballot)])
+
+    def cast_many(self, ballots: Iterable[tuple[str, str, dict[str, int]]]) -> None:
+        """Cast every (club, member, ballot) in ballots, in order, returning once they are all committed.
+        """
+        ballots = [(club, member, _validate(ballot)) for club, member, ballot in ballots]
+        if not ballots:
+            return
+        request = (ballots, threading.Event(), [])
+        self._pending.put(request)
+        request[1].wait()
+        if request[2]:
+            raise request[2][0]
+
+    def genre_votes(self, club: str) -> dict[str, int]:
+        """Return the total votes for each genre across the ballots of club's members.
+        """
+        rows = self._reader().execute(
+            'SELECT genre, total FROM genre_totals WHERE club = ? ORDER BY genre', (club,)).fetchall()
+        return dict(rows)
+
+    def ballot(self, club: str, member: str) -> dict[str, int]:
+        """Return member's current ballot in club, which is empty if they have not voted.
+        """
+        rows = self._reader().execute('SELECT genre, weight FROM ballots WHERE club = ? AND member = ? ORDER BY genre',
+                                      (club, member)).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        """Commit the ballots already cast and stop the writer thread.
+        """
+        self._pending.put(None)
+        self._writer.join()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def _write_loop(self) -> None:
+        connection = self._connect()
+        while True:
+            request = self._pending.get()
+            if request is None:
+                break
+            requests = [request]
+            count = len(request[0])
+            while count < self.batch_size:
+                try:
+                    request = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._pending.put(None)
+                    break
+                requests.append(request)
+                count += len(request[0])
+
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                for ballots, _, _ in requests:
+                    for club, member, ballot in ballots:
+                        _replace_ballot(connection, club, member, ballot)
+                connection.execute('COMMIT')
+            except Exception as error:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                for _, _, errors in requests:
+                    errors.append(error)
+            for _, done, _ in requests:
+                done.set()
+        connection.close()
+
+
+def _validate(ballot: dict[str, int]) -> dict[str, int]:
+    for genre, weight in ballot.items():
+        if not isinstance(weight, int) or isinstance(weight, bool) or weight < 0:
+            raise ValueError(f'the vote for {genre} must be a whole number of at least 0, not {weight!r}')
+    return {genre: weight for genre, weight in ballot.items() if weight}
+
+
+def _replace_ballot(connection: sqlite3.Connection, club: str, member: str, ballot: dict[str, int]) -> None:
+    """Replace member's ballot in club and apply the difference to the club's genre totals.
+    """
+    old = dict(connection.execute(
+        'SELECT genre, weight FROM ballots WHERE club = ? AND member = ?', (club, member)).fetchall())
+    changes = {genre: ballot.get(genre, 0) - weight for genre, weight in old.items()}
+    for genre, weight in ballot.items():
+        changes.setdefault(genre, weight)
+    changes = [(club, genre, change) for genre, change in changes.items() if change]
+    if not changes:
+        return
+
+    connection.execute('DELETE FROM ballots WHERE club = ? AND member = ?', (club, member))
+    connection.executemany('INSERT INTO ballots VALUES (?, ?, ?, ?)',
+                           [(club, member, genre, weight) for genre, weight in ballot.items()])
+    connection.executemany('INSERT INTO genre_totals VALUES (?, ?, ?) '
+                           'ON CONFLICT (club, genre) DO UPDATE SET total = total + excluded.total', changes)
+    connection.executemany('DELETE FROM genre_totals WHERE club = ? AND genre = ? AND total = 0',
+                           [(club, genre) for club, genre, _ in changes])
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_vote_store(path: str = 'votes.db') -> VoteStore:
+    """Return the process-wide vote store for the given database file, opening it on first use.
+    """
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = VoteStore(path)
+        return store
@@ -0,0 +1,18 @@
+"""This file contains the WSGI entry point for serving LitLoom with a pre-forking server such as uwsgi:
+
+    uwsgi --master --http :8000 --processes 4 --threads 4 --module wsgi:app
+
+uwsgi imports this module once, in its master process, and forks the workers from it (unless lazy-apps is set).
+The catalog that create_app loads is therefore loaded once and shared copy-on-write by every worker, and a worker
+started by a restart or by autoscaling answers its first request without importing or loading anything. Each
+worker starts its own pool of recommendation processes, and the pools share the host's cores out between the
+--processes workers.
+"""
+import gc
+
+from app import create_app
+
+app = create_app()
+# Move everything loaded so far out of the garbage collector's reach, so that collections in the workers do not
+# write to the pages it is on, which would give every worker its own copy of them.
+gc.freeze()